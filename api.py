@@ -1,18 +1,34 @@
 # Author: Steven Lansangan
 # Simple API wrapper
 # This is what connects to the internet
-from fastapi import FastAPI, HTTPException, Body
+from fastapi import FastAPI, HTTPException, Body, Request
 from pydantic import BaseModel
-from typing import Optional, Dict
+from typing import Optional, Dict, List
 import uvicorn
+import asyncio
+import json
+import logging
 import os
 import re
+import secrets
+import time
+from urllib.parse import quote
 
 import base64
-from backend import babaru_brain
-from utils import memory_manager, voice_manager
+
+# .env and logging first, everything below reads its settings on import
+from utils import warmup
+warmup.configure()
+
+from backend import babaru_brain, post_turn, batch, nudges
+from backend.user_actors import actors, UserBusy
+from utils import memory_manager, voice_manager, executors, tts_cache, upstream, metrics
+from utils.audio_store import AudioStore
 
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse, Response, JSONResponse
+
+logger = logging.getLogger("API")
 
 app = FastAPI(title="Babaru Cloud API", version="1.0.0")
 
@@ -24,8 +40,48 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # So browser clients can read the reply text when the body is raw audio
+    expose_headers=["X-Babaru-Response", "Content-Range", "Accept-Ranges", "Server-Timing"],
 )
 
+# Audio handed out by id (GET /v1/audio/{id}) instead of inlined as base64
+audio_store = AudioStore()
+
+# Every Gemini/ElevenLabs call made for a request has to fit in this many seconds
+# (clients can ask for less with an X-Request-Timeout header)
+REQUEST_DEADLINE_SECONDS = float(os.getenv("BABARU_REQUEST_DEADLINE", "60"))
+
+PER_ITEM_DEADLINE = {"/v1/chat/batch"}
+
+@app.middleware("http")
+async def request_deadline(request: Request, call_next):
+    seconds = REQUEST_DEADLINE_SECONDS
+    try:
+        seconds = min(seconds, float(request.headers.get("x-request-timeout", seconds)))
+    except ValueError:
+        pass
+    if request.url.path in PER_ITEM_DEADLINE:
+        # A batch can run for minutes, each item gets the deadline instead
+        request.state.item_deadline = seconds
+        return await call_next(request)
+    with upstream.deadline(seconds):
+        return await call_next(request)
+
+@app.middleware("http")
+async def server_timing(request: Request, call_next):
+    # Every stage below records into this request's timings (see utils/metrics.py)
+    # Streamed responses only get what happened before the first byte
+    with metrics.request_timings() as timings:
+        response = await call_next(request)
+    # Route template, not the raw path, so /v1/audio/{audio_id} stays one series
+    route = getattr(request.scope.get("route"), "path", "unmatched")
+    metrics.REQUEST_SECONDS.observe(time.perf_counter() - timings.started,
+                                    method=request.method, route=route, status=response.status_code)
+    response.headers["Server-Timing"] = timings.header()
+    # Lets browser JS read Server-Timing cross-origin too
+    response.headers["Timing-Allow-Origin"] = "*"
+    return response
+
 class ChatRequest(BaseModel):
     user_id: str
     message: str
@@ -34,104 +90,460 @@ class ChatRequest(BaseModel):
 class ChatResponse(BaseModel):
     response: str
     audio_base64: Optional[str] = None # Added for audio data
+    # With ?audio=ref: fetch the MP3 from audio_url instead (expires after BABARU_AUDIO_TTL)
+    audio_id: Optional[str] = None
+    audio_url: Optional[str] = None
     
+database = warmup.lazy("db", memory_manager.init_db)
+
+# serve.py workers warm up completely before taking traffic (the port is already open in the parent)
+WARM_BEFORE_SERVE = os.getenv("BABARU_WARM_BEFORE_SERVE", "0") == "1"
+
+async def _warm_up():
+    # SDK clients, the prompt cache and the songs, all at once on their own pools
+    # Requests that arrive before this is done just build what they need themselves
+    await warmup.warm_async()
+    # Render the signature lines into the TTS cache in the background (costs ElevenLabs credits once)
+    phrases = os.getenv("BABARU_TTS_PREWARM")
+    if phrases and os.path.exists(phrases):
+        executors.get_executor("tts").submit(voice_manager.prewarm, list(tts_cache.read_phrases(phrases)))
+
 @app.on_event("startup")
 async def startup_event():
-    memory_manager.init_db()
+    # Only the cheap must-haves here, uvicorn doesn't bind the port until this returns
+    database.get()
+    # History, missions, points and streaks get applied by a background worker after each reply
+    post_turn.start()
+    # Morning / gone-quiet nudges (BABARU_NUDGES=on), one worker schedules them for everyone
+    nudges.start()
+    if WARM_BEFORE_SERVE:
+        await _warm_up()
+    else:
+        # Everything heavy warms up after the port is open, /ready says when it's done
+        app.state.warming = asyncio.ensure_future(_warm_up())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    # Apply queued turns so nothing waits for the next deploy
+    # (turns left in the queue survive anyway, the next startup picks them up)
+    await nudges.stop()
+    post_turn.stop()
+    executors.shutdown(wait=False)
 
 @app.get("/")
 def read_root():
     return {"status": "Babaru is watching you.", "version": "1.0.0"}
 
+@app.get("/ready")
+def ready_endpoint():
+    """
+    200 once every dependency is warm, 503 (with what's still missing) before that.
+    For load balancer readiness checks, / is the liveness one.
+    """
+    states = warmup.states()
+    return JSONResponse(status_code=200 if warmup.all_ready() else 503,
+                        content={"ready": warmup.all_ready(), "dependencies": states})
+
+@app.get("/v1/stats")
+def stats_endpoint():
+    """Queues, caches and upstream health, for eyeballing a running server"""
+    return {
+        "turns": actors.stats(),
+        "post_turn": post_turn.stats(),
+        "nudges": {**nudges.scheduler.stats(), **memory_manager.nudge_stats()},
+        "upstreams": upstream.stats(),
+        "memory_cache": memory_manager.cache_stats(),
+        "tts_cache": voice_manager.audio_cache.stats(),
+        "jukebox": voice_manager.jukebox.stats(),
+        "prompt_cache": babaru_brain.prefix_cache_lazy.value.stats() if babaru_brain.prefix_cache_lazy.value else None,
+    }
+
+# The same stats, as gauges next to the stage histograms
+metrics.register_stats("babaru_turns", actors.stats)
+metrics.register_stats("babaru_post_turn", post_turn.stats)
+metrics.register_stats("babaru_nudges", nudges.scheduler.stats)
+metrics.register_stats("babaru_upstream", upstream.stats, label="upstream")
+metrics.register_stats("babaru_memory_cache", memory_manager.cache_stats)
+metrics.register_stats("babaru_tts_cache", voice_manager.audio_cache.stats)
+metrics.register_stats("babaru_jukebox", voice_manager.jukebox.stats)
+
+@app.get("/metrics")
+def metrics_endpoint():
+    """Prometheus scrape target"""
+    return Response(content=metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+async def _render_reply_audio(ai_reply: str) -> Optional[bytes]:
+    # Turns Babaru's reply into one MP3, singing included
+    # TTS goes through the async ElevenLabs client, ffmpeg mixing runs on the 'mix' pool
+
+    # JukeBox Logic: Check for [PLAY_SONG: xyz] (same tag pattern the streaming path splits on)
+    song_match = voice_manager.SONG_TAG.search(ai_reply)
+
+    if not song_match:
+        # Standard Voice (sentences synthesized in parallel)
+        try:
+            return await voice_manager.generate_voice_pipelined(ai_reply)
+        except Exception as v_err:
+            logger.warning(f"Voice broke: {v_err}") # It's fine, just log it
+            metrics.fallback("voice_broke")
+            return None
+
+    try:
+        song_name = song_match.group(1).strip().lower()
+        # User wants "You want me to sing? okay, [sing] then..."
+        # Use split to get intro and outro
+        parts = ai_reply.split(song_match.group(0))
+        intro_text = parts[0].strip() if len(parts) > 0 else ""
+        outro_text = parts[1].strip() if len(parts) > 1 else ""
+
+        # Songs are loaded at startup, no disk check per request (waits here if that's still going)
+        await voice_manager.songs.get_async()
+        if not voice_manager.jukebox.get(song_name):
+            logger.warning(f"Song not found: {song_name}")
+            metrics.fallback("song_not_found")
+            # Fallback to standard TTS of the full text
+            return await voice_manager.generate_voice_async(ai_reply)
+
+        # Generate both parts at the same time
+        intro_bytes, outro_bytes = await asyncio.gather(
+            voice_manager.generate_voice_async(intro_text) if intro_text else _nothing(),
+            voice_manager.generate_voice_async(outro_text) if outro_text else _nothing(),
+        )
+
+        # Mix (frame splice, ffmpeg only if the formats don't line up)
+        return await executors.run("mix", voice_manager.mix_song, intro_bytes, song_name, outro_bytes)
+
+    except Exception as e:
+        logger.error(f"Jukebox crashed: {e}")
+        metrics.fallback("jukebox_crashed")
+        # Fallback
+        try:
+            return await voice_manager.generate_voice_async(ai_reply)
+        except:
+            return None
+
+async def _nothing():
+    return None
+
+def _encode_audio(audio_bytes: Optional[bytes]) -> Optional[str]:
+    if not audio_bytes:
+        return None
+    return base64.b64encode(audio_bytes).decode('utf-8')
+
+# --- Audio Delivery ---
+# How the MP3 gets to the client, picked per request:
+#   base64     audio_base64 inside the JSON (default, what old clients expect)
+#   ref        audio_id + audio_url in the JSON, fetch it from GET /v1/audio/{id}
+#   multipart  multipart/mixed: a JSON part, then an audio/mpeg part
+#   mpeg       the body is the MP3, the reply text is in the X-Babaru-Response header (URL-encoded)
+# Either ?audio=<mode>, or the Accept header (multipart/mixed or audio/mpeg).
+AUDIO_MODES = ("base64", "ref", "multipart", "mpeg")
+_ACCEPT_MODES = {"application/json": "base64", "multipart/mixed": "multipart", "audio/mpeg": "mpeg"}
+
+def _audio_mode(http_request: Request, audio: Optional[str]) -> str:
+    if audio:
+        if audio not in AUDIO_MODES:
+            raise HTTPException(status_code=400, detail=f"audio must be one of {', '.join(AUDIO_MODES)}")
+        return audio
+    # Highest q wins, ties go to whatever the client listed first
+    best, best_q = "base64", 0.0
+    for item in http_request.headers.get("accept", "").split(","):
+        media, _, params = item.strip().partition(";")
+        mode = _ACCEPT_MODES.get(media.strip().lower())
+        if not mode:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if q > best_q:
+            best, best_q = mode, q
+    return best
+
+def _multipart(payload: Dict, audio_bytes: Optional[bytes]) -> Response:
+    boundary = secrets.token_hex(16)
+
+    def parts():
+        yield (f"--{boundary}\r\nContent-Type: application/json\r\n\r\n{json.dumps(payload)}\r\n").encode()
+        if audio_bytes:
+            yield (f"--{boundary}\r\nContent-Type: audio/mpeg\r\nContent-Length: {len(audio_bytes)}\r\n\r\n").encode()
+            # Sent as-is, no copy into one big body
+            yield audio_bytes
+            yield b"\r\n"
+        yield f"--{boundary}--\r\n".encode()
+
+    return StreamingResponse(parts(), media_type=f"multipart/mixed; boundary={boundary}")
+
+async def _deliver(mode: str, payload: Dict, audio_bytes: Optional[bytes]):
+    """Wrap the JSON payload + audio the way the client asked for."""
+    if mode == "mpeg":
+        headers = {"X-Babaru-Response": quote(payload["response"])} if "response" in payload else {}
+        if not audio_bytes:
+            return Response(status_code=204, headers=headers)
+        return Response(content=audio_bytes, media_type="audio/mpeg", headers=headers)
+    if mode == "multipart":
+        return _multipart(payload, audio_bytes)
+    if mode == "ref":
+        if audio_bytes:
+            audio_id = await executors.run("tts", audio_store.put, audio_bytes)
+            payload.update(audio_id=audio_id, audio_url=f"/v1/audio/{audio_id}")
+        return payload
+    payload["audio_base64"] = _encode_audio(audio_bytes)
+    return payload
+
 @app.post("/v1/chat", response_model=ChatResponse)
-async def chat_endpoint(request: ChatRequest):
+async def chat_endpoint(request: ChatRequest, http_request: Request, audio: Optional[str] = None):
     """
     Send a message to Babaru
     """
+    mode = _audio_mode(http_request, audio)
     try:
-        # Pass to Brain
-        ai_reply = babaru_brain.get_response(
+        # Pass to Brain (after this user's previous turn, so it sees that turn's history)
+        ai_reply = await actors.run(request.user_id, lambda: babaru_brain.get_response_async(
             user_id=request.user_id,
             user_input=request.message,
             context_trigger=request.context
-        )
-        
-        # JukeBox Logic: Check for [PLAY_SONG: xyz]
-        song_match = re.search(r"\[PLAY_SONG: (.*?)\]", ai_reply)
-        audio_b64 = None
-        
-        if song_match:
-            try:
-                song_name = song_match.group(1).strip().lower()
-                clean_reply = ai_reply.replace(song_match.group(0), "").strip() # Remove tag for text display (optional, or keep it?)
-                # Actually, user wants "You want me to sing? okay, [sing] then..."
-                # Use split to get intro and outro
-                parts = ai_reply.split(song_match.group(0))
-                intro_text = parts[0].strip() if len(parts) > 0 else ""
-                outro_text = parts[1].strip() if len(parts) > 1 else ""
-                
-                # Paths
-                song_path = f"assets/songs/{song_name}.mp3"
-                if not os.path.exists(song_path):
-                    print(f"Song not found: {song_path}")
-                    # Fallback to standard TTS of the full text
-                    audio_bytes = voice_manager.generate_voice(ai_reply)
-                else:
-                    # Generate parts
-                    intro_bytes = voice_manager.generate_voice(intro_text) if intro_text else None
-                    outro_bytes = voice_manager.generate_voice(outro_text) if outro_text else None
-                    
-                    # Mix
-                    audio_bytes = voice_manager.mix_audio_sandwich(intro_bytes, song_path, outro_bytes)
-
-                if audio_bytes:
-                    audio_b64 = base64.b64encode(audio_bytes).decode('utf-8')
-                    
-            except Exception as e:
-                print(f"Jukebox crashed: {e}")
-                # Fallback
-                try:
-                    audio_bytes = voice_manager.generate_voice(ai_reply)
-                    if audio_bytes:
-                        audio_b64 = base64.b64encode(audio_bytes).decode('utf-8')
-                except:
-                    pass
-        else:
-            # Standard Voice
-            try:
-                audio_bytes = voice_manager.generate_voice(ai_reply)
-                if audio_bytes:
-                    audio_b64 = base64.b64encode(audio_bytes).decode('utf-8')
-            except Exception as v_err:
-                print(f"Voice broke: {v_err}") # It's fine, just print it
-        
-        return ChatResponse(response=ai_reply, audio_base64=audio_b64)
+        ))
+
+        # Audio doesn't touch memory, no need to hold the user's turn for it
+        audio_bytes = await _render_reply_audio(ai_reply)
+        with metrics.stage("encode"):
+            return await _deliver(mode, {"response": ai_reply}, audio_bytes)
+    except UserBusy as e:
+        raise HTTPException(status_code=429, detail=f"Slow down, Babaru is still answering you. ({e})")
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+# --- Streaming Chat (Server-Sent Events) ---
+# Events:
+#   delta       {"text": "..."}                              as soon as Gemini produces it
+#   audio       {"index": n, "kind": "speech"|"song", "audio_base64": "..."}
+#               one per sentence (or song), in order, while the text is still streaming
+#               (with ?audio=ref it carries audio_id/audio_url instead of audio_base64)
+#   text_done   {"response": "..."}                          full reply, history is saved at this point
+#   audio_done  {"segments": n}
+#   done        {}
+def _sse(event: str, data: Dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.post("/v1/chat/stream")
+async def chat_stream_endpoint(request: ChatRequest, audio: Optional[str] = None):
+    """
+    Send a message to Babaru and get the reply streamed back as SSE
+    Audio for each sentence is synthesized while the rest of the reply is still being generated
+    """
+    if audio not in (None, "base64", "ref"):
+        raise HTTPException(status_code=400, detail="audio must be base64 or ref for the stream")
+    out: asyncio.Queue = asyncio.Queue()
+    segments: asyncio.Queue = asyncio.Queue()
+    finished = object()
+
+    async def segment_stream():
+        while True:
+            seg = await segments.get()
+            if seg is None:
+                return
+            yield seg
+
+    async def run_text():
+        chunker = voice_manager.SentenceChunker()
+        chunks = []
+        try:
+            # The turn is held until the stream is done and the history is saved
+            async with actors.turn(request.user_id):
+                async for delta in babaru_brain.stream_response(
+                    user_id=request.user_id,
+                    user_input=request.message,
+                    context_trigger=request.context
+                ):
+                    chunks.append(delta)
+                    await out.put(_sse("delta", {"text": delta}))
+                    for seg in chunker.feed(delta):
+                        segments.put_nowait(seg)
+            for seg in chunker.flush():
+                segments.put_nowait(seg)
+            await out.put(_sse("text_done", {"response": "".join(chunks)}))
+        finally:
+            segments.put_nowait(None)
+
+    async def run_audio():
+        index = 0
+        async for kind, _, audio_bytes in voice_manager.synthesize_segments(segment_stream()):
+            if audio_bytes:
+                event = await _deliver(audio or "base64", {"index": index, "kind": kind}, audio_bytes)
+                await out.put(_sse("audio", event))
+                index += 1
+        await out.put(_sse("audio_done", {"segments": index}))
+
+    async def guarded(coro):
+        try:
+            await coro
+        except Exception as e:
+            # Headers are already out, so errors have to travel as an event
+            await out.put(_sse("error", {"detail": str(e)}))
+        finally:
+            await out.put(finished)
+
+    async def events():
+        tasks = [asyncio.ensure_future(guarded(run_text())), asyncio.ensure_future(guarded(run_audio()))]
+        try:
+            remaining = len(tasks)
+            while remaining:
+                item = await out.get()
+                if item is finished:
+                    remaining -= 1
+                    continue
+                yield item
+            yield _sse("done", {})
+        finally:
+            # Client went away, stop generating
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        # Stop proxies (Railway, nginx) from buffering the stream
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+# --- Batch Chat (fan-out nudges) ---
+# One NDJSON line per item as soon as it's done (not in request order, use "index"):
+#   {"index": n, "user_id": "...", "response": "...", "audio_base64": "...", "ms": 123.4}
+#   {"index": n, "user_id": "...", "error": "..."}
+# and a last line {"done": true, "items": n, "ok": n, "failed": n, "seconds": s, ...}
+class BatchItem(BaseModel):
+    user_id: str
+    message: str
+    context: Optional[str] = "CONTEXT_GENERAL"
+    # Reply text only, no ElevenLabs call for this one
+    text_only: bool = False
+
+class BatchRequest(BaseModel):
+    items: List[BatchItem]
+    # Capped by BABARU_BATCH_CONCURRENCY / the server's rate limits when those are set
+    concurrency: Optional[int] = None
+    llm_rps: Optional[float] = None
+    tts_rps: Optional[float] = None
+
+def _batch_rate(asked: Optional[float], ceiling: float) -> float:
+    if asked is None or asked <= 0:
+        return ceiling
+    return min(asked, ceiling) if ceiling > 0 else asked
+
+@app.post("/v1/chat/batch")
+async def chat_batch_endpoint(request: BatchRequest, http_request: Request, audio: Optional[str] = None):
+    """
+    Run a chat turn for many users (e.g. CONTEXT_MORNING to everyone) and stream the results back as NDJSON
+    """
+    if audio not in (None, "base64", "ref"):
+        raise HTTPException(status_code=400, detail="audio must be base64 or ref for a batch")
+    if not request.items:
+        raise HTTPException(status_code=400, detail="items is empty")
+    if len(request.items) > batch.BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"At most {batch.BATCH_MAX_ITEMS} items per batch")
+
+    async def render(reply: str) -> Dict:
+        audio_bytes = await _render_reply_audio(reply)
+        return await _deliver(audio or "base64", {}, audio_bytes)
+
+    results = batch.run(
+        [{"user_id": i.user_id, "message": i.message, "context": i.context, "text_only": i.text_only} for i in request.items],
+        render,
+        concurrency=min(request.concurrency or batch.BATCH_CONCURRENCY, batch.BATCH_CONCURRENCY),
+        llm_rps=_batch_rate(request.llm_rps, batch.BATCH_LLM_RPS),
+        tts_rps=_batch_rate(request.tts_rps, batch.BATCH_TTS_RPS),
+        item_deadline=getattr(http_request.state, "item_deadline", REQUEST_DEADLINE_SECONDS),
+    )
+
+    async def lines():
+        async for result in results:
+            yield json.dumps(result) + "\n"
+
+    return StreamingResponse(
+        lines(),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+# --- Nudges ---
+@app.get("/v1/nudges/{user_id}")
+async def nudges_endpoint(user_id: str, peek: bool = False):
+    """
+    Pick up what Babaru said on his own (morning check-in, "are you ignoring me?")
+    Each nudge is handed out once, unless ?peek=true. Text only, /v1/speak has the voice.
+    """
+    items = await executors.run("db", nudges.pickup, user_id, peek)
+    return {"user_id": user_id, "nudges": items}
+
 # --- Direct TTS Endpoint ---
 class SpeakRequest(BaseModel):
     text: str
 
 class SpeakResponse(BaseModel):
     audio_base64: Optional[str] = None
+    audio_id: Optional[str] = None
+    audio_url: Optional[str] = None
 
 @app.post("/v1/speak", response_model=SpeakResponse)
-async def speak_endpoint(request: SpeakRequest):
+async def speak_endpoint(request: SpeakRequest, http_request: Request, audio: Optional[str] = None):
     """
     Direct Text-to-Speech (No LLM)
     """
+    mode = _audio_mode(http_request, audio)
     try:
         # Just generate voice directly
-        audio_bytes = voice_manager.generate_voice(request.text)
-        audio_b64 = None
-        if audio_bytes:
-            audio_b64 = base64.b64encode(audio_bytes).decode('utf-8')
-            
-        return SpeakResponse(audio_base64=audio_b64)
+        audio_bytes = await voice_manager.generate_voice_async(request.text)
+        with metrics.stage("encode"):
+            return await _deliver(mode, {}, audio_bytes)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+# --- Audio by id ---
+_RANGE = re.compile(r"bytes=(\d*)-(\d*)")
+
+def _read_range(path: str, start: int, length: int) -> bytes:
+    with open(path, "rb") as f:
+        f.seek(start)
+        return f.read(length)
+
+@app.get("/v1/audio/{audio_id}")
+async def audio_endpoint(audio_id: str, http_request: Request):
+    """
+    Audio handed out as audio_id/audio_url. Supports Range so players can seek
+    and flaky mobile connections can resume.
+    """
+    found = audio_store.open(audio_id)
+    if not found:
+        raise HTTPException(status_code=404, detail="Audio not found or expired")
+    path, size = found
+    headers = {"Accept-Ranges": "bytes", "Cache-Control": "private, max-age=60"}
+
+    range_header = http_request.headers.get("range")
+    m = _RANGE.fullmatch(range_header.strip()) if range_header else None
+    if not m or not (m.group(1) or m.group(2)):
+        # No (or a multi-part) range, just send the whole thing
+        content = await executors.run("tts", _read_range, path, 0, size)
+        return Response(content=content, media_type="audio/mpeg", headers=headers)
+
+    if m.group(1):
+        start = int(m.group(1))
+        end = min(int(m.group(2)), size - 1) if m.group(2) else size - 1
+    else:
+        # bytes=-N is the last N bytes
+        start = max(size - int(m.group(2)), 0)
+        end = size - 1
+    if start >= size or start > end:
+        return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+
+    content = await executors.run("tts", _read_range, path, start, end - start + 1)
+    headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    return Response(content=content, status_code=206, media_type="audio/mpeg", headers=headers)
+
 # --- Serve Static Frontend ---
 from fastapi.responses import FileResponse
 
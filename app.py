@@ -4,9 +4,11 @@
 import streamlit as st
 import json
 import logging
-from utils import memory_manager
+from utils import memory_manager, warmup
 from backend import babaru_brain
 
+warmup.configure()
+
 # Page Config
 st.set_page_config(
     page_title="Babaru Cloud",
@@ -4,29 +4,152 @@
 
 import os
 import logging
-from dotenv import load_dotenv
-from google import genai
-from google.genai import types
+from typing import Any, Dict, List, Optional
 
 # Import local modules
-from utils import memory_manager
-from backend import prompt_builder
+from utils import memory_manager, executors, upstream, metrics, warmup
+from backend import prompt_builder, summarizer, prompt_cache, post_turn
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("BabaruBrain")
 
-# Load environment variables
-load_dotenv()
+MODEL_ID = "gemini-3-pro-preview"
 
-# Initialize Gemini Client
-API_KEY = os.getenv("GOOGLE_API_KEY")
-if not API_KEY:
-    logger.warning("GOOGLE_API_KEY not found! Check your .env file.")
+def _api_key():
+    return os.getenv("GOOGLE_API_KEY")
 
-client = genai.Client(api_key=API_KEY)
+def _build_client():
+    # google-genai takes a while to import, so it only happens here (first use or startup warm-up)
+    from google import genai
+    from google.genai import types
 
-MODEL_ID = "gemini-3-pro-preview"
+    if not _api_key():
+        logger.warning("GOOGLE_API_KEY not found! Check your .env file.")
+    # GEMINI_BASE_URL points it somewhere else, e.g. the fakes in benchmarks/fake_services.py
+    base_url = os.getenv("GEMINI_BASE_URL")
+    return genai.Client(api_key=_api_key(), http_options=types.HttpOptions(base_url=base_url) if base_url else None)
+
+# Gemini Client, built on first use
+gemini_client = warmup.lazy("gemini", _build_client, stage="llm")
+
+def get_client():
+    return gemini_client.get()
+
+# Static prompt prefix registered as Gemini cached content (None when BABARU_PROMPT_CACHE=off)
+prefix_cache_lazy = warmup.lazy("prompt_cache", lambda: prompt_cache.from_env(get_client(), MODEL_ID), stage="llm")
+
+def get_prefix_cache():
+    return prefix_cache_lazy.get()
+
+# Raw messages always sent with each turn (the summarizer leaves these out)
+RECENT_MESSAGES = 10
+
+# Everything the rolling summary doesn't cover yet goes word for word too, up to this many:
+# compaction waits for SUMMARY_TRIGGER messages past the recent ones, so that's the most it should ever be
+MAX_RAW_MESSAGES = RECENT_MESSAGES + summarizer.SUMMARY_TRIGGER
+
+# Limits, retries, deadline and circuit breaker for every Gemini call
+gemini = upstream.get("gemini")
+
+def _load_memory(user_id: str):
+    # Earlier turns may still be in the post-turn queue, apply them so this one sees its own history
+    try:
+        post_turn.drain_user(user_id)
+    except Exception as e:
+        logger.warning(f"Couldn't apply queued turns for {user_id}: {e}")
+    # Check if user exists, if not make a new one
+    user_memory = memory_manager.get_user_memory(user_id)
+    if not user_memory:
+        # Fallback/Auto-create for testing if missing
+        logger.info(f"User {user_id} memory not found. Creating default.")
+        memory_manager.create_user(user_id, "Traveler")
+        # We know exactly what a new user looks like, no need to read it back
+        user_memory = memory_manager.new_user_memory(user_id, "Traveler")
+    return user_memory
+
+def load_memories(user_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+    """_load_memory for a whole batch (fan-out nudges): one drain, one read per shard chunk,
+    and the unknown users created in bulk."""
+    try:
+        post_turn.drain_users(user_ids)
+    except Exception as e:
+        logger.warning(f"Couldn't apply queued turns before a batch load: {e}")
+    memories = memory_manager.get_user_memories(user_ids)
+    missing = [user_id for user_id in dict.fromkeys(user_ids) if not memories.get(user_id)]
+    if missing:
+        logger.info(f"{len(missing)} users in the batch not found. Creating defaults.")
+        memory_manager.create_users({"user_id": user_id, "name": "Traveler"} for user_id in missing)
+        for user_id in missing:
+            memories[user_id] = memory_manager.new_user_memory(user_id, "Traveler")
+    return memories
+
+def _build_contents(user_memory, user_input: str, turn_context: str = None):
+    # Construct chat history
+    # Fetch full history from memory
+    raw_history = user_memory.get('conversations', [])
+
+    # Every message the summary hasn't folded in yet (at least the last 10), older stuff comes in through the summary
+    count = min(max(user_memory.get('unsummarized', 0), RECENT_MESSAGES), MAX_RAW_MESSAGES)
+    recent_history = raw_history[-count:] if raw_history else []
+
+    # Format for Gemini API (convert 'content' to 'parts')
+    # The SDK expects contents=[{'role': 'user', 'parts': ['text']}, ...]
+    from google.genai import types
+    formatted_contents = []
+    for msg in recent_history:
+        role = "user" if msg['role'] == "user" else "model"
+        formatted_contents.append(types.Content(
+            role=role,
+            parts=[types.Part(text=msg['content'])]
+        ))
+
+    # Add current user input
+    # With a cached prefix, this turn's rank/context/datasheet rides along in front of it
+    parts = [types.Part(text=user_input)]
+    if turn_context:
+        parts.insert(0, types.Part(text=f"[TURN CONTEXT - instructions for Babaru, not said by the user]\n{turn_context}"))
+    formatted_contents.append(types.Content(role="user", parts=parts))
+    return formatted_contents
+
+def _build_request(context_trigger: str, user_memory, user_input: str, cache_name: str = None):
+    # Returns (config, contents) for generate_content
+    from google.genai import types
+    if cache_name:
+        # Character + rules already live on Gemini's side, only send the small per-turn part
+        config = types.GenerateContentConfig(cached_content=cache_name, temperature=0.7)
+        suffix = prompt_builder.build_dynamic_suffix(context_trigger, user_memory)
+        return config, _build_contents(user_memory, user_input, turn_context=suffix)
+
+    config = types.GenerateContentConfig(
+        system_instruction=prompt_builder.build_system_prompt(context_trigger, user_memory),
+        temperature=0.7,
+    )
+    return config, _build_contents(user_memory, user_input)
+
+def _with_timeout(config, seconds: float):
+    # Blocking calls can't be cancelled from our side, so the SDK has to give up on its own
+    from google.genai import types
+    return config.model_copy(update={"http_options": types.HttpOptions(timeout=int(seconds * 1000))})
+
+async def _cache_name_async():
+    prefix_cache = await prefix_cache_lazy.get_async()
+    if not prefix_cache:
+        return None
+    name = prefix_cache.peek()
+    if name is None and prefix_cache.needs_refresh():
+        # Creating the cache is a blocking SDK call, keep it off the event loop
+        name = await executors.run("llm", prefix_cache.get_name)
+    return name
+
+def _record_turn(user_id: str, user_input: str, ai_reply: str):
+    # 4. Queue the bookkeeping (history, missions, points, streak, relationship)
+    # The worker applies it after the reply is out, see backend/post_turn.py
+    post_turn.submit(user_id, user_input, ai_reply)
+
+def _after_turn(user_id: str):
+    # 5. Fold older history into the long-term summary once the turn is on disk (runs in the background)
+    summarizer.maybe_schedule(user_id, get_client(), keep_recent=RECENT_MESSAGES)
+
+post_turn.on_applied(_after_turn)
 
 def get_response(user_id: str, user_input: str, context_trigger: str = "CONTEXT_GENERAL") -> str:
     # This is where the magic happens
@@ -34,77 +157,142 @@ def get_response(user_id: str, user_input: str, context_trigger: str = "CONTEXT_
     # 2. Make the prompt
     # 3. Call Google
     # 4. Save what happened
-    
+    # (Blocking version for the CLI and Streamlit, the API uses get_response_async)
+
     # 1. Fetch Memory
-    # Check if user exists, if not make a new one
-    user_memory = memory_manager.get_user_memory(user_id)
-    if not user_memory:
-        # Fallback/Auto-create for testing if missing
-        logger.info(f"User {user_id} memory not found. Creating default.")
-        memory_manager.create_user(user_id, "Traveler")
-        user_memory = memory_manager.get_user_memory(user_id)
+    with metrics.stage("memory"):
+        user_memory = _load_memory(user_id)
 
-    # 2. Build Prompt
-    system_instruction = prompt_builder.build_system_prompt(context_trigger, user_memory)
-    
     # 3. Call Gemini
-    if not API_KEY:
+    if not _api_key():
         return "[SYSTEM ERROR] Google API Key is missing. Please set it in .env."
 
     try:
-        # Construct chat history
-        # Fetch full history from memory
-        raw_history = user_memory.get('conversations', [])
-        
-        # Take last 10 messages (5 turns)
-        recent_history = raw_history[-10:] if raw_history else []
-        
-        # Format for Gemini API (convert 'content' to 'parts')
-        # The SDK expects contents=[{'role': 'user', 'parts': ['text']}, ...]
-        formatted_contents = []
-        for msg in recent_history:
-            role = "user" if msg['role'] == "user" else "model"
-            formatted_contents.append(types.Content(
-                role=role,
-                parts=[types.Part(text=msg['content'])]
-            ))
-            
-        # Add current user input
-        formatted_contents.append(types.Content(
-            role="user",
-            parts=[types.Part(text=user_input)]
-        ))
-        
-        response = client.models.generate_content(
-            model=MODEL_ID,
-            config=types.GenerateContentConfig(
-                system_instruction=system_instruction,
-                temperature=0.7, 
-            ),
-            contents=formatted_contents
-        )
-        
+        # 2. Build Prompt
+        client = get_client()
+        prefix_cache = get_prefix_cache()
+        cache_name = prefix_cache.get_name() if prefix_cache else None
+        with metrics.stage("prompt"):
+            config, contents = _build_request(context_trigger, user_memory, user_input, cache_name)
+        try:
+            with metrics.stage("gemini"):
+                response = gemini.call(lambda timeout: client.models.generate_content(
+                    model=MODEL_ID, config=_with_timeout(config, timeout), contents=contents))
+        except Exception as e:
+            # Gemini being down/slow isn't the cache's fault
+            if not cache_name or isinstance(e, upstream.UpstreamUnavailable):
+                raise
+            # Cache got evicted/expired on Gemini's side, drop it and send the full prompt
+            logger.warning(f"Cached prefix failed ({e}), retrying with the full prompt.")
+            metrics.fallback("full_prompt")
+            prefix_cache.invalidate()
+            config, contents = _build_request(context_trigger, user_memory, user_input)
+            with metrics.stage("gemini"):
+                response = gemini.call(lambda timeout: client.models.generate_content(
+                    model=MODEL_ID, config=_with_timeout(config, timeout), contents=contents))
+
+        ai_reply = response.text
+        with metrics.stage("enqueue"):
+            _record_turn(user_id, user_input, ai_reply)
+        return ai_reply
+
+    except Exception as e:
+        logger.error(f"Gemini API Error: {e}")
+        metrics.fallback("brain_fried")
+        return f"[SYSTEM ERROR] Babaru's brain fried: {e}"
+
+async def get_response_async(user_id: str, user_input: str, context_trigger: str = "CONTEXT_GENERAL",
+                             user_memory: Optional[Dict[str, Any]] = None, record: bool = True) -> str:
+    """Same as get_response, but never blocks the event loop.
+    Gemini goes through the SDK's async client, sqlite runs on the 'db' executor.
+    Pass user_memory if it was already loaded inside this user's turn (see load_memories).
+    record=False leaves history, points and streak alone (Babaru talking first isn't a user turn)."""
+    if user_memory is None:
+        with metrics.stage("memory"):
+            user_memory = await executors.run("db", _load_memory, user_id)
+
+    if not _api_key():
+        return "[SYSTEM ERROR] Google API Key is missing. Please set it in .env."
+
+    try:
+        client = await gemini_client.get_async()
+        cache_name = await _cache_name_async()
+        with metrics.stage("prompt"):
+            config, contents = _build_request(context_trigger, user_memory, user_input, cache_name)
+        try:
+            with metrics.stage("gemini"):
+                response = await gemini.call_async(lambda: client.aio.models.generate_content(model=MODEL_ID, config=config, contents=contents))
+        except Exception as e:
+            if not cache_name or isinstance(e, upstream.UpstreamUnavailable):
+                raise
+            logger.warning(f"Cached prefix failed ({e}), retrying with the full prompt.")
+            metrics.fallback("full_prompt")
+            prefix_cache_lazy.value.invalidate()
+            config, contents = _build_request(context_trigger, user_memory, user_input)
+            with metrics.stage("gemini"):
+                response = await gemini.call_async(lambda: client.aio.models.generate_content(model=MODEL_ID, config=config, contents=contents))
+
         ai_reply = response.text
-        
-        # 4. Save History (Async in production, sync here)
-        memory_manager.update_conversation_history(user_id, {"role": "user", "content": user_input})
-        memory_manager.update_conversation_history(user_id, {"role": "model", "content": ai_reply})
-        
-        # 5. Post-Processing (Mission Updates)
-        # Rudimentary keyword check for now. 
-        # Future: Use structured output or function calling to update DB.
-        if "MISSION COMPLETE" in ai_reply.upper():
-            # Trigger mission completion logic
-            logger.info("Mission completion detected by AI trigger.")
-            # memory_manager.update_missions(...) 
-        
+        if record:
+            with metrics.stage("enqueue"):
+                await executors.run("db", _record_turn, user_id, user_input, ai_reply)
         return ai_reply
 
     except Exception as e:
         logger.error(f"Gemini API Error: {e}")
+        metrics.fallback("brain_fried")
         return f"[SYSTEM ERROR] Babaru's brain fried: {e}"
 
+async def _stream_text(client, config, contents):
+    # Holds a Gemini slot until the last chunk, retries stop once text is flowing
+    async for chunk in gemini.stream_async(lambda: client.aio.models.generate_content_stream(model=MODEL_ID, config=config, contents=contents)):
+        if chunk.text:
+            yield chunk.text
+
+async def stream_response(user_id: str, user_input: str, context_trigger: str = "CONTEXT_GENERAL"):
+    """
+    Streaming version of get_response_async: yields text deltas as Gemini produces them.
+    History is saved once the stream finishes (nothing is saved if it breaks halfway).
+    """
+    with metrics.stage("memory"):
+        user_memory = await executors.run("db", _load_memory, user_id)
+
+    if not _api_key():
+        yield "[SYSTEM ERROR] Google API Key is missing. Please set it in .env."
+        return
+
+    chunks = []
+    try:
+        client = await gemini_client.get_async()
+        cache_name = await _cache_name_async()
+        with metrics.stage("prompt"):
+            config, contents = _build_request(context_trigger, user_memory, user_input, cache_name)
+        try:
+            async for text in _stream_text(client, config, contents):
+                chunks.append(text)
+                yield text
+        except Exception as e:
+            # Only safe to retry if nothing went out to the client yet
+            if not cache_name or chunks or isinstance(e, upstream.UpstreamUnavailable):
+                raise
+            logger.warning(f"Cached prefix failed ({e}), retrying with the full prompt.")
+            metrics.fallback("full_prompt")
+            prefix_cache_lazy.value.invalidate()
+            config, contents = _build_request(context_trigger, user_memory, user_input)
+            async for text in _stream_text(client, config, contents):
+                chunks.append(text)
+                yield text
+
+    except Exception as e:
+        logger.error(f"Gemini API Error: {e}")
+        metrics.fallback("brain_fried")
+        yield f"[SYSTEM ERROR] Babaru's brain fried: {e}"
+        return
+
+    await executors.run("db", _record_turn, user_id, user_input, "".join(chunks))
+
 if __name__ == "__main__":
+    warmup.configure()
     print("--- Babaru Terminal Interface (Ctrl+C to exit) ---")
     user_id = "terminal_user"
     
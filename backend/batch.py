@@ -0,0 +1,180 @@
+# Author: Steven Lansangan
+# Fan-out turns for campaigns (CONTEXT_MORNING / CONTEXT_USER_SILENT to everyone)
+# Used to be thousands of separate /v1/chat calls, each loading one user's
+# memory and rendering its audio on its own. Here a batch runs through a
+# fixed number of workers, memories are loaded in bulk (whoever is in their
+# turn at the same moment shares one query), Gemini and ElevenLabs calls are
+# paced by per-batch rate limits, and results come out as soon as each finishes.
+import os
+import time
+import asyncio
+import logging
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+from utils import executors, upstream, metrics
+from backend import babaru_brain
+from backend.user_actors import actors
+
+logger = logging.getLogger("Batch")
+
+# Ceilings for what a batch request may ask for
+BATCH_MAX_ITEMS = int(os.getenv("BABARU_BATCH_MAX_ITEMS", "5000"))
+BATCH_CONCURRENCY = int(os.getenv("BABARU_BATCH_CONCURRENCY", "16"))
+# Calls per second per batch, 0 = only the upstream limits apply
+BATCH_LLM_RPS = float(os.getenv("BABARU_BATCH_LLM_RPS", "0"))
+BATCH_TTS_RPS = float(os.getenv("BABARU_BATCH_TTS_RPS", "0"))
+
+
+class RateLimit:
+    """Token bucket: at most `rate` acquires per second, bursts up to `burst`. rate <= 0 never waits."""
+
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        if self.rate <= 0:
+            return
+        # One waiter at a time, so callers go through in the order they arrived
+        async with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                self._updated = time.monotonic()
+                self._tokens = 1
+            self._tokens -= 1
+
+
+class MemoryLoader:
+    """Coalesces memory loads: everyone asking in the same loop tick (or until max_batch) shares one load_memories()."""
+
+    def __init__(self, max_batch: int = 500):
+        self.max_batch = max_batch
+        self._pending: Dict[str, List[asyncio.Future]] = {}
+        self._scheduled = False
+        self.loads = 0
+        self.users = 0
+
+    async def load(self, user_id: str) -> Dict[str, Any]:
+        future = asyncio.get_running_loop().create_future()
+        self._pending.setdefault(user_id, []).append(future)
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif not self._scheduled:
+            self._scheduled = True
+            asyncio.get_running_loop().call_soon(self._flush)
+        return await future
+
+    def _flush(self):
+        self._scheduled = False
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        asyncio.ensure_future(self._load(pending))
+
+    async def _load(self, pending: Dict[str, List[asyncio.Future]]):
+        self.loads += 1
+        self.users += len(pending)
+        try:
+            with metrics.stage("memory"):
+                memories = await executors.run("db", babaru_brain.load_memories, list(pending))
+        except Exception as e:
+            for futures in pending.values():
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+            return
+        for user_id, futures in pending.items():
+            for future in futures:
+                if not future.done():
+                    future.set_result(memories.get(user_id))
+
+
+async def run(items: List[Dict[str, Any]],
+              render: Callable[[str], Awaitable[Dict[str, Any]]],
+              concurrency: int = BATCH_CONCURRENCY,
+              llm_rps: float = BATCH_LLM_RPS,
+              tts_rps: float = BATCH_TTS_RPS,
+              item_deadline: Optional[float] = None) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Run chat turns for items ({user_id, message, context, text_only, record}) and yield
+    one result per item in the order they finish. render(reply) turns a reply
+    into the audio fields of the result (skipped for text_only items).
+    The last thing yielded is a summary with done=True.
+    """
+    llm_limit = RateLimit(llm_rps)
+    tts_limit = RateLimit(tts_rps)
+    loader = MemoryLoader()
+    todo: asyncio.Queue = asyncio.Queue()
+    results: asyncio.Queue = asyncio.Queue()
+    for index, item in enumerate(items):
+        todo.put_nowait((index, item))
+    finished = object()
+    started = time.monotonic()
+
+    async def one(index: int, item: Dict[str, Any]) -> Dict[str, Any]:
+        user_id = item['user_id']
+        t0 = time.monotonic()
+        # Each item gets the whole deadline, not a slice of the batch's
+        with upstream.deadline(item_deadline):
+            async def turn():
+                # Loaded inside the turn, so it already has this user's previous turns in it
+                user_memory = await loader.load(user_id)
+                await llm_limit.acquire()
+                return await babaru_brain.get_response_async(
+                    user_id=user_id,
+                    user_input=item['message'],
+                    context_trigger=item.get('context') or "CONTEXT_GENERAL",
+                    user_memory=user_memory,
+                    record=item.get('record', True),
+                )
+
+            reply = await actors.run(user_id, turn)
+            result = {"index": index, "user_id": user_id, "response": reply}
+            if not item.get('text_only'):
+                await tts_limit.acquire()
+                result.update(await render(reply))
+        result["ms"] = round((time.monotonic() - t0) * 1000, 1)
+        return result
+
+    async def worker():
+        try:
+            while True:
+                try:
+                    index, item = todo.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                try:
+                    result = await one(index, item)
+                except Exception as e:
+                    logger.warning(f"Batch item {index} ({item['user_id']}) failed: {e}")
+                    result = {"index": index, "user_id": item['user_id'], "error": str(e) or type(e).__name__}
+                await results.put(result)
+        finally:
+            await results.put(finished)
+
+    workers = [asyncio.ensure_future(worker()) for _ in range(max(1, min(concurrency, len(items))))]
+    ok = failed = 0
+    try:
+        remaining = len(workers)
+        while remaining:
+            result = await results.get()
+            if result is finished:
+                remaining -= 1
+                continue
+            if "error" in result:
+                failed += 1
+            else:
+                ok += 1
+            yield result
+        yield {"done": True, "items": len(items), "ok": ok, "failed": failed,
+               "seconds": round(time.monotonic() - started, 2), "memory_loads": loader.loads}
+    finally:
+        # Client went away, stop the rest
+        for task in workers:
+            task.cancel()
@@ -0,0 +1,353 @@
+# Author: Steven Lansangan
+# Babaru talking first: morning check-ins and "did you fall asleep?" pokes
+# prompt_builder has CONTEXT_MORNING and CONTEXT_USER_SILENT, but nothing
+# ever used them unless a client asked. This scheduler finds the users who
+# are due and generates their nudge, without ever scanning every user:
+# - silent: each sweep reads only the users whose last activity crossed the
+#   silence line since the previous sweep (range scan on conversations.last_updated
+#   from a saved watermark), so one silence gets one nudge
+# - morning: a heap of timezones keyed by when it's next MORNING_HOUR there,
+#   when one comes up only that timezone's recently active users are read
+# Nudges are generated through backend/batch.py (bounded concurrency, rate
+# limited) and stored in the nudges table until the client picks them up
+# (GET /v1/nudges/{user_id}). Only one process runs the scheduler (a lock
+# file), and every nudge is claimed in the db first, so none go out twice.
+import os
+import time
+import heapq
+import asyncio
+import logging
+from datetime import date, datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Set, Tuple
+from zoneinfo import ZoneInfo
+
+from utils import memory_manager, executors
+from backend import batch
+
+try:
+    import fcntl
+except ImportError:
+    # No flock (Windows): every process schedules, the claims still keep nudges unique
+    fcntl = None
+
+logger = logging.getLogger("Nudges")
+
+# Costs Gemini calls nobody asked for, so it's opt-in
+NUDGES_ENABLED = os.getenv("BABARU_NUDGES", "off").lower() == "on"
+SILENT_AFTER_HOURS = float(os.getenv("BABARU_NUDGE_SILENT_HOURS", "24"))
+# First sweep ever only looks this far back, users quiet for longer than that don't all get poked at once
+SILENT_LOOKBACK_HOURS = float(os.getenv("BABARU_NUDGE_SILENT_LOOKBACK_HOURS", "24"))
+SILENT_SWEEP_SECONDS = float(os.getenv("BABARU_NUDGE_SWEEP_S", "60"))
+MORNING_HOUR = int(os.getenv("BABARU_NUDGE_MORNING_HOUR", "8"))
+# Server was down at 8:00? Still send it if we're back within this many hours
+MORNING_GRACE_HOURS = float(os.getenv("BABARU_NUDGE_MORNING_GRACE_HOURS", "3"))
+# Morning nudges only go to users who talked to Babaru in the last N days
+MORNING_ACTIVE_DAYS = float(os.getenv("BABARU_NUDGE_ACTIVE_DAYS", "7"))
+# Kept low on purpose, live chats share the same Gemini limits
+NUDGE_CONCURRENCY = int(os.getenv("BABARU_NUDGE_CONCURRENCY", "4"))
+NUDGE_LLM_RPS = float(os.getenv("BABARU_NUDGE_LLM_RPS", "2"))
+# A silent nudge that keeps failing while others go through is given up after this many sweeps
+SILENT_RETRIES = int(os.getenv("BABARU_NUDGE_SILENT_RETRIES", "5"))
+# Nudges older than this aren't handed out anymore, and get deleted
+NUDGE_TTL_HOURS = float(os.getenv("BABARU_NUDGE_TTL_HOURS", "24"))
+LOCK_PATH = os.getenv("BABARU_NUDGE_LOCK", ".nudge_scheduler.lock")
+
+# Picks up new timezones (and retries leadership) this often
+REFRESH_SECONDS = 300
+# A morning where some nudges failed runs again this much later (the claims skip whoever got one),
+# until MORNING_GRACE_HOURS past the morning
+MORNING_RETRY_SECONDS = 120
+SWEEP_PAGE = 500
+
+# What the model gets as the "user message", there isn't a real one
+NUDGE_MESSAGE = "[No message. Babaru starts the conversation.]"
+KINDS = {"silent": "CONTEXT_USER_SILENT", "morning": "CONTEXT_MORNING"}
+
+
+def _sql_time(moment: datetime) -> str:
+    # Same format as sqlite's CURRENT_TIMESTAMP (UTC), so it compares as text against last_updated
+    return moment.astimezone(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _zone(name: str) -> Optional[ZoneInfo]:
+    try:
+        return ZoneInfo(name)
+    except Exception:
+        return None
+
+
+def next_morning(tz: ZoneInfo, now: datetime, done_for: Optional[str]) -> Tuple[datetime, date]:
+    """When this timezone's next morning nudge is due, and which local day it's for.
+    Due right away if today's morning passed less than MORNING_GRACE_HOURS ago and it wasn't done."""
+    local = now.astimezone(tz)
+    today = local.date()
+    target = datetime(today.year, today.month, today.day, MORNING_HOUR, tzinfo=tz)
+    if done_for != today.isoformat():
+        if local < target:
+            return target, today
+        if local <= target + timedelta(hours=MORNING_GRACE_HOURS):
+            return now, today
+    tomorrow = today + timedelta(days=1)
+    return datetime(tomorrow.year, tomorrow.month, tomorrow.day, MORNING_HOUR, tzinfo=tz), tomorrow
+
+
+class _Leader:
+    """Only the process holding the lock file schedules (serve.py runs several workers)."""
+
+    def __init__(self, path: str = LOCK_PATH):
+        self.path = path
+        self._file = None
+
+    def acquire(self) -> bool:
+        if self._file is not None:
+            return True
+        if fcntl is None:
+            return True
+        f = open(self.path, "a")
+        try:
+            # Released by the OS if this process dies, another worker takes over on its next try
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            return False
+        self._file = f
+        return True
+
+    def release(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    @property
+    def held(self) -> bool:
+        return self._file is not None or fcntl is None
+
+
+class NudgeScheduler:
+    def __init__(self):
+        # (due epoch, kind, timezone or "") - the next thing to do is always heap[0]
+        self._heap: List[Tuple[float, str, str]] = []
+        self._zones: Dict[str, date] = {}
+        # (user_id, nudge_key) -> failed tries, for silent nudges the watermark is still waiting on
+        self._retries: Dict[Tuple[str, str], int] = {}
+        self._leader = _Leader()
+        self._task: Optional[asyncio.Task] = None
+        self._stop = asyncio.Event()
+        self.sent = {kind: 0 for kind in KINDS}
+        self.failed = 0
+        self.skipped = 0
+        self.sweeps = 0
+
+    # --- Loop ---
+    def start(self):
+        if self._task is None:
+            self._stop = asyncio.Event()
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._stop.set()
+            self._task.cancel()
+            try:
+                await self._task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._task = None
+        self._leader.release()
+
+    async def _sleep(self, seconds: float):
+        try:
+            await asyncio.wait_for(self._stop.wait(), max(0.0, seconds))
+        except asyncio.TimeoutError:
+            pass
+
+    async def _run(self):
+        refresh_at = 0.0
+        while not self._stop.is_set():
+            try:
+                if not self._leader.acquire():
+                    await self._sleep(REFRESH_SECONDS)
+                    continue
+                now = time.time()
+                if now >= refresh_at:
+                    await self._refresh()
+                    refresh_at = now + REFRESH_SECONDS
+                while self._heap and self._heap[0][0] <= time.time():
+                    _, kind, zone = heapq.heappop(self._heap)
+                    await self._fire(kind, zone)
+                wake = min(self._heap[0][0] if self._heap else refresh_at, refresh_at)
+                await self._sleep(wake - time.time())
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Nudge scheduler hiccup: {e}")
+                await self._sleep(SILENT_SWEEP_SECONDS)
+
+    async def _refresh(self):
+        # New timezones get a slot in the heap, the silent sweep gets its first one
+        if not any(kind == "silent" for _, kind, _ in self._heap):
+            heapq.heappush(self._heap, (time.time(), "silent", ""))
+        zones = set()
+        for shard in range(memory_manager.SHARD_COUNT):
+            zones.update(await executors.run("db", memory_manager.timezones, shard))
+        now = datetime.now(timezone.utc)
+        for name in zones - set(self._zones):
+            tz = _zone(name)
+            if tz is None:
+                logger.warning(f"Skipping unknown timezone {name!r} for morning nudges")
+                self._zones[name] = None
+                continue
+            done_for = await executors.run("db", memory_manager.get_mark, f"morning:{name}")
+            due, day = next_morning(tz, now, done_for)
+            self._zones[name] = day
+            heapq.heappush(self._heap, (due.timestamp(), "morning", name))
+
+    async def _fire(self, kind: str, zone: str):
+        if kind == "silent":
+            await self.sweep_silent()
+            heapq.heappush(self._heap, (time.time() + SILENT_SWEEP_SECONDS, "silent", ""))
+        else:
+            day = self._zones[zone]
+            done = await self.morning(zone, day)
+            tz = _zone(zone)
+            now = datetime.now(timezone.utc)
+            if not done:
+                late = now - datetime(day.year, day.month, day.day, MORNING_HOUR, tzinfo=tz)
+                if late < timedelta(hours=MORNING_GRACE_HOURS):
+                    heapq.heappush(self._heap, (time.time() + MORNING_RETRY_SECONDS, "morning", zone))
+                    return
+                logger.warning(f"Giving up on the rest of {day} morning in {zone}, it's too late for good morning")
+            due, self._zones[zone] = next_morning(tz, now, day.isoformat())
+            heapq.heappush(self._heap, (due.timestamp(), "morning", zone))
+
+    # --- Finding who's due ---
+    async def sweep_silent(self):
+        """Nudge everyone whose silence started since the last sweep."""
+        self.sweeps += 1
+        now = datetime.now(timezone.utc)
+        until = _sql_time(now - timedelta(hours=SILENT_AFTER_HOURS))
+        for shard in range(memory_manager.SHARD_COUNT):
+            mark_name = f"silent:{shard}"
+            mark = await executors.run("db", memory_manager.get_mark, mark_name)
+            if mark:
+                after = tuple(mark.split("|", 1))
+            else:
+                after = (_sql_time(now - timedelta(hours=SILENT_AFTER_HOURS + SILENT_LOOKBACK_HOURS)), "")
+            # The mark only moves up to the first nudge that failed. The sweep still goes on past it,
+            # and the next one starts from the mark again (the claims skip the ones already sent)
+            sent = self.sent["silent"]
+            failures = []
+            position = after
+            while True:
+                rows = await executors.run("db", memory_manager.went_silent, shard, position, until, SWEEP_PAGE)
+                if not rows:
+                    break
+                # Keyed by the activity it's about, so a user gets one poke per silence
+                targets = [(user_id, last) for user_id, last in rows]
+                failed = await self._dispatch("silent", targets)
+                for user_id, last in targets:
+                    if (user_id, last) in failed:
+                        failures.append(((user_id, last), position))
+                    else:
+                        self._retries.pop((user_id, last), None)
+                    position = (last, user_id)
+                if len(rows) < SWEEP_PAGE:
+                    break
+            waiting = self._retry_or_give_up([target for target, _ in failures], self.sent["silent"] > sent)
+            stop = next((before for target, before in failures if target in waiting), position)
+            if stop != after or not mark:
+                await executors.run("db", memory_manager.set_mark, mark_name, f"{stop[0]}|{stop[1]}")
+        await executors.run("db", memory_manager.prune_nudges, time.time() - NUDGE_TTL_HOURS * 3600)
+
+    async def morning(self, zone: str, day: date) -> bool:
+        """Good-morning nudge for this timezone's recently active users.
+        Returns False if some failed, the mark is only set once everyone got theirs (a restart tries again)."""
+        active_since = _sql_time(datetime.now(timezone.utc) - timedelta(days=MORNING_ACTIVE_DAYS))
+        users = []
+        for shard in range(memory_manager.SHARD_COUNT):
+            users += await executors.run("db", memory_manager.users_in_timezone, shard, zone, active_since)
+        logger.info(f"Morning in {zone}: {len(users)} users to nudge")
+        failed = set()
+        for i in range(0, len(users), SWEEP_PAGE):
+            failed |= await self._dispatch("morning", [(user_id, day.isoformat()) for user_id in users[i:i + SWEEP_PAGE]])
+        if failed:
+            logger.warning(f"Morning in {zone}: {len(failed)} nudges failed, trying them again later")
+            return False
+        await executors.run("db", memory_manager.set_mark, f"morning:{zone}", day.isoformat())
+        return True
+
+    def _retry_or_give_up(self, failed: List[Tuple[str, str]], went_through: bool) -> Set[Tuple[str, str]]:
+        """Which failed silent nudges the mark should wait for. One that keeps failing while others
+        go through is dropped after SILENT_RETRIES, so it can't hold the mark forever.
+        When nothing goes through (Gemini down) nobody uses up a try."""
+        if not went_through:
+            return set(failed)
+        waiting = set()
+        for target in failed:
+            tries = self._retries.get(target, 0) + 1
+            if tries >= SILENT_RETRIES:
+                logger.warning(f"Giving up on the silent nudge for {target[0]} after {tries} tries")
+                self._retries.pop(target, None)
+            else:
+                self._retries[target] = tries
+                waiting.add(target)
+        return waiting
+
+    # --- Generating ---
+    async def _dispatch(self, kind: str, targets: List[Tuple[str, str]]) -> Set[Tuple[str, str]]:
+        """Generate and store nudges for the targets nobody claimed yet. Returns the ones that failed
+        (their claims are given back, so they can be tried again)."""
+        failed = set()
+        claimed = await executors.run("db", memory_manager.claim_nudges, kind, targets)
+        self.skipped += len(targets) - len(claimed)
+        if not claimed:
+            return failed
+        keys = dict(targets)
+        user_ids = list(claimed)
+        items = [{"user_id": user_id, "message": NUDGE_MESSAGE, "context": KINDS[kind],
+                  "text_only": True, "record": False} for user_id in user_ids]
+        async for result in batch.run(items, None, concurrency=NUDGE_CONCURRENCY, llm_rps=NUDGE_LLM_RPS):
+            if result.get("done"):
+                continue
+            user_id = result["user_id"]
+            reply = result.get("response")
+            # The brain answers errors with a [SYSTEM ERROR] line instead of raising
+            if not reply or reply.startswith("[SYSTEM ERROR]"):
+                self.failed += 1
+                failed.add((user_id, keys[user_id]))
+                reply = None
+            else:
+                self.sent[kind] += 1
+            await executors.run("db", memory_manager.finish_nudge, user_id, claimed[user_id], reply)
+        return failed
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": NUDGES_ENABLED,
+            "leader": self._leader.held and self._task is not None,
+            "timezones": len([z for z in self._zones.values() if z]),
+            "next_due_s": round(self._heap[0][0] - time.time(), 1) if self._heap else None,
+            "sent": dict(self.sent),
+            "failed": self.failed,
+            "retrying": len(self._retries),
+            "skipped": self.skipped,
+            "sweeps": self.sweeps,
+        }
+
+
+scheduler = NudgeScheduler()
+
+
+def start():
+    if NUDGES_ENABLED:
+        scheduler.start()
+        logger.info("Nudge scheduler started.")
+
+
+async def stop():
+    await scheduler.stop()
+
+
+def pickup(user_id: str, peek: bool = False) -> List[Dict[str, Any]]:
+    """Ready nudges for this user (marked picked up unless peek)."""
+    return memory_manager.take_nudges(user_id, time.time() - NUDGE_TTL_HOURS * 3600, peek)
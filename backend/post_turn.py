@@ -0,0 +1,267 @@
+# Author: Steven Lansangan
+# Post-turn bookkeeping, off the response path
+# After Babaru answers we still have to save the history and keep the streak
+# and last-active time going (plus points, missions and relationship when
+# scoring is switched on).
+# None of that should hold up the reply, so the turn is written to a durable
+# queue (turn_jobs table) and a background worker applies it. Each job is
+# applied and deleted in the same transaction, so it happens exactly once,
+# even across crashes and retries. A sweep applies every due job in a single
+# commit, so under load it's one fsync per sweep instead of one per turn.
+import os
+import time
+import random
+import threading
+import logging
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional
+from zoneinfo import ZoneInfo
+
+from utils import memory_manager
+
+logger = logging.getLogger("PostTurn")
+
+# Attempts before a job is parked (available_at NULL) for someone to look at
+MAX_ATTEMPTS = 5
+# Worker sleeps this long between sweeps when nobody wakes it
+POLL_SECONDS = float(os.getenv("BABARU_POST_TURN_POLL_MS", "500")) / 1000
+BATCH = 100
+
+# Game rules on top of the bookkeeping, off unless asked for (BABARU_SCORING=on):
+# points per turn and per mission, a "MISSION COMPLETE" in the reply completes the first
+# active mission (+1 trust), and coming back the next day is +1 familiarity
+SCORING_ENABLED = os.getenv("BABARU_SCORING", "off").lower() == "on"
+TURN_POINTS = int(os.getenv("BABARU_TURN_POINTS", "1"))
+MISSION_POINTS = int(os.getenv("BABARU_MISSION_POINTS", "10"))
+
+# Called with user_id after a turn is applied (e.g. the summarizer, which needs the messages on disk)
+_hooks: List[Callable[[str], None]] = []
+
+
+def on_applied(fn: Callable[[str], None]):
+    _hooks.append(fn)
+
+
+# --- Rules ---
+
+def _local_day(value, tz: ZoneInfo):
+    if isinstance(value, str):
+        # sqlite CURRENT_TIMESTAMP, always UTC
+        value = datetime.strptime(value[:19], "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc)
+    elif not isinstance(value, datetime):
+        value = datetime.fromtimestamp(value, timezone.utc)
+    return value.astimezone(tz).date()
+
+
+def turn_effects(state: Dict[str, Any], payload: Dict[str, Any], scoring: Optional[bool] = None) -> Dict[str, Any]:
+    """Everything one turn changes, worked out from the user's current state. No I/O.
+    History and streak always, the scoring rules only with scoring on (default: SCORING_ENABLED)."""
+    scoring = SCORING_ENABLED if scoring is None else scoring
+    effects: Dict[str, Any] = {
+        "messages": [
+            {"role": "user", "content": payload['user_input']},
+            {"role": "model", "content": payload['ai_reply']},
+        ],
+    }
+    points = state['points'] + TURN_POINTS
+    familiarity_delta = trust_delta = 0
+
+    # Mission detection (the model says it out loud, first active mission gets the credit)
+    if "MISSION COMPLETE" in payload['ai_reply'].upper():
+        logger.info("Mission completion detected by AI trigger.")
+        if scoring and state['active']:
+            done, *still_active = state['active']
+            effects['missions'] = {"active": still_active, "completed": state['completed'] + [done]}
+            points += MISSION_POINTS
+            trust_delta += 1
+
+    # Streak: consecutive days (in the user's timezone) with at least one turn
+    try:
+        tz = ZoneInfo(state['timezone'])
+    except Exception:
+        tz = ZoneInfo("UTC")
+    today = _local_day(payload['turn_at'], tz)
+    streak = state['streak_days']
+    if state['last_active'] is None:
+        streak = 1
+    else:
+        gap = (today - _local_day(state['last_active'], tz)).days
+        if gap == 1:
+            streak += 1
+            # Coming back day after day is how Babaru gets to know you
+            familiarity_delta += 1
+        elif gap > 1:
+            streak = 1
+        streak = max(streak, 1)
+
+    effects['progression'] = {"streak_days": streak}
+    if scoring:
+        effects['progression']['points'] = points
+        effects['relationship'] = (familiarity_delta, trust_delta)
+    return effects
+
+
+# --- Processing ---
+
+def _apply_in(conn, job: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Work out and write one job's effects inside the caller's transaction. None if the user is gone."""
+    user_id = job['user_id']
+    state = memory_manager.read_turn_state(conn, user_id)
+    if state is None:
+        logger.warning(f"Dropping turn job {job['id']}: user {user_id} doesn't exist.")
+        return None
+    effects = turn_effects(state, job['payload'])
+    memory_manager.apply_turn(conn, user_id, effects, job['payload'].get('turn_at'))
+    return effects
+
+
+def _committed(user_id: str, effects: Optional[Dict[str, Any]]) -> bool:
+    # The cache already got the turn inside complete_turn_jobs, hooks only run once it's committed
+    if effects is None:
+        return False
+    for hook in _hooks:
+        try:
+            hook(user_id)
+        except Exception as e:
+            logger.error(f"Post-turn hook failed for {user_id}: {e}")
+    return True
+
+
+def _failed(job: Dict[str, Any], e: BaseException):
+    attempt = job['attempts'] + 1
+    # Jittered exponential backoff: ~1s, 2s, 4s, 8s, then park it
+    retry_in = None if attempt >= MAX_ATTEMPTS else random.uniform(0.5, 1.5) * 2 ** (attempt - 1)
+    if retry_in is None:
+        logger.error(f"Turn job {job['id']} for {job['user_id']} failed {attempt} times, parking it: {e}")
+    else:
+        logger.warning(f"Turn job {job['id']} for {job['user_id']} failed ({e}), retrying in {retry_in:.1f}s")
+    try:
+        memory_manager.fail_turn_job(job, str(e), retry_in)
+    except Exception as e2:
+        # Still in the table untouched, the next sweep picks it up again
+        logger.error(f"Couldn't record failure of turn job {job['id']}: {e2}")
+
+
+def _apply_batch(shard: int, jobs: List[Dict[str, Any]], record_failures: bool = True) -> int:
+    """Apply jobs (in id order) in one commit (the cache is updated with it), then run hooks. Returns how many applied."""
+    applied = 0
+    for job, done, result in memory_manager.complete_turn_jobs(shard, jobs, _apply_in):
+        if done:
+            applied += _committed(job['user_id'], result)
+        elif isinstance(result, Exception):
+            if record_failures:
+                _failed(job, result)
+            else:
+                logger.warning(f"Couldn't apply turn job {job['id']} for {job['user_id']} before reading: {result}")
+    return applied
+
+
+def drain_user(user_id: str) -> int:
+    """Apply this user's queued turns right now (read-your-writes before loading their memory).
+    Stops at the first failure so turns never apply out of order, the worker retries it with backoff."""
+    jobs = memory_manager.user_turn_jobs(user_id)
+    if not jobs:
+        return 0
+    return _apply_batch(memory_manager.shard_index(user_id), jobs, record_failures=False)
+
+
+def drain_users(user_ids: List[str]) -> int:
+    """drain_user for a whole batch, only touching the users that actually have something queued."""
+    applied = 0
+    for user_id in memory_manager.users_with_turn_jobs(user_ids):
+        applied += drain_user(user_id)
+    return applied
+
+
+def drain_all() -> int:
+    """One sweep over every shard. Returns jobs applied.
+    Each page of due jobs is one transaction, so a busy server pays one commit per sweep, not two per turn."""
+    applied = 0
+    for shard in range(memory_manager.SHARD_COUNT):
+        while True:
+            jobs = memory_manager.due_turn_jobs(shard, BATCH)
+            if not jobs:
+                break
+            done = _apply_batch(shard, jobs)
+            applied += done
+            if len(jobs) < BATCH or not done:
+                break
+    return applied
+
+
+class _Worker:
+    def __init__(self, poll: float = POLL_SECONDS):
+        self.poll = poll
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self.sweeps = 0
+
+    def wake(self):
+        self._wake.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.poll)
+            self._wake.clear()
+            try:
+                drain_all()
+                self.sweeps += 1
+            except Exception as e:
+                logger.error(f"Post-turn sweep failed: {e}")
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="post-turn", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+_worker: Optional[_Worker] = None
+
+
+def submit(user_id: str, user_input: str, ai_reply: str) -> int:
+    """Queue a finished turn. With no worker running (CLI, Streamlit) it's applied right away."""
+    job_id = memory_manager.enqueue_turn_job(user_id, {
+        "user_input": user_input,
+        "ai_reply": ai_reply,
+        "turn_at": time.time(),
+    })
+    if _worker is not None:
+        _worker.wake()
+    else:
+        drain_user(user_id)
+    return job_id
+
+
+def start():
+    """Apply queued turns in the background (API startup). Picks up whatever a previous run left."""
+    global _worker
+    if _worker is None:
+        _worker = _Worker()
+        _worker.start()
+        logger.info("Post-turn worker started.")
+
+
+def stop():
+    """Stop the worker and apply what's left (API shutdown)."""
+    global _worker
+    worker, _worker = _worker, None
+    if worker is not None:
+        worker.stop()
+        drain_all()
+        logger.info("Post-turn worker stopped.")
+
+
+def stats() -> Dict[str, Any]:
+    return {
+        "running": _worker is not None,
+        "sweeps": _worker.sweeps if _worker else 0,
+        **memory_manager.turn_job_stats(),
+    }
@@ -3,6 +3,7 @@
 # It combines the personality, rules, and user data into one string
 
 import json
+import hashlib
 from typing import Dict, Any
 
 # --- TEXT MODULES ---
@@ -179,14 +180,21 @@ SPECIAL_MODIFIERS = {
     "MODIFIER_ON_FIRE": "User is on a streak (>7 days). They are heating up. Challenge them to double down.",
 }
 
-# --- BUILDER FUNCTION ---
+# --- BUILDER FUNCTIONS ---
+
+# The prompt is split in two:
+# - STATIC_PREFIX: character + rules, identical for every user and every turn.
+#   It gets registered once as cached content on Gemini (see prompt_cache.py).
+# - dynamic suffix: rank, context, datasheet, tone. Small, rebuilt per turn.
+# Bump PROMPT_VERSION when the prefix changes meaning without changing text (e.g. new model).
+PROMPT_VERSION = "1"
+STATIC_PREFIX = "\n\n".join([CORE_CHARACTER, CORE_RULES])
+STATIC_PREFIX_HASH = hashlib.sha256(f"{PROMPT_VERSION}:{STATIC_PREFIX}".encode("utf-8")).hexdigest()[:16]
+
+def build_dynamic_suffix(context_trigger: str, memory: Dict[str, Any]) -> str:
+    # everything that changes per user / per turn
+    prompt_parts = []
 
-def build_system_prompt(context_trigger: str, memory: Dict[str, Any]) -> str:
-    # combine all the parts into one big prompt
-    
-    # 1. Core Module
-    prompt_parts = [CORE_CHARACTER, CORE_RULES]
-    
     # 2. Rank Module
     rank = memory.get('progression', {}).get('rank', 'Newcomer')
     prompt_parts.append(f"Rank Protocol: {RANK_MODULES.get(rank, RANK_MODULES['Newcomer'])}")
@@ -209,6 +217,11 @@ def build_system_prompt(context_trigger: str, memory: Dict[str, Any]) -> str:
     Known Obstacles: {obstacles}
     """
     prompt_parts.append(memory_block)
+
+    # 4b. Long-term memory (rolling summary of older conversations)
+    summary = memory.get('summary')
+    if summary:
+        prompt_parts.append(f"LONG-TERM MEMORY (what you remember from older conversations):\n{summary}")
     
     # 5. Tone Modifier
     fam = memory.get('relationship', {}).get('familiarity_level', 1)
@@ -230,6 +243,11 @@ def build_system_prompt(context_trigger: str, memory: Dict[str, Any]) -> str:
     
     return "\n\n".join(prompt_parts)
 
+def build_system_prompt(context_trigger: str, memory: Dict[str, Any]) -> str:
+    # combine all the parts into one big prompt
+    # (used when there is no cached prefix on the Gemini side)
+    return STATIC_PREFIX + "\n\n" + build_dynamic_suffix(context_trigger, memory)
+
 if __name__ == "__main__":
     # Test builder
     dummy_memory = {
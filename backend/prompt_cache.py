@@ -0,0 +1,185 @@
+# Author: Steven Lansangan
+# Keeps Babaru's static prompt prefix registered as cached content on Gemini
+# so each turn only sends the small dynamic part + history instead of
+# re-sending (and re-paying for) thousands of tokens of character sheet.
+#
+# BABARU_PROMPT_CACHE=gemini  -> real Gemini context caching (default)
+# BABARU_PROMPT_CACHE=local   -> in-memory stub, for testing without the network (no Gemini client)
+# BABARU_PROMPT_CACHE=off     -> always send the full system prompt
+import os
+import time
+import threading
+import logging
+import itertools
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from typing import Optional
+
+from backend import prompt_builder
+
+logger = logging.getLogger("PromptCache")
+
+CACHE_MODE = os.getenv("BABARU_PROMPT_CACHE", "gemini").lower()
+CACHE_TTL_SECONDS = int(os.getenv("BABARU_PROMPT_CACHE_TTL", "3600"))
+
+# Refresh this long before Gemini would expire it, so a turn never lands on a dead cache
+REFRESH_MARGIN_SECONDS = 300
+
+# After a failed create (quota, prefix below the model's minimum size...) wait before trying again
+RETRY_AFTER_SECONDS = 60
+
+
+class LocalCaches:
+    """
+    Stand-in for `client.caches` that never leaves the process.
+    Same create/get/list/delete surface, so PromptCache can be exercised offline.
+    """
+
+    def __init__(self):
+        self._items = {}
+        self._ids = itertools.count(1)
+        self.creates = 0
+
+    def create(self, model: str, config):
+        self.creates += 1
+        name = f"cachedContents/local-{next(self._ids)}"
+        ttl = int(str(getattr(config, "ttl", f"{CACHE_TTL_SECONDS}s")).rstrip("s"))
+        item = SimpleNamespace(
+            name=name,
+            model=model,
+            display_name=getattr(config, "display_name", None),
+            system_instruction=getattr(config, "system_instruction", None),
+            expire_time=datetime.now(timezone.utc) + timedelta(seconds=ttl),
+        )
+        self._items[name] = item
+        return item
+
+    def get(self, name: str):
+        item = self._items.get(name)
+        if item is None or item.expire_time <= datetime.now(timezone.utc):
+            raise KeyError(f"{name} not found")
+        return item
+
+    def list(self):
+        now = datetime.now(timezone.utc)
+        return [item for item in self._items.values() if item.expire_time > now]
+
+    def delete(self, name: str):
+        self._items.pop(name, None)
+
+
+class PromptCache:
+    """
+    Owns the cached-content handle for the current STATIC_PREFIX.
+    The handle is keyed by the prefix hash (in its display name), so a prompt
+    change or a new deploy never picks up a stale prefix.
+    """
+
+    def __init__(self, caches, model: str, ttl_seconds: int = CACHE_TTL_SECONDS):
+        self.caches = caches
+        self.model = model
+        self.ttl_seconds = ttl_seconds
+        self.display_name = f"babaru-prefix-v{prompt_builder.PROMPT_VERSION}-{prompt_builder.STATIC_PREFIX_HASH}"
+        self._name: Optional[str] = None
+        self._expires_at = 0.0
+        self._retry_at = 0.0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.refreshes = 0
+        self.failures = 0
+
+    def _usable(self) -> bool:
+        return self._name is not None and time.time() < self._expires_at - REFRESH_MARGIN_SECONDS
+
+    def peek(self) -> Optional[str]:
+        """Cache name if we have a fresh one, without ever hitting the network."""
+        if self._usable():
+            self.hits += 1
+            return self._name
+        return None
+
+    def needs_refresh(self) -> bool:
+        return not self._usable() and time.time() >= self._retry_at
+
+    def get_name(self) -> Optional[str]:
+        """Cache name for the current prefix, creating/refreshing it if needed. Blocking.
+        Returns None when caching isn't available, callers then send the full prompt."""
+        name = self.peek()
+        if name or time.time() < self._retry_at:
+            return name
+
+        with self._lock:
+            if self._usable():
+                return self._name
+            try:
+                self._name, self._expires_at = self._find_existing() or self._create()
+                self.refreshes += 1
+                return self._name
+            except Exception as e:
+                self.failures += 1
+                self._name = None
+                self._retry_at = time.time() + RETRY_AFTER_SECONDS
+                logger.warning(f"Prompt cache unavailable, sending full prompts for {RETRY_AFTER_SECONDS}s: {e}")
+                return None
+
+    def invalidate(self):
+        """Forget the current handle (e.g. Gemini said it's gone) so the next turn re-creates it."""
+        with self._lock:
+            self._name = None
+            self._expires_at = 0.0
+
+    def _find_existing(self):
+        # Another replica (or our previous life) may already have registered this exact prefix
+        for item in self.caches.list():
+            if getattr(item, "display_name", None) == self.display_name and getattr(item, "model", "").endswith(self.model):
+                expires = _to_epoch(item.expire_time)
+                if expires - REFRESH_MARGIN_SECONDS > time.time():
+                    logger.info(f"Reusing prompt cache {item.name}")
+                    return item.name, expires
+        return None
+
+    def _create(self):
+        from google.genai import types
+        item = self.caches.create(
+            model=self.model,
+            config=types.CreateCachedContentConfig(
+                display_name=self.display_name,
+                system_instruction=prompt_builder.STATIC_PREFIX,
+                ttl=f"{self.ttl_seconds}s",
+            ),
+        )
+        logger.info(f"Registered prompt prefix {self.display_name} as {item.name}")
+        expires = _to_epoch(item.expire_time) if getattr(item, "expire_time", None) else time.time() + self.ttl_seconds
+        return item.name, expires
+
+    def stats(self):
+        return {
+            "mode": CACHE_MODE,
+            "name": self._name,
+            "display_name": self.display_name,
+            "expires_in_s": round(self._expires_at - time.time(), 1) if self._name else None,
+            "hits": self.hits,
+            "refreshes": self.refreshes,
+            "failures": self.failures,
+        }
+
+
+def _to_epoch(value) -> float:
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return value.timestamp()
+    return float(value)
+
+
+def from_env(client, model: str) -> Optional[PromptCache]:
+    """Build the PromptCache the BABARU_PROMPT_CACHE setting asks for (None means off)."""
+    if CACHE_MODE == "off":
+        return None
+    if CACHE_MODE == "local":
+        if client is not None:
+            # Gemini has never heard of the stub's names, every turn would 404 and fall back anyway
+            logger.error("BABARU_PROMPT_CACHE=local only works without a Gemini client, prompt caching is off.")
+            return None
+        return PromptCache(LocalCaches(), model)
+    return PromptCache(client.caches, model)
@@ -0,0 +1,98 @@
+# Author: Steven Lansangan
+# Rolling conversation summaries ("Memory Flex" without giant prompts)
+# Older messages get folded into one short per-user summary in the background,
+# so the prompt carries a fixed-size recap instead of the whole history
+import os
+import threading
+import logging
+
+from utils import memory_manager, executors, upstream
+
+logger = logging.getLogger("Summarizer")
+
+# A cheap, fast model is plenty for summarizing
+SUMMARY_MODEL = os.getenv("BABARU_SUMMARY_MODEL", "gemini-2.5-flash")
+
+# Compact once this many messages have piled up past the ones sent word for word
+SUMMARY_TRIGGER = int(os.getenv("BABARU_SUMMARY_TRIGGER", "20"))
+
+# Most messages folded in per compaction (a user coming back from a long history catches up over a few runs)
+SUMMARY_BATCH = 200
+
+# Keeps the summary (and so the prompt) a fixed, small size
+SUMMARY_MAX_WORDS = 250
+
+SUMMARY_PROMPT = """You maintain the long-term memory of Babaru, a snarky AI life coach, about one user.
+Merge the EXISTING SUMMARY with the NEW CONVERSATION into one updated summary.
+Keep what matters for coaching: their name, goals, obstacles, promises they made, missions,
+wins and failures, excuses they keep using, running jokes, and anything personal they shared.
+Drop small talk. Write plain third-person notes about the user, at most {max_words} words.
+
+EXISTING SUMMARY:
+{summary}
+
+NEW CONVERSATION:
+{conversation}
+
+UPDATED SUMMARY:"""
+
+# Users with a compaction currently running, so we never run two at once for someone
+_in_flight = set()
+_lock = threading.Lock()
+
+
+def maybe_schedule(user_id: str, client, keep_recent: int):
+    """Kick off a background compaction for this user if one isn't already running.
+    Cheap to call every turn, the actual check happens on the 'llm' executor."""
+    with _lock:
+        if user_id in _in_flight:
+            return
+        _in_flight.add(user_id)
+    try:
+        executors.get_executor("llm").submit(_run, user_id, client, keep_recent)
+    except RuntimeError:
+        # Executor already shut down (server stopping), try again next turn
+        with _lock:
+            _in_flight.discard(user_id)
+
+
+def _run(user_id: str, client, keep_recent: int):
+    try:
+        compact(user_id, client, keep_recent)
+    except Exception as e:
+        logger.error(f"Summary for {user_id} failed: {e}")
+    finally:
+        with _lock:
+            _in_flight.discard(user_id)
+
+
+def compact(user_id: str, client, keep_recent: int) -> bool:
+    """Fold old messages into the stored summary. Returns True if the summary changed."""
+    state = memory_manager.get_summary_state(user_id)
+    messages = memory_manager.get_unsummarized_messages(
+        user_id, state['summarized_until'], keep_recent=keep_recent, limit=SUMMARY_BATCH
+    )
+    if len(messages) < SUMMARY_TRIGGER:
+        return False
+
+    conversation = "\n".join(
+        f"{'User' if m['role'] == 'user' else 'Babaru'}: {m['content']}" for m in messages
+    )
+    prompt = SUMMARY_PROMPT.format(
+        max_words=SUMMARY_MAX_WORDS,
+        summary=state['summary'] or "(nothing yet)",
+        conversation=conversation,
+    )
+
+    from google.genai import types
+    response = upstream.get("gemini").call(lambda timeout: client.models.generate_content(
+        model=SUMMARY_MODEL, contents=prompt,
+        config=types.GenerateContentConfig(http_options=types.HttpOptions(timeout=int(timeout * 1000)))))
+    summary = (response.text or "").strip()
+    if not summary:
+        logger.warning(f"Empty summary for {user_id}, keeping the old one.")
+        return False
+
+    memory_manager.save_summary(user_id, summary, messages[-1]['id'])
+    logger.info(f"Summarized {len(messages)} messages for {user_id}.")
+    return True
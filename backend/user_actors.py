@@ -0,0 +1,119 @@
+# Author: Steven Lansangan
+# One mailbox per active user, so their turns happen one after another
+# Two quick messages from the same user used to run side by side and both read
+# the same history. Now each user_id gets a FIFO mailbox: their turns wait for
+# the previous one (and see its writes), while other users don't wait at all.
+# Mailboxes only exist while someone is in them, idle users cost nothing.
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable, Dict
+
+from utils import upstream, metrics
+
+logger = logging.getLogger("UserActors")
+
+# Turns a single user may have queued (running one included) before we say slow down
+USER_QUEUE_MAX = int(os.getenv("BABARU_USER_QUEUE_MAX", "5"))
+
+
+class UserBusy(Exception):
+    """Too many turns already queued for this user."""
+
+
+class _Mailbox:
+    def __init__(self):
+        # asyncio.Lock hands itself to waiters in arrival order
+        self.lock = asyncio.Lock()
+        self.depth = 0
+
+
+class UserActors:
+    def __init__(self, queue_max: int = USER_QUEUE_MAX):
+        self.queue_max = queue_max
+        self._mailboxes: Dict[str, _Mailbox] = {}
+        # Recent wait times (seconds) before a turn got to run
+        self._waits: deque = deque(maxlen=1000)
+        self.turns = 0
+        self.waited = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.peak_depth = 0
+
+    @asynccontextmanager
+    async def turn(self, user_id: str):
+        """Hold this user's turn for the duration of the block. Waits for earlier turns first."""
+        box = self._mailboxes.get(user_id)
+        if box is None:
+            box = self._mailboxes[user_id] = _Mailbox()
+        if box.depth >= self.queue_max:
+            self.rejected += 1
+            raise UserBusy(f"{box.depth} turns already queued for {user_id}")
+
+        box.depth += 1
+        self.peak_depth = max(self.peak_depth, box.depth)
+        queued_at = time.monotonic()
+        try:
+            # Waiting counts against the request deadline like everything else
+            left = upstream.remaining()
+            if left is not None and left <= 0:
+                raise asyncio.TimeoutError()
+            await asyncio.wait_for(box.lock.acquire(), left)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            self._leave(user_id, box)
+            raise upstream.DeadlineExceeded(f"Timed out waiting for {user_id}'s previous turn")
+        except BaseException:
+            self._leave(user_id, box)
+            raise
+
+        wait = time.monotonic() - queued_at
+        self._waits.append(wait)
+        metrics.record("user_queue", wait)
+        self.turns += 1
+        if box.depth > 1 or wait > 0.001:
+            self.waited += 1
+        try:
+            yield
+        finally:
+            box.lock.release()
+            self._leave(user_id, box)
+
+    def _leave(self, user_id: str, box: _Mailbox):
+        box.depth -= 1
+        # Last one out removes the mailbox (no awaits in between, so nobody can sneak in)
+        if box.depth == 0 and self._mailboxes.get(user_id) is box:
+            del self._mailboxes[user_id]
+
+    async def run(self, user_id: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """Run fn() as this user's next turn and return its result."""
+        async with self.turn(user_id):
+            return await fn()
+
+    def depth(self, user_id: str) -> int:
+        box = self._mailboxes.get(user_id)
+        return box.depth if box else 0
+
+    def stats(self) -> Dict[str, Any]:
+        waits = sorted(self._waits)
+        pct = lambda p: round(waits[min(len(waits) - 1, int(len(waits) * p))] * 1000, 1) if waits else 0.0
+        return {
+            "active_users": len(self._mailboxes),
+            "queued_turns": sum(box.depth for box in self._mailboxes.values()),
+            "max_user_depth": max((box.depth for box in self._mailboxes.values()), default=0),
+            "peak_user_depth": self.peak_depth,
+            "turns": self.turns,
+            "waited": self.waited,
+            "rejected": self.rejected,
+            "timeouts": self.timeouts,
+            "wait_p50_ms": pct(0.50),
+            "wait_p95_ms": pct(0.95),
+            "wait_max_ms": round(waits[-1] * 1000, 1) if waits else 0.0,
+        }
+
+
+# Shared by every endpoint that runs a chat turn
+actors = UserActors()
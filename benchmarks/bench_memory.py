@@ -0,0 +1,225 @@
+# Author: Steven Lansangan
+# Micro-benchmarks for the memory_manager hot paths
+# Builds a throwaway database with synthetic users (10 to 50k messages each),
+# times the read/write helpers single-threaded and under N threads, and writes
+# JSON so runs from different commits can be diffed.
+#
+#   python -m benchmarks.bench_memory --out bench_memory.json
+#   python -m benchmarks.bench_memory --sizes 10,1000 --threads 1,4 --ops 500
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import sqlite3
+import platform
+import argparse
+import tempfile
+import statistics
+import subprocess
+import threading
+from typing import Callable, Dict, List, Any
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import memory_manager, db_pool  # noqa: E402
+
+WORDS = ("mission deploy gym code launch sleep excuse tomorrow promise coffee deadline pitch investor "
+         "landing page ship it feedback ugly draft focus distracted netflix friend goal").split()
+
+
+def _sentence(rng: random.Random, lo: int = 6, hi: int = 40) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(lo, hi)))
+
+
+def _missions(rng: random.Random) -> Dict[str, List[str]]:
+    return {
+        "active": [_sentence(rng, 3, 10) for _ in range(rng.randint(1, 5))],
+        "completed": [_sentence(rng, 3, 10) for _ in range(rng.randint(0, 60))],
+        "failed": [_sentence(rng, 3, 10) for _ in range(rng.randint(0, 20))],
+    }
+
+
+def populate(sizes: List[int], users_per_size: int, seed: int = 7) -> Dict[int, List[str]]:
+    """Create users with the given history sizes. Returns {history size: [user ids]}."""
+    rng = random.Random(seed)
+    by_size: Dict[int, List[str]] = {}
+    for size in sizes:
+        ids = [f"bench_{size}_{i}" for i in range(users_per_size)]
+        memory_manager.create_users({"user_id": u, "name": f"Bench {u}"} for u in ids)
+        for user_id in ids:
+            m = _missions(rng)
+            memory_manager.update_missions(user_id, **m)
+            memory_manager.update_profile(user_id, {"primary_goal": _sentence(rng, 4, 12), "obstacles": _sentence(rng, 4, 12)})
+            # Bulk insert straight into the log, going through the helper would take forever at 50k
+            rows = [(user_id, "user" if i % 2 == 0 else "model", _sentence(rng)) for i in range(size)]
+            with memory_manager.get_pool(user_id).writer() as conn:
+                conn.executemany("INSERT INTO messages (user_id, role, content) VALUES (?, ?, ?)", rows)
+        by_size[size] = ids
+    return by_size
+
+
+def _percentile(sorted_vals: List[float], pct: float) -> float:
+    if not sorted_vals:
+        return 0.0
+    idx = min(len(sorted_vals) - 1, max(0, int(round(pct / 100 * len(sorted_vals))) - 1))
+    return sorted_vals[idx]
+
+
+def measure(name: str, fn: Callable[[int], Any], ops: int, threads: int, **labels) -> Dict[str, Any]:
+    """Call fn(i) `ops` times spread over `threads` threads and summarize the latencies."""
+    latencies: List[float] = []
+    lock = threading.Lock()
+    counter = iter(range(ops))
+
+    def worker():
+        local = []
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                break
+            t0 = time.perf_counter()
+            fn(i)
+            local.append(time.perf_counter() - t0)
+        with lock:
+            latencies.extend(local)
+
+    started = time.perf_counter()
+    pool = [threading.Thread(target=worker) for _ in range(threads)]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    wall = time.perf_counter() - started
+
+    latencies.sort()
+    result = {
+        "op": name,
+        "threads": threads,
+        "ops": len(latencies),
+        "wall_s": round(wall, 4),
+        "ops_per_sec": round(len(latencies) / wall, 1) if wall else 0.0,
+        "mean_ms": round(statistics.fmean(latencies) * 1000, 4),
+        "p50_ms": round(_percentile(latencies, 50) * 1000, 4),
+        "p99_ms": round(_percentile(latencies, 99) * 1000, 4),
+        "max_ms": round(latencies[-1] * 1000, 4),
+    }
+    result.update(labels)
+    print(f"  {name:<28} threads={threads:<3} {json.dumps(labels) if labels else '':<24} "
+          f"{result['ops_per_sec']:>10} ops/s  p50={result['p50_ms']}ms  p99={result['p99_ms']}ms", file=sys.stderr)
+    return result
+
+
+def run_suite(by_size: Dict[int, List[str]], ops: int, thread_counts: List[int]) -> List[Dict[str, Any]]:
+    results = []
+    rng = random.Random(11)
+    created = iter(range(10 ** 9))
+    created_lock = threading.Lock()
+
+    for threads in thread_counts:
+        for size, ids in by_size.items():
+            results.append(measure(
+                "get_user_memory", lambda i: memory_manager.get_user_memory(ids[i % len(ids)])["conversations"],
+                ops, threads, history_size=size,
+            ))
+            results.append(measure(
+                "update_conversation_history",
+                lambda i: memory_manager.update_conversation_history(ids[i % len(ids)], {"role": "user", "content": "bench message"}),
+                ops, threads, history_size=size,
+            ))
+
+        all_ids = [u for ids in by_size.values() for u in ids]
+
+        def new_user(_):
+            with created_lock:
+                n = next(created)
+            memory_manager.create_user(f"bench_new_{threads}_{n}", "New")
+
+        results.append(measure("create_user", new_user, ops, threads))
+        results.append(measure(
+            "update_progression",
+            lambda i: memory_manager.update_progression(all_ids[i % len(all_ids)], {"points": i, "streak_days": i % 30}),
+            ops, threads,
+        ))
+        results.append(measure(
+            "update_missions",
+            lambda i: memory_manager.update_missions(all_ids[i % len(all_ids)], active=[_sentence(rng, 3, 8)]),
+            ops, threads,
+        ))
+        results.append(measure(
+            "update_profile",
+            lambda i: memory_manager.update_profile(all_ids[i % len(all_ids)], {"wins": f"win {i}"}),
+            ops, threads,
+        ))
+        results.append(measure(
+            "update_relationship",
+            lambda i: memory_manager.update_relationship(all_ids[i % len(all_ids)], familiarity_delta=1, trust_delta=-1),
+            ops, threads,
+        ))
+    return results
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL, text=True,
+        ).strip()
+    except Exception:
+        return "unknown"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark memory_manager hot paths")
+    parser.add_argument("--sizes", default="10,100,1000,10000,50000", help="History sizes (messages per user)")
+    parser.add_argument("--users-per-size", type=int, default=5)
+    parser.add_argument("--ops", type=int, default=2000, help="Operations per measurement")
+    parser.add_argument("--threads", default="1,8", help="Thread counts to run each measurement with")
+    parser.add_argument("--shards", type=int, default=1)
+    parser.add_argument("--cache", action="store_true", help="Leave the in-process memory cache on (off by default to measure SQLite)")
+    parser.add_argument("--out", default="bench_memory.json", help="Where to write the JSON results")
+    args = parser.parse_args(argv)
+
+    sizes = [int(s) for s in args.sizes.split(",") if s]
+    thread_counts = [int(t) for t in args.threads.split(",") if t]
+
+    workdir = tempfile.mkdtemp(prefix="babaru-bench-")
+    memory_manager.DB_PATH = os.path.join(workdir, "bench.db")
+    memory_manager.SHARD_COUNT = args.shards
+    if not args.cache:
+        memory_manager.memory_cache.max_entries = 0
+
+    try:
+        memory_manager.init_db()
+        print(f"Populating {len(sizes) * args.users_per_size} users in {workdir}...", file=sys.stderr)
+        t0 = time.perf_counter()
+        by_size = populate(sizes, args.users_per_size)
+        print(f"Populated in {time.perf_counter() - t0:.1f}s", file=sys.stderr)
+
+        results = run_suite(by_size, args.ops, thread_counts)
+
+        report = {
+            "meta": {
+                "commit": _git_commit(),
+                "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                "python": platform.python_version(),
+                "sqlite": sqlite3.sqlite_version,
+                "platform": platform.platform(),
+                "cpu_count": os.cpu_count(),
+                "config": vars(args),
+            },
+            "pool": memory_manager.pool_stats(),
+            "results": results,
+        }
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Wrote {args.out}", file=sys.stderr)
+    finally:
+        db_pool.close_all()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+# Author: Steven Lansangan
+# Cold start numbers: how long `import api` takes and how long until the server answers
+# Each measurement is a fresh interpreter, so nothing is warm from the previous run.
+# - import: wall time of importing each module, plus the slowest packages (python -X importtime)
+# - serve: uvicorn started from scratch, time until / answers (port bound) and until /ready is 200
+# Writes JSON so runs from different commits can be diffed.
+#
+#   python -m benchmarks.bench_startup --out bench_startup.json
+#   python -m benchmarks.bench_startup --runs 10 --skip-serve
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import statistics
+import subprocess
+import http.client
+from typing import Any, Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODULES = ["api", "backend.babaru_brain", "utils.voice_manager"]
+
+
+def _env(workdir: str) -> Dict[str, str]:
+    env = dict(os.environ)
+    env.update({
+        "PYTHONPATH": ROOT + os.pathsep + env.get("PYTHONPATH", ""),
+        "GOOGLE_API_KEY": env.get("GOOGLE_API_KEY", "fake"),
+        "ELEVENLABS_API_KEY": env.get("ELEVENLABS_API_KEY", "fake"),
+        "BABARU_TTS_CACHE_DIR": os.path.join(workdir, "tts_cache"),
+        "BABARU_AUDIO_STORE_DIR": os.path.join(workdir, "audio_store"),
+    })
+    return env
+
+
+def time_import(module: str, workdir: str) -> float:
+    code = f"import time; t = time.perf_counter(); import {module}; print(time.perf_counter() - t)"
+    out = subprocess.run([sys.executable, "-c", code], cwd=workdir, env=_env(workdir),
+                         capture_output=True, text=True, check=True)
+    return float(out.stdout.strip().splitlines()[-1])
+
+
+def slowest_imports(module: str, workdir: str, top: int) -> List[Dict[str, Any]]:
+    """Top-level packages by cumulative import time, from python -X importtime."""
+    out = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], cwd=workdir,
+                         env=_env(workdir), capture_output=True, text=True, check=True)
+    totals: Dict[str, int] = {}
+    for line in out.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        parts = [p.strip() for p in line[len("import time:"):].split("|")]
+        if not parts[1].isdigit():
+            continue
+        name = parts[2]
+        # Only the outermost import of each top-level package (least indented), its cumulative covers the rest
+        if name.startswith(" "):
+            continue
+        root = name.split(".")[0]
+        totals[root] = max(totals.get(root, 0), int(parts[1]))
+    ranked = sorted(totals.items(), key=lambda kv: kv[1], reverse=True)[:top]
+    return [{"package": name, "ms": round(us / 1000, 1)} for name, us in ranked]
+
+
+def _get(port: int, path: str) -> int:
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=2)
+    try:
+        conn.request("GET", path)
+        response = conn.getresponse()
+        response.read()
+        return response.status
+    finally:
+        conn.close()
+
+
+def time_serve(workdir: str, port: int, timeout: float = 60) -> Dict[str, Any]:
+    started = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "api:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=workdir, env=_env(workdir), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    result = {"listening_s": None, "ready_s": None}
+    try:
+        while time.perf_counter() - started < timeout and result["ready_s"] is None:
+            if proc.poll() is not None:
+                raise RuntimeError("server exited during startup")
+            try:
+                if result["listening_s"] is None and _get(port, "/") == 200:
+                    result["listening_s"] = round(time.perf_counter() - started, 3)
+                if result["listening_s"] is not None and _get(port, "/ready") == 200:
+                    result["ready_s"] = round(time.perf_counter() - started, 3)
+                    break
+            except OSError:
+                pass
+            time.sleep(0.02)
+    finally:
+        proc.terminate()
+        proc.wait(timeout=30)
+    return result
+
+
+def _summary(values: List[float]) -> Dict[str, float]:
+    values = [v for v in values if v is not None]
+    if not values:
+        return {}
+    return {"median": round(statistics.median(values), 3), "min": round(min(values), 3), "max": round(max(values), 3)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure import and startup time")
+    parser.add_argument("--runs", type=int, default=5, help="Fresh interpreters per measurement")
+    parser.add_argument("--modules", default=",".join(MODULES))
+    parser.add_argument("--top", type=int, default=10, help="Slowest packages to list")
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--skip-serve", action="store_true", help="Only measure imports")
+    parser.add_argument("--out", default=None)
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix="babaru_startup_")
+    report: Dict[str, Any] = {"python": sys.version.split()[0], "runs": args.runs, "imports": {}}
+    try:
+        for module in args.modules.split(","):
+            times = [time_import(module, workdir) for _ in range(args.runs)]
+            report["imports"][module] = {
+                "seconds": _summary(times),
+                "slowest_packages": slowest_imports(module, workdir, args.top),
+            }
+        if not args.skip_serve:
+            runs = [time_serve(workdir, args.port) for _ in range(args.runs)]
+            report["serve"] = {
+                "listening_s": _summary([r["listening_s"] for r in runs]),
+                "ready_s": _summary([r["ready_s"] for r in runs]),
+            }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text)
+
+
+if __name__ == "__main__":
+    main()
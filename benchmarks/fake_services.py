@@ -0,0 +1,266 @@
+# Author: Steven Lansangan
+# Local stand-ins for Gemini and ElevenLabs, for load testing the real API
+# They speak just enough of both HTTP APIs for the SDKs (generateContent,
+# streamGenerateContent, cachedContents, text-to-speech), with latency drawn
+# from a log-normal (median + p99), random errors, a capacity after which they
+# 429, and real MP3 frames sized to the text, so the Jukebox splicer works too.
+# Point the app at them with GEMINI_BASE_URL / ELEVENLABS_BASE_URL.
+#
+#   python -m benchmarks.fake_services --gemini-port 9001 --elevenlabs-port 9002
+import sys
+import json
+import math
+import time
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Optional, Tuple
+
+# MPEG-1 Layer III, 128 kbps, 44.1 kHz, mono: what mp3_44100_128 gives us with one channel
+FRAME_HEADER = bytes([0xFF, 0xFB, 0x90, 0xC4])
+FRAME_BYTES = 417
+FRAMES_PER_SECOND = 44100 / 1152
+
+REPLIES = [
+    "Oh look who crawled back. Did the couch finally let you go?",
+    "Another excuse, how original. I'm writing this one down for the museum.",
+    "Fine. One small step. Do the thing you said you'd do yesterday.",
+    "Your mission, should you choose to stop whining, is twenty minutes of real work.",
+    "I'm not mad, I'm just disappointed. Okay, I'm a little mad.",
+]
+
+
+def mp3_audio(seconds: float) -> bytes:
+    """Silent-ish but valid MP3 frames, about `seconds` long."""
+    frames = max(1, int(seconds * FRAMES_PER_SECOND))
+    frame = FRAME_HEADER + bytes(FRAME_BYTES - len(FRAME_HEADER))
+    return frame * frames
+
+
+class Latency:
+    """Log-normal latency from a median and a p99 (milliseconds)."""
+
+    def __init__(self, median_ms: float, p99_ms: float, rng: random.Random):
+        self.mu = math.log(max(median_ms, 0.01))
+        self.sigma = max(math.log(max(p99_ms, median_ms) / max(median_ms, 0.01)) / 2.326, 0.0)
+        self.rng = rng
+
+    def sample(self) -> float:
+        return self.rng.lognormvariate(self.mu, self.sigma) / 1000
+
+
+class FakeService:
+    """Latency, errors and capacity shared by both fakes."""
+
+    def __init__(self, name: str, median_ms: float, p99_ms: float, error_rate: float = 0.0,
+                 capacity: int = 1000, seed: int = 7):
+        self.name = name
+        self.rng = random.Random(seed)
+        self.latency = Latency(median_ms, p99_ms, self.rng)
+        self.error_rate = error_rate
+        self.capacity = capacity
+        self.in_flight = 0
+        self.peak = 0
+        self.requests = 0
+        self.errors = 0
+        self.overloaded = 0
+        self._lock = threading.Lock()
+
+    def admit(self) -> Tuple[float, Optional[int]]:
+        """(delay, error status or None) for a new request. Call done() when it's over."""
+        with self._lock:
+            self.requests += 1
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+            if self.in_flight > self.capacity:
+                self.overloaded += 1
+                return 0.0, 429
+            fail = self.rng.random() < self.error_rate
+            delay = self.latency.sample()
+            if fail:
+                self.errors += 1
+        return delay, (503 if fail else None)
+
+    def done(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {"requests": self.requests, "errors": self.errors, "overloaded": self.overloaded, "peak_in_flight": self.peak}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out as separate writes, don't let Nagle sit on the second one
+    disable_nagle_algorithm = True
+    service: FakeService = None
+
+    def log_message(self, *args):
+        pass
+
+    def _body(self) -> Dict[str, Any]:
+        length = int(self.headers.get("content-length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        try:
+            return json.loads(raw or b"{}")
+        except ValueError:
+            return {}
+
+    def _send(self, status: int, body: bytes, content_type: str = "application/json"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _error(self, status: int):
+        codes = {429: "RESOURCE_EXHAUSTED", 503: "UNAVAILABLE"}
+        self._send(status, json.dumps({"error": {"code": status, "message": f"fake {self.service.name} says no", "status": codes.get(status, "UNKNOWN")}}).encode())
+
+    def do_POST(self):
+        self.service_request(self._body())
+
+    def do_DELETE(self):
+        self._send(200, b"{}")
+
+    def service_request(self, body):
+        raise NotImplementedError
+
+
+class GeminiHandler(_Handler):
+    # Words per streamed chunk, and the gap between chunks (ms)
+    reply_words = 40
+    chunk_words = 6
+    chunk_ms = 30.0
+    song = "anthem"
+
+    def _reply(self, body: Dict[str, Any]) -> str:
+        contents = body.get("contents") or [{}]
+        last = " ".join(p.get("text", "") for p in contents[-1].get("parts", []) if isinstance(p, dict))
+        rng = self.service.rng
+        words = []
+        while len(words) < self.reply_words:
+            words += rng.choice(REPLIES).split()
+        text = " ".join(words[:self.reply_words])
+        if not text.endswith((".", "!", "?")):
+            text += "."
+        if "sing" in last.lower():
+            # Intro, song, outro, like the real thing does it
+            return f"You want a song? Fine. [PLAY_SONG: {self.song}] {text}"
+        return text
+
+    @staticmethod
+    def _candidate(text: str) -> bytes:
+        return json.dumps({
+            "candidates": [{"content": {"role": "model", "parts": [{"text": text}]}, "finishReason": "STOP", "index": 0}],
+            "usageMetadata": {"promptTokenCount": 100, "candidatesTokenCount": len(text.split()), "totalTokenCount": 100 + len(text.split())},
+        }).encode()
+
+    def service_request(self, body):
+        path = self.path.split("?")[0]
+        if path.endswith("/cachedContents"):
+            self._send(200, json.dumps({
+                "name": f"cachedContents/fake{self.service.rng.randrange(10**9)}",
+                "model": body.get("model", "models/fake"),
+                "expireTime": "2099-01-01T00:00:00Z",
+            }).encode())
+            return
+        delay, error = self.service.admit()
+        try:
+            time.sleep(delay)
+            if error:
+                self._error(error)
+            elif path.endswith(":streamGenerateContent"):
+                self._stream(self._reply(body))
+            else:
+                self._send(200, self._candidate(self._reply(body)))
+        finally:
+            self.service.done()
+
+    def _stream(self, text: str):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        words = text.split(" ")
+        for i in range(0, len(words), self.chunk_words):
+            piece = " ".join(words[i:i + self.chunk_words]) + ("" if i + self.chunk_words >= len(words) else " ")
+            self.wfile.write(b"data: " + self._candidate(piece) + b"\r\n\r\n")
+            self.wfile.flush()
+            time.sleep(self.chunk_ms / 1000)
+
+
+class ElevenLabsHandler(_Handler):
+    # Seconds of audio per character of text (about 15 chars/s of speech)
+    seconds_per_char = 0.065
+
+    def service_request(self, body):
+        delay, error = self.service.admit()
+        try:
+            time.sleep(delay)
+            if error:
+                self._error(error)
+                return
+            text = body.get("text", "")
+            self._send(200, mp3_audio(len(text) * self.seconds_per_char), "audio/mpeg")
+        finally:
+            self.service.done()
+
+
+def serve(handler: type, service: FakeService, port: int = 0, host: str = "127.0.0.1", **settings) -> ThreadingHTTPServer:
+    """Start a fake in a background thread. Its URL is server.url."""
+    cls = type(handler.__name__, (handler,), {"service": service, **settings})
+    server = ThreadingHTTPServer((host, port), cls)
+    server.daemon_threads = True
+    server.url = f"http://{host}:{server.server_address[1]}"
+    threading.Thread(target=server.serve_forever, name=f"fake-{service.name}", daemon=True).start()
+    return server
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--gemini-median-ms", type=float, default=800)
+    parser.add_argument("--gemini-p99-ms", type=float, default=3000)
+    parser.add_argument("--gemini-error-rate", type=float, default=0.01)
+    parser.add_argument("--gemini-capacity", type=int, default=200, help="Requests at once before 429s")
+    parser.add_argument("--reply-words", type=int, default=40)
+    parser.add_argument("--tts-median-ms", type=float, default=400)
+    parser.add_argument("--tts-p99-ms", type=float, default=1500)
+    parser.add_argument("--tts-error-rate", type=float, default=0.01)
+    parser.add_argument("--tts-capacity", type=int, default=100)
+    parser.add_argument("--audio-seconds-per-char", type=float, default=0.065, help="Sets the audio size (128 kbps)")
+    parser.add_argument("--song", default="anthem", help="Song name fake Gemini asks for when the user says 'sing'")
+
+
+def start_from_args(args, gemini_port: int = 0, elevenlabs_port: int = 0):
+    gemini = serve(GeminiHandler, FakeService("gemini", args.gemini_median_ms, args.gemini_p99_ms,
+                                              args.gemini_error_rate, args.gemini_capacity, seed=7),
+                   gemini_port, reply_words=args.reply_words, song=args.song)
+    elevenlabs = serve(ElevenLabsHandler, FakeService("elevenlabs", args.tts_median_ms, args.tts_p99_ms,
+                                                      args.tts_error_rate, args.tts_capacity, seed=11),
+                       elevenlabs_port, seconds_per_char=args.audio_seconds_per_char)
+    return gemini, elevenlabs
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run fake Gemini and ElevenLabs servers")
+    parser.add_argument("--gemini-port", type=int, default=9001)
+    parser.add_argument("--elevenlabs-port", type=int, default=9002)
+    add_arguments(parser)
+    args = parser.parse_args(argv)
+    gemini, elevenlabs = start_from_args(args, args.gemini_port, args.elevenlabs_port)
+    print(f"GEMINI_BASE_URL={gemini.url}")
+    print(f"ELEVENLABS_BASE_URL={elevenlabs.url}")
+    sys.stdout.flush()
+    try:
+        while True:
+            time.sleep(10)
+            print(json.dumps({"gemini": gemini.RequestHandlerClass.service.stats(),
+                              "elevenlabs": elevenlabs.RequestHandlerClass.service.stats()}))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
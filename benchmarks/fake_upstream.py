@@ -0,0 +1,162 @@
+# Author: Steven Lansangan
+# Fake upstream for exercising utils/upstream.py without Gemini or ElevenLabs
+# Injects latency (with a slow tail), errors, overload (429) and outages,
+# then reports how the limiter / retries / hedging / breaker coped.
+#
+#   python -m benchmarks.fake_upstream --calls 2000 --concurrency 100 --error-rate 0.05
+#   python -m benchmarks.fake_upstream --outage 2:4 --hedge
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import threading
+from typing import Any, Dict, List, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import upstream  # noqa: E402
+from benchmarks.bench_memory import _percentile  # noqa: E402
+
+
+class FakeError(Exception):
+    """Looks like an SDK error: carries an HTTP status in .code"""
+
+    def __init__(self, code: int):
+        super().__init__(f"fake upstream returned {code}")
+        self.code = code
+
+
+class FakeUpstream:
+    """
+    Behaves like a remote API with a fixed capacity:
+    - latency_ms (+ up to jitter_ms), with slow_rate of calls taking slow_ms instead
+    - error_rate of calls failing with a 500
+    - more than `capacity` calls at once get a 429
+    - during the outage window (seconds since start) every call fails with a 503
+    """
+
+    def __init__(self, latency_ms: float = 50, jitter_ms: float = 20, slow_rate: float = 0.02,
+                 slow_ms: float = 1000, error_rate: float = 0.0, capacity: int = 50, outage=None, seed: int = 3):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.slow_rate = slow_rate
+        self.slow_ms = slow_ms
+        self.error_rate = error_rate
+        self.capacity = capacity
+        self.outage = outage
+        self.rng = random.Random(seed)
+        self.started = time.monotonic()
+        self.in_flight = 0
+        self.peak = 0
+        self.received = 0
+        self._lock = threading.Lock()
+
+    def _plan(self):
+        with self._lock:
+            self.received += 1
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+            overloaded = self.in_flight > self.capacity
+            r = self.rng.random()
+            slow = self.rng.random() < self.slow_rate
+            jitter = self.rng.random() * self.jitter_ms
+        elapsed = time.monotonic() - self.started
+        if self.outage and self.outage[0] <= elapsed < self.outage[1]:
+            return 0.005, 503
+        if overloaded:
+            return 0.005, 429
+        delay = (self.slow_ms if slow else self.latency_ms + jitter) / 1000
+        return delay, (500 if r < self.error_rate else None)
+
+    def _done(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    async def call_async(self) -> str:
+        delay, error = self._plan()
+        try:
+            await asyncio.sleep(delay)
+            if error:
+                raise FakeError(error)
+            return "ok"
+        finally:
+            self._done()
+
+    def call(self, timeout: Optional[float] = None) -> str:
+        # Upstream.call hands over the attempt's budget, like the SDKs' request timeout
+        delay, error = self._plan()
+        try:
+            if timeout is not None and delay > timeout:
+                time.sleep(timeout)
+                raise TimeoutError(f"fake upstream took longer than {timeout:.2f}s")
+            time.sleep(delay)
+            if error:
+                raise FakeError(error)
+            return "ok"
+        finally:
+            self._done()
+
+
+async def run_scenario(fake: FakeUpstream, up: upstream.Upstream, calls: int, concurrency: int,
+                       request_deadline: float) -> Dict[str, Any]:
+    latencies: List[float] = []
+    outcomes: Dict[str, int] = {}
+    sem = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with sem:
+            t0 = time.monotonic()
+            with upstream.deadline(request_deadline):
+                try:
+                    await up.call_async(fake.call_async)
+                    outcome = "ok"
+                except Exception as e:
+                    outcome = type(e).__name__ if not isinstance(e, FakeError) else f"http_{e.code}"
+            latencies.append(time.monotonic() - t0)
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+
+    started = time.monotonic()
+    await asyncio.gather(*(one() for _ in range(calls)))
+    wall = time.monotonic() - started
+    latencies.sort()
+    return {
+        "calls": calls,
+        "wall_s": round(wall, 2),
+        "success_rate": round(outcomes.get("ok", 0) / calls, 4),
+        "outcomes": outcomes,
+        "p50_ms": round(_percentile(latencies, 50) * 1000, 1),
+        "p99_ms": round(_percentile(latencies, 99) * 1000, 1),
+        "upstream_received": fake.received,
+        "upstream_peak_in_flight": fake.peak,
+        "client": up.stats(),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run utils.upstream against a fake, misbehaving upstream")
+    parser.add_argument("--calls", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=100, help="Callers at once")
+    parser.add_argument("--capacity", type=int, default=40, help="Calls the fake serves at once before 429s")
+    parser.add_argument("--latency-ms", type=float, default=50)
+    parser.add_argument("--slow-rate", type=float, default=0.02, help="Share of calls in the slow tail")
+    parser.add_argument("--slow-ms", type=float, default=1000)
+    parser.add_argument("--error-rate", type=float, default=0.02, help="Share of calls failing with a 500")
+    parser.add_argument("--outage", default=None, help="start:end seconds during which everything 503s")
+    parser.add_argument("--deadline", type=float, default=10.0, help="Per-request deadline in seconds")
+    parser.add_argument("--hedge", action="store_true")
+    parser.add_argument("--timeout", type=float, default=5.0, help="Per-attempt timeout")
+    args = parser.parse_args(argv)
+
+    outage = tuple(float(x) for x in args.outage.split(":")) if args.outage else None
+    fake = FakeUpstream(latency_ms=args.latency_ms, slow_rate=args.slow_rate, slow_ms=args.slow_ms,
+                        error_rate=args.error_rate, capacity=args.capacity, outage=outage)
+    up = upstream.Upstream("fake", timeout=args.timeout, hedge=args.hedge, breaker_cooldown=1.0)
+    report = asyncio.run(run_scenario(fake, up, args.calls, args.concurrency, args.deadline))
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,293 @@
+# Author: Steven Lansangan
+# End-to-end load test: the real API (api.py under uvicorn) against fake Gemini/ElevenLabs
+# Starts the fakes from benchmarks/fake_services.py, runs api:app in a subprocess
+# pointed at them (throwaway DB and caches in a temp dir), then lets N simulated
+# users loose with a mix of chat, speak and jukebox turns. Reports throughput,
+# latency percentiles and error rates per turn kind, plus the server's own
+# /v1/stats and fallback counters, as JSON.
+#
+#   python -m benchmarks.load_test --users 50 --duration 60
+#   python -m benchmarks.load_test --users 200 --mix chat=6,speak=3,jukebox=1 --gemini-error-rate 0.05
+#   python -m benchmarks.load_test --url http://localhost:8000 --users 20   (an already running server)
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+import http.client
+from urllib.parse import urlparse
+from typing import Any, Dict, List, Optional, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks import fake_services  # noqa: E402
+from benchmarks.bench_memory import _percentile  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MESSAGES = [
+    "I skipped the gym again.",
+    "What should I do today?",
+    "I finished my landing page draft!",
+    "Motivate me, I'm tired.",
+    "I'll start tomorrow, promise.",
+]
+SPEAK_LINES = [
+    "Welcome back, you absolute legend of procrastination.",
+    "Twenty minutes. That's all I'm asking.",
+    "Mission complete. I'm almost proud.",
+]
+
+
+def parse_mix(value: str) -> List[Tuple[str, float]]:
+    mix = []
+    for part in value.split(","):
+        kind, _, weight = part.partition("=")
+        if kind not in ("chat", "speak", "jukebox"):
+            raise argparse.ArgumentTypeError(f"unknown turn kind: {kind}")
+        mix.append((kind, float(weight or 1)))
+    return mix
+
+
+class Results:
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = {}
+        self.statuses: Dict[str, Dict[str, int]] = {}
+        self.bytes = 0
+        self._lock = threading.Lock()
+
+    def add(self, kind: str, seconds: float, status: str, size: int = 0):
+        with self._lock:
+            self.statuses.setdefault(kind, {})
+            self.statuses[kind][status] = self.statuses[kind].get(status, 0) + 1
+            if status == "200":
+                self.latencies.setdefault(kind, []).append(seconds)
+            self.bytes += size
+
+    def report(self, wall: float) -> Dict[str, Any]:
+        kinds = {}
+        total = ok = 0
+        for kind, statuses in sorted(self.statuses.items()):
+            count = sum(statuses.values())
+            done = statuses.get("200", 0)
+            lat = sorted(self.latencies.get(kind, []))
+            total += count
+            ok += done
+            kinds[kind] = {
+                "requests": count,
+                "throughput_rps": round(count / wall, 2),
+                "error_rate": round(1 - done / count, 4) if count else 0.0,
+                "statuses": statuses,
+                "p50_ms": round(_percentile(lat, 50) * 1000, 1) if lat else None,
+                "p90_ms": round(_percentile(lat, 90) * 1000, 1) if lat else None,
+                "p99_ms": round(_percentile(lat, 99) * 1000, 1) if lat else None,
+                "max_ms": round(lat[-1] * 1000, 1) if lat else None,
+            }
+        return {
+            "wall_s": round(wall, 2),
+            "requests": total,
+            "throughput_rps": round(total / wall, 2) if wall else 0.0,
+            "error_rate": round(1 - ok / total, 4) if total else 0.0,
+            "received_mb": round(self.bytes / 1e6, 2),
+            "by_kind": kinds,
+        }
+
+
+class User(threading.Thread):
+    """One simulated user: a keep-alive connection, turns one after another with think time."""
+
+    def __init__(self, index: int, base: str, mix, results: Results, stop_at: float, think_ms: float,
+                 audio_mode: Optional[str], timeout: float, seed: int):
+        super().__init__(daemon=True)
+        self.user_id = f"load_user_{index}"
+        self.url = urlparse(base)
+        self.mix = mix
+        self.results = results
+        self.stop_at = stop_at
+        self.think = think_ms / 1000
+        self.audio_mode = audio_mode
+        self.timeout = timeout
+        self.rng = random.Random(seed + index)
+        self.conn = None
+
+    def _connect(self):
+        self.conn = http.client.HTTPConnection(self.url.hostname, self.url.port or 80, timeout=self.timeout)
+
+    def _post(self, path: str, payload: Dict[str, Any]) -> Tuple[int, int]:
+        if self.audio_mode:
+            path += f"?audio={self.audio_mode}"
+        if self.conn is None:
+            self._connect()
+        try:
+            self.conn.request("POST", path, body=json.dumps(payload).encode(), headers={"Content-Type": "application/json"})
+            response = self.conn.getresponse()
+            body = response.read()
+            return response.status, len(body)
+        except Exception:
+            self.conn.close()
+            self.conn = None
+            raise
+
+    def turn(self, kind: str) -> Tuple[int, int]:
+        if kind == "speak":
+            return self._post("/v1/speak", {"text": self.rng.choice(SPEAK_LINES)})
+        message = "Sing me something." if kind == "jukebox" else self.rng.choice(MESSAGES)
+        return self._post("/v1/chat", {"user_id": self.user_id, "message": message})
+
+    def run(self):
+        kinds, weights = zip(*self.mix)
+        # Spread the start so everyone doesn't arrive in the same millisecond
+        time.sleep(self.rng.random() * self.think)
+        while time.monotonic() < self.stop_at:
+            kind = self.rng.choices(kinds, weights)[0]
+            started = time.monotonic()
+            try:
+                status, size = self.turn(kind)
+                self.results.add(kind, time.monotonic() - started, str(status), size)
+            except Exception as e:
+                self.results.add(kind, time.monotonic() - started, type(e).__name__)
+            if self.think:
+                time.sleep(self.rng.expovariate(1 / self.think))
+
+
+def _get_json(base: str, path: str) -> Any:
+    url = urlparse(base)
+    conn = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=10)
+    try:
+        conn.request("GET", path)
+        response = conn.getresponse()
+        body = response.read()
+        return json.loads(body) if path != "/metrics" else body.decode()
+    finally:
+        conn.close()
+
+
+def _fallbacks(metrics_text: str) -> Dict[str, float]:
+    counts = {}
+    for line in metrics_text.splitlines():
+        if line.startswith("babaru_fallbacks_total{"):
+            labels, value = line.rsplit(" ", 1)
+            counts[labels.split('"')[1]] = float(value)
+    return counts
+
+
+def start_api(args, workdir: str, gemini_url: str, elevenlabs_url: str) -> Tuple[subprocess.Popen, str]:
+    songs = os.path.join(workdir, "songs")
+    os.makedirs(songs, exist_ok=True)
+    with open(os.path.join(songs, f"{args.song}.mp3"), "wb") as f:
+        f.write(fake_services.mp3_audio(args.song_seconds))
+
+    env = dict(os.environ)
+    env.update({
+        "PYTHONPATH": ROOT + os.pathsep + env.get("PYTHONPATH", ""),
+        "GOOGLE_API_KEY": "fake",
+        "ELEVENLABS_API_KEY": "fake",
+        "GEMINI_BASE_URL": gemini_url,
+        "ELEVENLABS_BASE_URL": elevenlabs_url,
+        "BABARU_SONGS_DIR": songs,
+        "BABARU_TTS_CACHE_DIR": os.path.join(workdir, "tts_cache"),
+        "BABARU_AUDIO_STORE_DIR": os.path.join(workdir, "audio_store"),
+        "BABARU_PROMPT_CACHE": args.prompt_cache,
+    })
+    if not args.tts_cache:
+        env.update({"BABARU_TTS_CACHE_DISK_MB": "0", "BABARU_TTS_CACHE_MEMORY_MB": "0"})
+    log = open(os.path.join(workdir, "api.log"), "wb")
+    # cwd is the temp dir, so babaru.db and friends land there
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "api:app", "--host", "127.0.0.1", "--port", str(args.port), "--log-level", "warning"],
+        cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT,
+    )
+    base = f"http://127.0.0.1:{args.port}"
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"API exited during startup, see {log.name}")
+        try:
+            _get_json(base, "/")
+            return proc, base
+        except Exception:
+            time.sleep(0.2)
+    proc.terminate()
+    raise RuntimeError(f"API didn't come up within 60s, see {log.name}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test the Babaru API against fake upstreams")
+    parser.add_argument("--users", type=int, default=50, help="Simulated users at once")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds to keep them going")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("chat=6,speak=3,jukebox=1"),
+                        help="Turn kinds and weights, e.g. chat=6,speak=3,jukebox=1")
+    parser.add_argument("--think-ms", type=float, default=1000, help="Mean pause between a user's turns")
+    parser.add_argument("--audio", default=None, help="Audio delivery mode to ask for (base64, ref, multipart, mpeg)")
+    parser.add_argument("--timeout", type=float, default=90, help="Client-side timeout per request")
+    parser.add_argument("--url", default=None, help="Test this running server instead of starting one (run benchmarks.fake_services for it yourself)")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--song-seconds", type=float, default=20)
+    parser.add_argument("--tts-cache", action="store_true", help="Keep the TTS cache on (off by default so ElevenLabs is hit every time)")
+    parser.add_argument("--prompt-cache", default="gemini", help="BABARU_PROMPT_CACHE for the server (gemini or off)")
+    parser.add_argument("--keep", action="store_true", help="Keep the temp dir (DB, caches, api.log)")
+    parser.add_argument("--out", default=None, help="Also write the report here")
+    parser.add_argument("--seed", type=int, default=1)
+    fake_services.add_arguments(parser)
+    args = parser.parse_args(argv)
+
+    gemini = elevenlabs = None
+    if not args.url:
+        gemini, elevenlabs = fake_services.start_from_args(args)
+    workdir = tempfile.mkdtemp(prefix="babaru_load_")
+    proc = None
+    try:
+        if args.url:
+            base = args.url.rstrip("/")
+        else:
+            proc, base = start_api(args, workdir, gemini.url, elevenlabs.url)
+
+        results = Results()
+        started = time.monotonic()
+        users = [User(i, base, args.mix, results, started + args.duration, args.think_ms, args.audio,
+                      args.timeout, args.seed) for i in range(args.users)]
+        for user in users:
+            user.start()
+        for user in users:
+            user.join()
+        wall = time.monotonic() - started
+
+        report = {
+            "config": {"users": args.users, "duration_s": args.duration, "mix": dict(args.mix),
+                       "think_ms": args.think_ms, "audio": args.audio or "base64"},
+            **results.report(wall),
+        }
+        if gemini:
+            report["upstreams"] = {"gemini": gemini.RequestHandlerClass.service.stats(),
+                                   "elevenlabs": elevenlabs.RequestHandlerClass.service.stats()}
+        try:
+            report["server"] = _get_json(base, "/v1/stats")
+            report["fallbacks"] = _fallbacks(_get_json(base, "/metrics"))
+        except Exception as e:
+            report["server"] = f"unavailable: {e}"
+    finally:
+        if proc:
+            proc.terminate()
+            proc.wait(timeout=30)
+        for fake in (gemini, elevenlabs):
+            if fake:
+                fake.shutdown()
+        if args.keep:
+            print(f"Kept {workdir}", file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text)
+
+
+if __name__ == "__main__":
+    main()
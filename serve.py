@@ -0,0 +1,96 @@
+# Author: Steven Lansangan
+# Production entry point: N uvicorn worker processes behind one port
+# api.py on its own is one process, so mixing, base64 and JSON parsing all
+# fight over one core. This runs --workers (BABARU_WORKERS) of them instead.
+# Before forking, the parent does the one-time work every worker would
+# otherwise race to do: DB schema, normalizing songs into the shared .frames
+# files, registering the Gemini prompt cache, rendering the TTS prewarm list.
+# Each worker then warms its own clients before it accepts a connection.
+#
+# What's shared between workers (all on disk, the page cache keeps it hot):
+# - TTS audio disk tier (.tts_cache), every worker reads what any of them rendered,
+#   and they share its budget (rescanned and evicted under a file lock)
+# - Song frames (.tts_cache/songs/*.frames), memory-mapped, so one copy for the box
+# - Audio refs (audio_store), so ?audio=ref URLs work whichever worker gets the GET
+# - SQLite (WAL) and the post-turn job queue in it
+# What isn't: the per-user mailboxes. A user's turns are only queued in order
+# inside one worker, two workers can run the same user's turns side by side.
+# That's why it's one worker unless you ask for more: then route each user to
+# the same worker at the proxy (hash on user_id) if turn order matters to you.
+# The post-turn queue still applies each user's writes once and in order.
+#
+#   python serve.py                 # one worker, port from $PORT (8000)
+#   python serve.py --workers 4 --port 9000
+import os
+import sys
+import time
+import argparse
+import logging
+import threading
+
+from utils import warmup
+
+logger = logging.getLogger("Serve")
+
+
+def _shared_settings(workers: int):
+    # Has to happen before utils/* is imported, they read their settings on import
+    if workers > 1:
+        # Each worker would keep its own copy, and a write in one never reaches the others
+        os.environ.setdefault("BABARU_MEMORY_CACHE_SIZE", "0")
+    # Workers finish warming before startup returns, so they only take traffic warm
+    os.environ["BABARU_WARM_BEFORE_SERVE"] = "1"
+
+
+def prefork_warm(tts_prewarm: bool = True):
+    """The one-time, disk-backed work, done once here instead of once per worker."""
+    t0 = time.perf_counter()
+    from utils import memory_manager, voice_manager
+    from backend import babaru_brain
+
+    memory_manager.init_db()
+    try:
+        # Writes the normalized song + .frames files the workers map
+        voice_manager.songs.get()
+    except Exception as e:
+        logger.error(f"Jukebox warm-up failed: {e}")
+    try:
+        prefix_cache = babaru_brain.get_prefix_cache()
+        if prefix_cache:
+            # Workers find this one by display name instead of each creating their own
+            prefix_cache.get_name()
+    except Exception as e:
+        logger.error(f"Prompt cache warm-up failed: {e}")
+
+    phrases = os.environ.pop("BABARU_TTS_PREWARM", None)
+    if tts_prewarm and phrases and os.path.exists(phrases):
+        from utils import tts_cache
+        # Rendered once into the shared disk cache, workers pick the clips up as they land
+        threading.Thread(target=voice_manager.prewarm, args=(list(tts_cache.read_phrases(phrases)),),
+                         name="tts-prewarm", daemon=True).start()
+    logger.info(f"Pre-fork warm-up done in {time.perf_counter() - t0:.1f}s")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the Babaru API with several worker processes")
+    parser.add_argument("--workers", type=int, default=int(os.getenv("BABARU_WORKERS", "1")),
+                        help="Worker processes (default: BABARU_WORKERS or 1, more than one needs routing by user for turn order)")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "8000")))
+    parser.add_argument("--no-prefork-warm", action="store_true", help="Skip the parent's warm-up, workers do it all")
+    args = parser.parse_args(argv)
+
+    warmup.configure()
+    _shared_settings(args.workers)
+    if not args.no_prefork_warm:
+        prefork_warm()
+
+    import uvicorn
+    if args.workers > 1:
+        logger.warning(f"{args.workers} workers: a user's turns are only kept in order within one worker, route by user_id at the proxy.")
+    logger.info(f"Starting {args.workers} workers on {args.host}:{args.port}")
+    uvicorn.run("api:app", host=args.host, port=args.port, workers=args.workers)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,18 @@
+# Author: Steven Lansangan
+# Shared fixtures: a fresh SQLite file (and memory cache) per test, never the real babaru.db
+import pytest
+
+from utils import db_pool, memory_manager
+from utils.memory_cache import MemoryCache
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """memory_manager pointed at an empty database in tmp_path. Returns the base path."""
+    path = str(tmp_path / "babaru.db")
+    monkeypatch.setattr(memory_manager, "DB_PATH", path)
+    monkeypatch.setattr(memory_manager, "SHARD_COUNT", 1)
+    monkeypatch.setattr(memory_manager, "memory_cache", MemoryCache())
+    memory_manager.init_db()
+    yield path
+    db_pool.close_all()
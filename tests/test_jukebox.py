@@ -0,0 +1,99 @@
+# Author: Steven Lansangan
+# MP3 frame parsing and splicing on hand-built frames: tags and the Xing
+# header are left out, clips in the song's format are glued frame by frame
+# and anything else is refused (the caller falls back to ffmpeg)
+from utils import jukebox
+from utils.jukebox import SongRegistry, audio_frames, join_clips, parse_frames
+
+# MPEG-1 Layer III, 128 kbps, 44.1 kHz, mono: 417 bytes a frame (418 padded)
+HEADER = b"\xff\xfb\x90\xc4"
+PADDED = b"\xff\xfb\x92\xc4"
+FORMAT = (3, 44100, 1)
+# Same but 48 kHz, doesn't splice with the above
+OTHER = b"\xff\xfb\x94\xc4"
+
+ID3 = b"ID3\x03\x00\x00\x00\x00\x00\x08" + b"\xff\xfb\x90\xc4tag!"
+ID3V1 = b"TAG" + b"\x00" * 125
+
+
+def frame(fill: int, header: bytes = HEADER) -> bytes:
+    length, _ = jukebox._frame_header(header, 0)
+    return header + bytes([fill]) * (length - 4)
+
+
+def xing() -> bytes:
+    return HEADER + (b"\x00" * 32 + b"Xing").ljust(413, b"\x00")
+
+
+def clip(*fills: int, header: bytes = HEADER) -> bytes:
+    """A file the way an encoder writes it: ID3 tag, Xing frame, audio, ID3v1 tag."""
+    return ID3 + xing() + b"".join(frame(f, header) for f in fills) + ID3V1
+
+
+def test_frames_without_tags_or_xing():
+    data = clip(1, 2, 3)
+    fmt, frames = parse_frames(data)
+    assert fmt == FORMAT
+    assert len(frames) == 3
+    assert [data[s] for s, _ in frames] == [0xFF] * 3
+    assert audio_frames(data)[1] == frame(1) + frame(2) + frame(3)
+
+
+def test_padded_frames_are_one_byte_longer():
+    data = frame(1, PADDED) + frame(2)
+    _, frames = parse_frames(data)
+    assert [e - s for s, e in frames] == [418, 417]
+
+
+def test_stray_sync_bytes_are_not_frames():
+    # 0xFF 0xFB inside the audio data isn't followed by another frame, so it's skipped
+    data = b"\x00\xff\xfb\x90" + frame(1) + frame(2)
+    _, frames = parse_frames(data)
+    assert len(frames) == 2
+
+
+def test_mixed_formats_have_no_format():
+    fmt, frames = parse_frames(frame(1) + frame(2, OTHER))
+    assert fmt is None
+    assert len(frames) == 2
+
+
+def test_join_clips_drops_the_headers_in_the_middle():
+    joined = join_clips([clip(1, 2), clip(3)])
+    assert joined == frame(1) + frame(2) + frame(3)
+    assert b"Xing" not in joined and b"TAG" not in joined
+    assert join_clips([clip(1), clip(2, header=OTHER)]) is None
+    assert join_clips([clip(1), b"not audio"]) is None
+
+
+def registry(tmp_path) -> SongRegistry:
+    songs = tmp_path / "songs"
+    songs.mkdir(exist_ok=True)
+    (songs / "Victory.mp3").write_bytes(clip(7, 7, 7, 7))
+    reg = SongRegistry("mp3_44100_128", songs_dir=str(songs), channels=1, normalized_dir=str(tmp_path / "cache"))
+    reg.load()
+    return reg
+
+
+def test_songs_load_as_frames(tmp_path):
+    song = registry(tmp_path).get("victory")
+    assert song.format == FORMAT
+    assert song.frames == 4
+    assert bytes(song.audio) == frame(7) * 4
+    assert round(song.duration_s, 3) == round(4 * 1152 / 44100, 3)
+    # Kept as a .frames file for the next process to map
+    assert list((tmp_path / "cache").glob("*.frames"))
+
+
+def test_splice_glues_intro_song_outro(tmp_path):
+    reg = registry(tmp_path)
+    song = reg.get("victory")
+    assert reg.splice(clip(1), song, clip(2)) == frame(1) + frame(7) * 4 + frame(2)
+    assert reg.splice(None, song, clip(2)) == frame(7) * 4 + frame(2)
+    assert reg.spliced == 2
+
+
+def test_splice_refuses_other_formats(tmp_path):
+    reg = registry(tmp_path)
+    assert reg.splice(clip(1, header=OTHER), reg.get("victory"), None) is None
+    assert reg.spliced == 0
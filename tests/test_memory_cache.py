@@ -0,0 +1,104 @@
+# Author: Steven Lansangan
+# MemoryCache: a load that raced a write is never cached, and a snapshot is
+# only changed once the write it mirrors has committed
+import time
+
+import pytest
+
+from utils import memory_manager
+from utils.memory_cache import MemoryCache
+
+
+def add_points(mem):
+    return {**mem, "points": mem["points"] + 1}
+
+
+def test_load_is_cached_and_served():
+    cache = MemoryCache()
+    cache.begin_load("u1")
+    cache.put("u1", {"points": 0})
+    assert cache.get("u1") == {"points": 0}
+    assert (cache.hits, cache.misses) == (1, 0)
+
+
+def test_a_load_that_raced_a_write_is_not_cached():
+    cache = MemoryCache()
+    cache.begin_load("u1")
+    # The write lands while the snapshot is being read, the snapshot may be from before it
+    cache.begin_write("u1")
+    cache.end_write("u1", add_points)
+    cache.put("u1", {"points": 0})
+    assert cache.get("u1") is None
+
+
+def test_only_the_loads_running_during_the_write_are_stale():
+    cache = MemoryCache()
+    cache.begin_load("u1")
+    cache.begin_write("u1")
+    cache.end_write("u1", add_points)
+    cache.put("u1", {"points": 0})
+    # A load that starts afterwards reads the committed state, that one is fine
+    cache.begin_load("u1")
+    cache.put("u1", {"points": 1})
+    assert cache.get("u1") == {"points": 1}
+
+
+def test_nothing_is_served_or_cached_while_a_write_is_open():
+    cache = MemoryCache()
+    cache.put("u1", {"points": 0}, loaded=False)
+    cache.begin_write("u1")
+    assert cache.get("u1") is None
+    cache.begin_load("u1")
+    cache.put("u1", {"points": 5})
+    cache.end_write("u1", add_points)
+    # The entry from before the write got the write, the load that overlapped it didn't replace it
+    assert cache.get("u1") == {"points": 1}
+
+
+def test_a_rolled_back_write_drops_the_entry():
+    cache = MemoryCache()
+    cache.put("u1", {"points": 0}, loaded=False)
+    cache.begin_write("u1")
+    cache.end_write("u1")
+    assert cache.get("u1") is None
+
+
+def test_a_failing_update_drops_the_entry():
+    cache = MemoryCache()
+    cache.put("u1", {"points": 0}, loaded=False)
+    cache.begin_write("u1")
+    cache.end_write("u1", lambda mem: mem["missing"])
+    assert cache.get("u1") is None
+
+
+def test_lru_and_ttl():
+    cache = MemoryCache(max_entries=2, ttl=0.05)
+    for user_id in ("a", "b", "c"):
+        cache.put(user_id, {"points": 0}, loaded=False)
+    assert cache.get("a") is None
+    assert cache.evictions == 1
+    time.sleep(0.06)
+    assert cache.get("c") is None
+    assert cache.expirations == 1
+
+
+# --- Through memory_manager ---
+def test_writes_update_the_cached_snapshot(db):
+    memory_manager.create_user("u1", "Tester")
+    memory_manager.get_user_memory("u1")
+    memory_manager.update_progression("u1", {"points": 7})
+    assert memory_manager.memory_cache.get("u1")["progression"]["points"] == 7
+
+
+def test_a_failed_write_leaves_no_cached_snapshot(db, monkeypatch):
+    memory_manager.create_user("u1", "Tester")
+    memory_manager.get_user_memory("u1")
+
+    def broken(conn, user_id, updates):
+        raise RuntimeError("disk full")
+
+    monkeypatch.setattr(memory_manager, "_apply_progression", broken)
+    with pytest.raises(RuntimeError):
+        memory_manager.update_progression("u1", {"points": 7})
+    assert memory_manager.memory_cache.get("u1") is None
+    assert memory_manager.get_user_memory("u1")["progression"]["points"] == 0
@@ -0,0 +1,103 @@
+# Author: Steven Lansangan
+# NDJSON export/import: a dump loads back into an empty database as the same
+# users (messages, summary position, queued turns, nudges, scheduler marks),
+# and the reader streams a user's messages instead of loading the line whole
+import io
+import json
+
+import pytest
+
+from utils import memory_manager, memory_transfer
+
+
+def populate():
+    memory_manager.create_user("u1", "Ana", "Asia/Manila")
+    memory_manager.create_user("u2", "Ben", "Europe/Berlin")
+    for i in range(30):
+        # Quotes, commas and the messages key itself inside the text must not confuse the reader
+        memory_manager.update_conversation_history("u1", {"role": "user", "content": f'line {i}, "messages": [ünï]'})
+    covered = memory_manager.get_unsummarized_messages("u1", 0, keep_recent=10, limit=200)
+    memory_manager.save_summary("u1", "Ana wants to run a 5k.", covered[-1]["id"])
+    memory_manager.update_progression("u2", {"points": 42})
+    memory_manager.enqueue_turn_job("u2", {"user_input": "hi", "ai_reply": "yo", "turn_at": 1.0})
+    claimed = memory_manager.claim_nudges("morning", [("u2", "2026-01-01")])
+    memory_manager.finish_nudge("u2", claimed["u2"], "Rise and shine.")
+    memory_manager.set_mark("morning:Asia/Manila", "2026-01-01")
+
+
+def export() -> str:
+    out = io.StringIO()
+    memory_transfer.export_ndjson(out)
+    return out.getvalue()
+
+
+def fresh_db(tmp_path, monkeypatch, name: str):
+    monkeypatch.setattr(memory_manager, "DB_PATH", str(tmp_path / name))
+    memory_manager.init_db()
+
+
+def test_round_trip(db, tmp_path, monkeypatch):
+    populate()
+    dump = export()
+    assert dump.count("\n") == 3  # scheduler marks + two users
+
+    fresh_db(tmp_path, monkeypatch, "restored.db")
+    assert memory_transfer.import_ndjson(io.StringIO(dump)) == 2
+    assert export() == dump
+
+    u1 = memory_manager.get_user_memory("u1")
+    assert u1["identity"]["timezone"] == "Asia/Manila"
+    assert len(u1["conversations"]) == 30
+    assert u1["summary"] == "Ana wants to run a 5k."
+    # summarized_until points at the new id of the same message
+    assert u1["unsummarized"] == 10
+    assert memory_manager.get_user_memory("u2")["progression"]["points"] == 42
+    assert len(memory_manager.user_turn_jobs("u2")) == 1
+    assert [n["response"] for n in memory_manager.take_nudges("u2", 0)] == ["Rise and shine."]
+    assert memory_manager.get_mark("morning:Asia/Manila") == "2026-01-01"
+    assert sorted(memory_manager.timezones(0)) == ["Asia/Manila", "Europe/Berlin"]
+
+
+def test_import_streams_in_small_reads(db, tmp_path, monkeypatch):
+    populate()
+    dump = export()
+    fresh_db(tmp_path, monkeypatch, "restored.db")
+    # Far smaller than one line, the messages have to come out one by one
+    monkeypatch.setattr(memory_transfer, "READ_CHUNK", 7)
+    monkeypatch.setattr(memory_transfer, "MESSAGE_CHUNK", 4)
+    monkeypatch.setattr(memory_transfer, "IMPORT_ROWS", 5)
+    assert memory_transfer.import_ndjson(io.StringIO(dump)) == 2
+    assert export() == dump
+
+
+def test_read_users_hands_out_messages_lazily():
+    line = json.dumps({"user_id": "u1", "use_identity": {"name": "Ana"}}, ensure_ascii=False)
+    messages = [{"role": "user", "content": f"m{i}"} for i in range(3)]
+    text = line[:-1] + ', "messages": [' + ", ".join(json.dumps(m) for m in messages) + "]}\n"
+    # Plus a line written by something else (messages not last), and blank lines
+    other = json.dumps({"messages": messages[:1], "user_id": "u2"})
+    users = memory_transfer.read_users(io.StringIO(text + "\n" + other + "\n\n"))
+
+    user, stream = next(users)
+    assert user == {"user_id": "u1", "use_identity": {"name": "Ana"}}
+    assert next(stream) == messages[0]
+    # Moving on without reading the rest is fine, they're skipped
+    user, stream = next(users)
+    assert user == {"user_id": "u2"}
+    assert list(stream) == messages[:1]
+    assert next(users, None) is None
+
+
+def test_bad_lines_name_the_line(db):
+    good = '{"user_id": "u1", "messages": []}\n'
+    with pytest.raises(ValueError, match="line 2"):
+        memory_transfer.import_ndjson(io.StringIO(good + '{"user_id": "u2", "messages": [{"role": "user"\n'))
+    with pytest.raises(ValueError, match="line 1"):
+        memory_transfer.import_ndjson(io.StringIO("{not json\n"))
+
+
+def test_a_failed_import_rolls_back_what_it_has_not_committed(db):
+    dump = '{"user_id": "u1", "use_identity": {"name": "Ana", "timezone": "UTC"}, "messages": [{"role": "user", "content": "hi"}, oops]}\n'
+    with pytest.raises(ValueError):
+        memory_transfer.import_ndjson(io.StringIO(dump))
+    assert memory_manager.get_user_memory("u1") == {}
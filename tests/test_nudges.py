@@ -0,0 +1,144 @@
+# Author: Steven Lansangan
+# Nudge claiming: every (user, kind, key) is generated once no matter how many
+# schedulers try, a failed one gives its claim back for a retry, and the silent
+# watermark / morning mark only move past nudges that actually went out
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from utils import memory_manager
+from backend import nudges
+
+SILENCE = "2026-01-01 00:00:00"
+
+
+@pytest.fixture
+def gemini(monkeypatch):
+    """Fake batch.run: replies for everyone except the users in .failing. Records who was asked."""
+    asked = []
+    failing = set()
+
+    async def run(items, render, **kwargs):
+        for item in items:
+            await asyncio.sleep(0)
+            asked.append(item["user_id"])
+            ok = item["user_id"] not in failing
+            yield {"user_id": item["user_id"], "response": f"Hey {item['user_id']}" if ok else "[SYSTEM ERROR] quota"}
+        yield {"done": True}
+
+    monkeypatch.setattr(nudges.batch, "run", run)
+    return type("Gemini", (), {"asked": asked, "failing": failing})
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def responses(user_id):
+    return [n["response"] for n in memory_manager.take_nudges(user_id, 0)]
+
+
+def test_a_claim_only_succeeds_once(db):
+    first = memory_manager.claim_nudges("silent", [("u1", SILENCE), ("u2", SILENCE)])
+    assert set(first) == {"u1", "u2"}
+    assert memory_manager.claim_nudges("silent", [("u1", SILENCE)]) == {}
+    # Another silence (or kind) is another nudge
+    assert set(memory_manager.claim_nudges("silent", [("u1", "2026-01-02 00:00:00")])) == {"u1"}
+    assert set(memory_manager.claim_nudges("morning", [("u1", SILENCE)])) == {"u1"}
+
+
+def test_giving_a_claim_back_lets_it_be_claimed_again(db):
+    claimed = memory_manager.claim_nudges("silent", [("u1", SILENCE)])
+    memory_manager.finish_nudge("u1", claimed["u1"], None)
+    assert set(memory_manager.claim_nudges("silent", [("u1", SILENCE)])) == {"u1"}
+
+
+def test_nudges_are_handed_out_once(db):
+    claimed = memory_manager.claim_nudges("morning", [("u1", "2026-01-01")])
+    memory_manager.finish_nudge("u1", claimed["u1"], "Morning!")
+    assert [n["response"] for n in memory_manager.take_nudges("u1", 0, peek=True)] == ["Morning!"]
+    assert responses("u1") == ["Morning!"]
+    assert responses("u1") == []
+
+
+def test_two_schedulers_generate_each_nudge_once(db, gemini):
+    targets = [(f"u{i}", SILENCE) for i in range(6)]
+
+    async def both():
+        first, second = nudges.NudgeScheduler(), nudges.NudgeScheduler()
+        await asyncio.gather(first._dispatch("silent", targets), second._dispatch("silent", targets))
+        return first, second
+
+    first, second = run(both())
+    assert sorted(gemini.asked) == sorted(user_id for user_id, _ in targets)
+    assert first.sent["silent"] + second.sent["silent"] == 6
+    assert first.skipped + second.skipped == 6
+
+
+def test_a_failed_nudge_is_given_back(db, gemini):
+    gemini.failing.add("u2")
+    scheduler = nudges.NudgeScheduler()
+    failed = run(scheduler._dispatch("silent", [("u1", SILENCE), ("u2", SILENCE)]))
+    assert failed == {("u2", SILENCE)}
+    assert responses("u1") == ["Hey u1"]
+    assert responses("u2") == []
+
+    gemini.failing.clear()
+    assert run(scheduler._dispatch("silent", [("u1", SILENCE), ("u2", SILENCE)])) == set()
+    assert responses("u2") == ["Hey u2"]
+    assert gemini.asked == ["u1", "u2", "u2"]
+
+
+def quiet(user_ids, hours_ago):
+    at = (datetime.now(timezone.utc) - timedelta(hours=hours_ago)).strftime("%Y-%m-%d %H:%M:%S")
+    memory_manager.create_users({"user_id": user_id, "name": user_id} for user_id in user_ids)
+    with memory_manager.shard_pool(0).writer() as conn:
+        conn.executemany("UPDATE conversations SET last_updated = ? WHERE user_id = ?", [(at, u) for u in user_ids])
+    return at
+
+
+def test_the_silent_watermark_waits_for_a_failed_nudge(db, gemini, monkeypatch):
+    monkeypatch.setattr(nudges, "SILENT_RETRIES", 2)
+    quiet(["a1", "a2"], hours_ago=nudges.SILENT_AFTER_HOURS + 2)
+    later = quiet(["b1"], hours_ago=nudges.SILENT_AFTER_HOURS + 1)
+    gemini.failing.add("a2")
+    scheduler = nudges.NudgeScheduler()
+
+    run(scheduler.sweep_silent())
+    # Everyone else went out, the mark stays just before a2 so the next sweep tries it again
+    assert responses("a1") == ["Hey a1"] and responses("b1") == ["Hey b1"]
+    mark = memory_manager.get_mark("silent:0")
+    assert mark.split("|")[1] == "a1"
+
+    # It keeps failing while nudges for others go through: given up after SILENT_RETRIES
+    quiet(["c1"], hours_ago=nudges.SILENT_AFTER_HOURS + 0.5)
+    run(scheduler.sweep_silent())
+    assert memory_manager.get_mark("silent:0").split("|")[1] == "c1"
+    assert later < memory_manager.get_mark("silent:0")
+
+
+def test_morning_is_only_marked_done_when_everyone_got_theirs(db, gemini, monkeypatch):
+    quiet(["m1", "m2"], hours_ago=1)
+    gemini.failing.add("m2")
+    scheduler = nudges.NudgeScheduler()
+    today = datetime.now(timezone.utc).date()
+    monkeypatch.setattr(nudges, "MORNING_HOUR", datetime.now(timezone.utc).hour)
+    scheduler._zones["UTC"] = today
+
+    run(scheduler._fire("morning", "UTC"))
+    assert memory_manager.get_mark("morning:UTC") is None
+    # Still within the grace window: the same morning comes up again shortly
+    due, kind, zone = scheduler._heap[0]
+    assert (kind, zone) == ("morning", "UTC")
+    assert scheduler._zones["UTC"] == today
+
+    gemini.failing.clear()
+    scheduler._heap.clear()
+    run(scheduler._fire("morning", "UTC"))
+    assert memory_manager.get_mark("morning:UTC") == today.isoformat()
+    assert scheduler._zones["UTC"] == today + timedelta(days=1)
+    # m1 got exactly one, m2 got theirs on the retry
+    assert responses("m1") == ["Hey m1"]
+    assert responses("m2") == ["Hey m2"]
+    assert gemini.asked.count("m1") == 1
@@ -0,0 +1,104 @@
+# Author: Steven Lansangan
+# The post-turn queue: one savepoint per job (a bad job rolls back alone and
+# holds back only its own user's later turns), exactly-once, and queued turns
+# drained before a user's memory is read
+import time
+
+from utils import memory_manager
+from backend import babaru_brain, post_turn
+
+DAY = 24 * 3600
+
+
+def queue(user_id, text, turn_at=None):
+    return memory_manager.enqueue_turn_job(user_id, {
+        "user_input": text, "ai_reply": f"re: {text}", "turn_at": turn_at or time.time(),
+    })
+
+
+def messages(user_id):
+    return [m["content"] for m in memory_manager.get_recent_messages(user_id)]
+
+
+def queued(user_id):
+    return memory_manager.user_turn_jobs(user_id)
+
+
+def test_a_failing_job_rolls_back_alone(db, monkeypatch):
+    for user_id in ("u1", "u2", "u3"):
+        memory_manager.create_user(user_id, "Tester")
+    queue("u1", "a")
+    queue("u2", "b")
+    queue("u3", "c")
+    queue("u2", "d")
+
+    apply_missions = memory_manager._apply_missions
+
+    def broken_for_u2(conn, user_id, data):
+        if user_id == "u2":
+            raise RuntimeError("boom")
+        apply_missions(conn, user_id, data)
+
+    # Fails after the messages were written, the savepoint has to take those back too
+    monkeypatch.setattr(memory_manager, "_apply_missions", broken_for_u2)
+    assert post_turn.drain_all() == 2
+
+    assert messages("u1") == ["a", "re: a"]
+    assert messages("u3") == ["c", "re: c"]
+    assert messages("u2") == []
+    # The failed job got an attempt and a backoff, the one after it waits its turn untouched
+    first, second = queued("u2")
+    assert first["attempts"] == 1
+    assert second["attempts"] == 0
+
+    monkeypatch.setattr(memory_manager, "_apply_missions", apply_missions)
+    assert post_turn.drain_user("u2") == 2
+    assert messages("u2") == ["b", "re: b", "d", "re: d"]
+
+
+def test_each_job_is_applied_once(db):
+    memory_manager.create_user("u1", "Tester")
+    queue("u1", "a")
+    jobs = queued("u1")
+    assert post_turn._apply_batch(0, jobs) == 1
+    # Another worker that picked up the same page gets nothing
+    assert post_turn._apply_batch(0, jobs) == 0
+    assert messages("u1") == ["a", "re: a"]
+
+
+def test_queued_turns_are_drained_before_reading(db):
+    memory_manager.create_user("u1", "Tester")
+    # Cached before the turn is applied
+    assert babaru_brain._load_memory("u1")["conversations"] == []
+    queue("u1", "hello")
+    memory = babaru_brain._load_memory("u1")
+    assert [m["content"] for m in memory["conversations"]] == ["hello", "re: hello"]
+    # The cached copy got the turn in the same write, a plain read agrees with the db
+    assert memory_manager.memory_cache.get("u1")["conversations"] == memory["conversations"]
+    assert queued("u1") == []
+
+
+def test_streak_counts_days_in_the_users_timezone(db):
+    memory_manager.create_user("u1", "Tester")
+    start = time.time() - 3 * DAY
+    queue("u1", "day 1", start)
+    queue("u1", "day 2", start + DAY)
+    post_turn.drain_user("u1")
+    assert memory_manager.get_user_memory("u1")["progression"]["streak_days"] == 2
+    queue("u1", "skipped a day", start + 3 * DAY)
+    post_turn.drain_user("u1")
+    assert memory_manager.get_user_memory("u1")["progression"]["streak_days"] == 1
+
+
+def test_scoring_is_off_unless_asked_for():
+    state = {"timezone": "UTC", "points": 0, "streak_days": 0, "last_active": None,
+             "active": ["Drink water"], "completed": []}
+    payload = {"user_input": "done", "ai_reply": "MISSION COMPLETE!", "turn_at": time.time()}
+    plain = post_turn.turn_effects(state, payload, scoring=False)
+    assert set(plain) == {"messages", "progression"}
+    assert plain["progression"] == {"streak_days": 1}
+
+    scored = post_turn.turn_effects(state, payload, scoring=True)
+    assert scored["missions"] == {"active": [], "completed": ["Drink water"]}
+    assert scored["progression"]["points"] == post_turn.TURN_POINTS + post_turn.MISSION_POINTS
+    assert scored["relationship"] == (0, 1)
@@ -0,0 +1,155 @@
+# Author: Steven Lansangan
+# PromptCache against the in-process LocalCaches: create once, reuse, refresh
+# before Gemini would expire it, and fall back to the full prompt when caching fails
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from backend import prompt_cache, babaru_brain
+from backend.prompt_cache import LocalCaches, PromptCache
+
+MODEL = "gemini-test"
+
+
+class BrokenCaches(LocalCaches):
+    def create(self, model, config):
+        self.creates += 1
+        raise RuntimeError("quota exceeded")
+
+
+def _later(monkeypatch, seconds):
+    now = time.time()
+    monkeypatch.setattr(prompt_cache.time, "time", lambda: now + seconds)
+
+
+def test_creates_once_then_reuses():
+    caches = LocalCaches()
+    cache = PromptCache(caches, MODEL)
+    name = cache.get_name()
+    assert name and name.startswith("cachedContents/local-")
+    assert cache.get_name() == name
+    assert cache.peek() == name
+    assert caches.creates == 1
+    assert cache.refreshes == 1
+    assert cache.hits == 2
+
+
+def test_reuses_a_cache_another_replica_registered():
+    caches = LocalCaches()
+    first = PromptCache(caches, MODEL).get_name()
+    second = PromptCache(caches, MODEL)
+    assert second.get_name() == first
+    assert caches.creates == 1
+
+
+def test_prompt_change_gets_its_own_cache():
+    caches = LocalCaches()
+    first = PromptCache(caches, MODEL).get_name()
+    other = PromptCache(caches, MODEL)
+    other.display_name += "-changed"
+    assert other.get_name() != first
+    assert caches.creates == 2
+
+
+def test_refreshes_before_it_expires(monkeypatch):
+    caches = LocalCaches()
+    cache = PromptCache(caches, MODEL, ttl_seconds=3600)
+    name = cache.get_name()
+    # Inside the refresh margin: not handed out anymore, a new one is registered
+    _later(monkeypatch, 3600 - prompt_cache.REFRESH_MARGIN_SECONDS + 1)
+    assert cache.peek() is None
+    assert cache.needs_refresh()
+    refreshed = cache.get_name()
+    assert refreshed != name
+    assert caches.creates == 2
+    assert cache.refreshes == 2
+
+
+def test_invalidate_recreates_a_cache_gemini_dropped():
+    caches = LocalCaches()
+    cache = PromptCache(caches, MODEL)
+    name = cache.get_name()
+    caches.delete(name)
+    cache.invalidate()
+    assert cache.peek() is None
+    assert cache.get_name() != name
+    assert caches.creates == 2
+
+
+def test_failed_create_means_no_cache_until_retry(monkeypatch):
+    caches = BrokenCaches()
+    cache = PromptCache(caches, MODEL)
+    assert cache.get_name() is None
+    assert cache.failures == 1
+    # Inside the retry window nobody tries again
+    assert not cache.needs_refresh()
+    assert cache.get_name() is None
+    assert caches.creates == 1
+    _later(monkeypatch, prompt_cache.RETRY_AFTER_SECONDS + 1)
+    assert cache.needs_refresh()
+    assert cache.get_name() is None
+    assert caches.creates == 2
+
+
+def test_from_env(monkeypatch):
+    monkeypatch.setattr(prompt_cache, "CACHE_MODE", "off")
+    assert prompt_cache.from_env(None, MODEL) is None
+    monkeypatch.setattr(prompt_cache, "CACHE_MODE", "local")
+    assert isinstance(prompt_cache.from_env(None, MODEL).caches, LocalCaches)
+    # A real client would get 404s for the stub's names
+    assert prompt_cache.from_env(SimpleNamespace(caches=LocalCaches()), MODEL) is None
+
+
+# --- What the brain sends with and without the cache ---
+MEMORY = {"identity": {"name": "Tester"}, "conversations": [{"role": "user", "content": "hi"}]}
+
+
+def test_uncached_request_carries_the_whole_prompt():
+    config, contents = babaru_brain._build_request("CONTEXT_GENERAL", MEMORY, "hello")
+    assert config.cached_content is None
+    assert "You are Babaru" in config.system_instruction
+    assert contents[-1].parts[-1].text == "hello"
+
+
+def test_cached_request_only_sends_the_dynamic_part():
+    config, contents = babaru_brain._build_request("CONTEXT_GENERAL", MEMORY, "hello", "cachedContents/local-1")
+    assert config.cached_content == "cachedContents/local-1"
+    assert config.system_instruction is None
+    assert len(contents[-1].parts) == 2
+
+
+@pytest.fixture
+def brain(monkeypatch):
+    """get_response wired to a LocalCaches prompt cache and a fake Gemini client."""
+    cache = PromptCache(LocalCaches(), MODEL)
+    sent = []
+
+    def generate_content(model, config, contents):
+        sent.append(config)
+        if config.cached_content and config.cached_content not in {c.name for c in cache.caches.list()}:
+            raise ValueError("404 cached content not found")
+        return SimpleNamespace(text="reply")
+
+    client = SimpleNamespace(models=SimpleNamespace(generate_content=generate_content))
+    monkeypatch.setattr(babaru_brain, "_api_key", lambda: "key")
+    monkeypatch.setattr(babaru_brain, "get_client", lambda: client)
+    monkeypatch.setattr(babaru_brain, "get_prefix_cache", lambda: cache)
+    monkeypatch.setattr(babaru_brain, "_load_memory", lambda user_id: MEMORY)
+    monkeypatch.setattr(babaru_brain, "_record_turn", lambda *args: None)
+    return SimpleNamespace(cache=cache, sent=sent)
+
+
+def test_brain_uses_the_cached_prefix(brain):
+    assert babaru_brain.get_response("u1", "hello") == "reply"
+    assert brain.sent[0].cached_content == brain.cache.get_name()
+
+
+def test_brain_falls_back_to_the_full_prompt_when_the_cache_is_gone(brain):
+    name = brain.cache.get_name()
+    brain.cache.caches.delete(name)
+    assert babaru_brain.get_response("u1", "hello") == "reply"
+    assert [config.cached_content for config in brain.sent] == [name, None]
+    assert brain.sent[1].system_instruction
+    # Forgotten, so the next turn registers a fresh one
+    assert brain.cache.peek() is None
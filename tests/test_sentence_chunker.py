@@ -0,0 +1,66 @@
+# Author: Steven Lansangan
+# SentenceChunker: reply text (whole or delta by delta) into ordered speech/song
+# segments, never splitting inside an *action* or a half-arrived song tag
+from utils.voice_manager import SentenceChunker, split_segments
+
+REPLY = ("Well well well, look who finally showed up. *adjusts tiny glasses. slowly* "
+         "You said you'd run today? [PLAY_SONG: Sad Trombone] Prove me wrong, champ.")
+
+
+def fed(text, step=1):
+    chunker = SentenceChunker()
+    out = []
+    for i in range(0, len(text), step):
+        out += chunker.feed(text[i:i + step])
+    return out + chunker.flush()
+
+
+def test_whole_reply():
+    assert split_segments(REPLY) == [
+        ("speech", "Well well well, look who finally showed up."),
+        ("speech", "You said you'd run today?"),
+        ("song", "sad trombone"),
+        ("speech", "Prove me wrong, champ."),
+    ]
+
+
+def test_deltas_give_the_same_segments():
+    expected = split_segments(REPLY)
+    for step in (1, 3, 7, 40):
+        assert fed(REPLY, step) == expected
+
+
+def test_sentences_go_out_as_soon_as_they_end():
+    chunker = SentenceChunker()
+    assert chunker.feed("This sentence is long enough to send. And this") == [
+        ("speech", "This sentence is long enough to send.")
+    ]
+    assert chunker.flush() == [("speech", "And this")]
+
+
+def test_short_sentences_are_merged():
+    assert split_segments("Hi. Ok. That's a whole lot better now!") == [
+        ("speech", "Hi. Ok. That's a whole lot better now!")
+    ]
+
+
+def test_no_cut_inside_an_action():
+    chunker = SentenceChunker()
+    # The period inside the action isn't the end of a sentence
+    assert chunker.feed("*sighs. deeply. dramatically.* ") == []
+    assert chunker.feed("Fine, I'll help you one more time. ") == [
+        ("speech", "Fine, I'll help you one more time.")
+    ]
+
+
+def test_a_tag_still_arriving_is_left_alone():
+    chunker = SentenceChunker()
+    out = chunker.feed("Here comes your theme song, buddy! [PLAY_SO")
+    assert out == [("speech", "Here comes your theme song, buddy!")]
+    assert chunker.feed("NG: Victory") == []
+    assert chunker.feed("] Go.") == [("song", "victory")]
+    assert chunker.flush() == [("speech", "Go.")]
+
+
+def test_actions_only_say_nothing():
+    assert split_segments("*stares silently*") == []
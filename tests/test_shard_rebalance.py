@@ -0,0 +1,71 @@
+# Author: Steven Lansangan
+# Changing the shard count: every user lands on the shard shard_index picks
+# for the new count, with their messages, queued turns and nudges, the old
+# files are left alone, and the scheduler's silent watermarks are re-keyed
+import pytest
+
+from utils import memory_manager, memory_transfer, shard_rebalance
+
+USERS = [f"user{i}" for i in range(40)]
+
+
+def populate():
+    memory_manager.create_users({"user_id": user_id, "name": user_id, "timezone": "Asia/Tokyo"} for user_id in USERS)
+    for i, user_id in enumerate(USERS[:10]):
+        for n in range(i + 1):
+            memory_manager.update_conversation_history(user_id, {"role": "user", "content": f"{user_id} says {n}"})
+    memory_manager.enqueue_turn_job("user3", {"user_input": "hi", "ai_reply": "yo", "turn_at": 1.0})
+    memory_manager.claim_nudges("silent", [("user4", "2026-01-01 00:00:00")])
+    memory_manager.set_mark("silent:0", "2026-01-01 00:00:00|user9")
+    memory_manager.set_mark("morning:Asia/Tokyo", "2026-01-01")
+
+
+def test_one_to_three_and_back(db, monkeypatch):
+    populate()
+    assert shard_rebalance.rebalance(1, 3) == len(USERS)
+
+    monkeypatch.setattr(memory_manager, "SHARD_COUNT", 3)
+    for shard in range(3):
+        with memory_manager.shard_pool(shard).reader() as conn:
+            ids = [r[0] for r in conn.execute("SELECT user_id FROM use_identity")]
+        assert ids and all(memory_manager.shard_index(user_id) == shard for user_id in ids)
+        assert memory_manager.timezones(shard) == ["Asia/Tokyo"]
+    for i, user_id in enumerate(USERS[:10]):
+        assert [m["content"] for m in memory_manager.get_recent_messages(user_id)] == [f"{user_id} says {n}" for n in range(i + 1)]
+    assert len(memory_manager.user_turn_jobs("user3")) == 1
+    # The claim came along, so the same silence isn't nudged twice
+    assert memory_manager.claim_nudges("silent", [("user4", "2026-01-01 00:00:00")]) == {}
+    assert [memory_manager.get_mark(f"silent:{shard}") for shard in range(3)] == ["2026-01-01 00:00:00|user9"] * 3
+    assert memory_manager.get_mark("morning:Asia/Tokyo") == "2026-01-01"
+
+    # The old single file is still there untouched
+    assert shard_rebalance._count_users(memory_manager.all_pools(1)) == len(USERS)
+
+    monkeypatch.setattr(memory_manager, "SHARD_COUNT", 1)
+    with memory_manager.shard_pool(0).writer() as conn:
+        for table in list(memory_transfer.USER_TABLES) + list(memory_transfer.USER_LIST_TABLES) + ["messages"]:
+            conn.execute(f"DELETE FROM {table}")
+    assert shard_rebalance.rebalance(3, 1) == len(USERS)
+    assert memory_manager.get_recent_messages("user9")[-1]["content"] == "user9 says 9"
+
+
+def test_streams_in_small_transactions(db, monkeypatch):
+    populate()
+    monkeypatch.setattr(memory_transfer, "MESSAGE_CHUNK", 2)
+    monkeypatch.setattr(memory_transfer, "IMPORT_ROWS", 3)
+    assert shard_rebalance.rebalance(1, 2) == len(USERS)
+    monkeypatch.setattr(memory_manager, "SHARD_COUNT", 2)
+    assert len(memory_manager.get_recent_messages("user9")) == 10
+
+
+def test_refuses_to_merge_into_users_unless_forced(db, monkeypatch):
+    populate()
+    shard_rebalance.rebalance(1, 2)
+    with pytest.raises(RuntimeError, match="already contain users"):
+        shard_rebalance.rebalance(1, 2)
+    # Forced: the dump is the source of truth, nobody ends up with doubled messages
+    assert shard_rebalance.rebalance(1, 2, force=True) == len(USERS)
+    monkeypatch.setattr(memory_manager, "SHARD_COUNT", 2)
+    assert len(memory_manager.get_recent_messages("user9")) == 10
+    with pytest.raises(ValueError):
+        shard_rebalance.rebalance(2, 2)
@@ -0,0 +1,285 @@
+# Author: Steven Lansangan
+# utils/upstream.py against benchmarks/fake_upstream.py: the AIMD limit, retries
+# inside the deadline, the circuit breaker and hedging, all offline and fast
+import time
+import asyncio
+
+import pytest
+
+from utils import upstream
+from benchmarks.fake_upstream import FakeError, FakeUpstream, run_scenario
+
+
+def fake(**kwargs) -> FakeUpstream:
+    # Fast and predictable unless a test asks otherwise
+    settings = {"latency_ms": 5, "jitter_ms": 0, "slow_rate": 0.0, "capacity": 1000}
+    settings.update(kwargs)
+    return FakeUpstream(**settings)
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+@pytest.fixture
+def longest_backoff(monkeypatch):
+    # Full jitter always picks the top of the range, so "is there time for a retry" is deterministic
+    monkeypatch.setattr(upstream.random, "uniform", lambda low, high: high)
+
+
+# --- AIMD ---
+def test_limit_grows_about_one_per_round_of_successes():
+    limit = upstream.AdaptiveLimit(4)
+    for _ in range(4):
+        limit.on_success()
+    assert 4.9 < limit.limit < 5.0
+
+
+def test_limit_backs_off_on_overload_but_not_below_min():
+    limit = upstream.AdaptiveLimit(10, min_limit=2)
+    limit.on_overload()
+    assert limit.limit == pytest.approx(7.0)
+    for _ in range(20):
+        limit.on_overload()
+    assert limit.limit == 2
+
+
+def test_limit_settles_near_the_upstreams_capacity():
+    backend = fake(capacity=10)
+    up = upstream.Upstream("aimd", initial_limit=32, max_limit=64, backoff_base=0.01, breaker_threshold=10_000)
+    report = run(run_scenario(backend, up, calls=300, concurrency=40, request_deadline=5.0))
+    assert report["success_rate"] == 1.0
+    # Started at 32 against a capacity of 10, the 429s pushed it down
+    assert up.limit.limit < 16
+    assert up.retries > 0
+
+
+def test_waiters_get_a_slot_or_give_up_at_the_deadline():
+    backend = fake(latency_ms=200)
+    up = upstream.Upstream("slots", initial_limit=1, max_limit=1)
+
+    async def scenario():
+        first = asyncio.ensure_future(up.call_async(backend.call_async))
+        await asyncio.sleep(0)
+        with upstream.deadline(0.05):
+            with pytest.raises(upstream.DeadlineExceeded):
+                await up.call_async(backend.call_async)
+        assert await first == "ok"
+
+    run(scenario())
+    assert backend.received == 1
+    assert up.limit.in_flight == 0
+
+
+# --- Retries and deadlines ---
+def test_retries_errors_worth_retrying_then_gives_up():
+    backend = fake(error_rate=1.0)
+    up = upstream.Upstream("retry", max_attempts=3, backoff_base=0.001)
+    with pytest.raises(FakeError):
+        run(up.call_async(backend.call_async))
+    assert backend.received == 3
+    assert up.retries == 2
+    assert up.failures == 1
+
+
+def test_a_transient_error_is_retried_away():
+    backend = fake()
+    up = upstream.Upstream("retry", backoff_base=0.001)
+    outcomes = iter([FakeError(503), None])
+
+    async def flaky():
+        error = next(outcomes)
+        if error:
+            raise error
+        return await backend.call_async()
+
+    assert run(up.call_async(flaky)) == "ok"
+    assert up.retries == 1
+
+
+def test_client_errors_are_not_retried():
+    up = upstream.Upstream("retry", backoff_base=0.001)
+    calls = []
+
+    async def rejected():
+        calls.append(1)
+        raise FakeError(400)
+
+    with pytest.raises(FakeError):
+        run(up.call_async(rejected))
+    assert len(calls) == 1
+    assert up.breaker.state == "closed"
+
+
+def test_no_retry_when_the_backoff_would_overrun_the_deadline(longest_backoff):
+    backend = fake(error_rate=1.0)
+    up = upstream.Upstream("retry", max_attempts=5, backoff_base=1.0)
+
+    async def scenario():
+        with upstream.deadline(0.5):
+            await up.call_async(backend.call_async)
+
+    with pytest.raises(FakeError):
+        run(scenario())
+    assert backend.received == 1
+
+
+def test_a_slow_call_is_cut_off_at_the_deadline():
+    backend = fake(slow_rate=1.0, slow_ms=2000)
+    up = upstream.Upstream("deadline", timeout=10)
+
+    async def scenario():
+        with upstream.deadline(0.1):
+            await up.call_async(backend.call_async)
+
+    started = time.monotonic()
+    with pytest.raises(asyncio.TimeoutError):
+        run(scenario())
+    assert time.monotonic() - started < 0.5
+
+
+def test_blocking_calls_hand_their_budget_to_the_call():
+    backend = fake(slow_rate=1.0, slow_ms=2000)
+    up = upstream.Upstream("deadline", timeout=10, max_attempts=1)
+    started = time.monotonic()
+    with upstream.deadline(0.1):
+        with pytest.raises(TimeoutError):
+            up.call(backend.call)
+    assert time.monotonic() - started < 0.5
+    # Without a deadline it gets the per-call timeout
+    assert up.call(lambda timeout: timeout) == 10
+
+
+def test_nothing_is_called_once_the_deadline_passed():
+    backend = fake()
+    up = upstream.Upstream("deadline")
+
+    async def scenario():
+        with upstream.deadline(-1):
+            await up.call_async(backend.call_async)
+
+    with pytest.raises(upstream.DeadlineExceeded):
+        run(scenario())
+    assert backend.received == 0
+
+
+# --- Circuit breaker ---
+def test_breaker_opens_then_half_opens_for_one_probe():
+    backend = fake(outage=(0, 3600))
+    up = upstream.Upstream("breaker", max_attempts=1, breaker_threshold=3, breaker_cooldown=0.1)
+
+    async def call():
+        return await up.call_async(backend.call_async)
+
+    async def scenario():
+        for _ in range(3):
+            with pytest.raises(FakeError):
+                await call()
+        assert up.breaker.state == "open"
+        # Open: fails fast, the upstream never sees it
+        with pytest.raises(upstream.CircuitOpen):
+            await call()
+        assert backend.received == 3
+
+        await asyncio.sleep(0.11)
+        # Half open: one probe goes through, everyone else still fails fast
+        probe = asyncio.ensure_future(call())
+        await asyncio.sleep(0)
+        assert up.breaker.state == "half_open"
+        with pytest.raises(upstream.CircuitOpen):
+            await call()
+        with pytest.raises(FakeError):
+            await probe
+        # The probe failed, so it's open again
+        assert up.breaker.state == "open"
+        assert backend.received == 4
+
+        backend.outage = None
+        await asyncio.sleep(0.11)
+        assert await call() == "ok"
+        assert up.breaker.state == "closed"
+
+    run(scenario())
+    assert up.breaker.trips == 2
+    assert up.rejected == 2
+
+
+def test_a_rejected_probe_lets_the_next_one_through():
+    up = upstream.Upstream("breaker", max_attempts=1, breaker_threshold=1, breaker_cooldown=0.0)
+
+    async def outage():
+        raise FakeError(503)
+
+    async def bad_request():
+        raise FakeError(400)
+
+    async def scenario():
+        with pytest.raises(FakeError):
+            await up.call_async(outage)
+        assert up.breaker.state == "open"
+        # The probe got an answer that says nothing about the outage, the next caller probes again
+        with pytest.raises(FakeError):
+            await up.call_async(bad_request)
+        assert up.breaker.allow()
+
+    run(scenario())
+
+
+# --- Hedging ---
+def _primed(up: upstream.Upstream, seconds: float = 0.01):
+    # Hedging only starts once it knows what normal looks like
+    up._latencies.extend([seconds] * upstream.Upstream.HEDGE_MIN_SAMPLES)
+
+
+def _slow_then_fast(backend: FakeUpstream):
+    # The first copy lands in the slow tail, the hedge doesn't
+    slow = iter([1.0, 0.0])
+
+    async def fn():
+        backend.slow_rate = next(slow, 0.0)
+        return await backend.call_async()
+    return fn
+
+
+def test_hedge_races_a_second_copy_of_a_slow_call():
+    backend = fake(slow_ms=1000)
+    up = upstream.Upstream("hedge", hedge=True)
+    _primed(up)
+    started = time.monotonic()
+    assert run(up.call_async(_slow_then_fast(backend))) == "ok"
+    assert time.monotonic() - started < 0.5
+    assert (up.hedges, up.hedge_wins) == (1, 1)
+    assert backend.received == 2
+    assert up.limit.in_flight == 0
+
+
+def test_no_hedging_before_enough_samples():
+    backend = fake(slow_ms=200)
+    up = upstream.Upstream("hedge", hedge=True)
+    assert up.p95() is None
+    assert run(up.call_async(_slow_then_fast(backend))) == "ok"
+    assert up.hedges == 0
+
+
+def test_hedging_turns_off_when_there_is_no_spare_slot():
+    # Every slot is busy with real work: a hedge would only add load, so the slow call just waits
+    backend = fake(slow_ms=200)
+    up = upstream.Upstream("hedge", hedge=True, initial_limit=1, max_limit=1)
+    _primed(up)
+    assert run(up.call_async(_slow_then_fast(backend))) == "ok"
+    assert up.hedges == 0
+    assert backend.received == 1
+
+
+def test_hedging_cuts_the_tail_when_there_is_room():
+    def p99(concurrency, hedge):
+        backend = fake(latency_ms=5, jitter_ms=5, slow_rate=0.05, slow_ms=200, capacity=1000, seed=3)
+        up = upstream.Upstream("hedge", hedge=hedge, initial_limit=32)
+        report = run(run_scenario(backend, up, calls=200, concurrency=concurrency, request_deadline=5.0))
+        assert report["success_rate"] == 1.0
+        return report["p99_ms"], up.hedges
+
+    plain, _ = p99(8, hedge=False)
+    hedged, hedges = p99(8, hedge=True)
+    assert hedges > 0
+    assert hedged < plain / 2
@@ -0,0 +1,96 @@
+# Author: Steven Lansangan
+# Short-lived audio files for GET /v1/audio/{id}
+# Instead of stuffing base64 MP3 into the JSON, the API can park the audio
+# here and hand back an id. Files live on disk (so every worker can serve
+# them) and get swept after BABARU_AUDIO_TTL seconds.
+import os
+import re
+import time
+import secrets
+import tempfile
+import threading
+import logging
+from typing import Optional, Tuple
+
+logger = logging.getLogger("AudioStore")
+
+AUDIO_STORE_DIR = os.getenv("BABARU_AUDIO_STORE_DIR", ".audio_store")
+AUDIO_TTL_SECONDS = int(os.getenv("BABARU_AUDIO_TTL", "600"))
+
+# token_urlsafe(16) gives 22 chars of [A-Za-z0-9_-], anything else never touches the filesystem
+_ID = re.compile(r"[A-Za-z0-9_-]{16,64}")
+
+
+class AudioStore:
+    def __init__(self, directory: str = AUDIO_STORE_DIR, ttl: int = AUDIO_TTL_SECONDS):
+        self.directory = directory
+        self.ttl = ttl
+        self._last_sweep = 0.0
+        self._lock = threading.Lock()
+        self.stored = 0
+        self.swept = 0
+
+    def _path(self, audio_id: str) -> str:
+        return os.path.join(self.directory, f"{audio_id}.mp3")
+
+    def put(self, audio: bytes) -> str:
+        """Write audio to disk and return its id. Blocking, call it from an executor."""
+        audio_id = secrets.token_urlsafe(16)
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(audio)
+            os.replace(tmp, self._path(audio_id))
+        except BaseException:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+        self.stored += 1
+        self._maybe_sweep()
+        return audio_id
+
+    def open(self, audio_id: str) -> Optional[Tuple[str, int]]:
+        """(path, size) if the id exists and hasn't expired."""
+        if not _ID.fullmatch(audio_id or ""):
+            return None
+        path = self._path(audio_id)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if time.time() - st.st_mtime > self.ttl:
+            return None
+        return path, st.st_size
+
+    def _maybe_sweep(self):
+        # Piggybacks on writes, no background thread needed
+        now = time.time()
+        with self._lock:
+            if now - self._last_sweep < self.ttl / 2:
+                return
+            self._last_sweep = now
+        self.sweep()
+
+    def sweep(self) -> int:
+        """Delete expired files (and leftover temp files). Returns how many were removed."""
+        removed = 0
+        cutoff = time.time() - self.ttl
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return 0
+        for name in names:
+            path = os.path.join(self.directory, name)
+            try:
+                if os.stat(path).st_mtime < cutoff:
+                    os.remove(path)
+                    removed += 1
+            except OSError:
+                continue
+        if removed:
+            self.swept += removed
+            logger.info(f"Swept {removed} expired audio files.")
+        return removed
@@ -0,0 +1,185 @@
+# Author: Steven Lansangan
+# Connection pool for SQLite
+# WAL mode lets readers and the writer work at the same time, so we keep
+# a few reader connections around plus exactly one writer
+import os
+import queue
+import sqlite3
+import threading
+import time
+import logging
+from contextlib import contextmanager
+from typing import Dict, Any
+
+logger = logging.getLogger("DBPool")
+
+READER_POOL_SIZE = int(os.getenv("BABARU_DB_READERS", "4"))
+
+# Size of each connection's prepared statement cache (keyed by SQL text)
+STATEMENT_CACHE_SIZE = 256
+
+PRAGMAS = [
+    "PRAGMA journal_mode = WAL",
+    # NORMAL is durable across app crashes in WAL mode, only a power cut can lose the last commits
+    "PRAGMA synchronous = NORMAL",
+    # Negative means KiB, so this is ~16MB of page cache per connection
+    "PRAGMA cache_size = -16000",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA busy_timeout = 5000",
+]
+
+
+class _WaitStats:
+    """Running totals of how long callers waited to get a connection."""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "acquisitions": self.count,
+            "wait_total_s": round(self.total, 6),
+            "wait_avg_s": round(self.total / self.count, 6) if self.count else 0.0,
+            "wait_max_s": round(self.max, 6),
+        }
+
+
+class ConnectionPool:
+    """
+    Bounded pool of reader connections plus one dedicated writer for a single SQLite file.
+    Use `with pool.reader() as conn:` for queries and `with pool.writer() as conn:` for
+    anything that changes data (it commits on exit, rolls back on error).
+    """
+
+    def __init__(self, path: str, readers: int = READER_POOL_SIZE):
+        self.path = path
+        self.max_readers = max(1, readers)
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._create_lock = threading.Lock()
+        self._writer = None
+        self._writer_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._reader_waits = _WaitStats()
+        self._writer_waits = _WaitStats()
+
+    def _connect(self, read_only: bool = False) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.path,
+            check_same_thread=False,  # connections move between threads, but only one uses it at a time
+            cached_statements=STATEMENT_CACHE_SIZE,
+        )
+        conn.row_factory = sqlite3.Row
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        if read_only:
+            conn.execute("PRAGMA query_only = 1")
+        return conn
+
+    def _record(self, stats: _WaitStats, started: float):
+        with self._stats_lock:
+            stats.record(time.perf_counter() - started)
+
+    @contextmanager
+    def reader(self):
+        started = time.perf_counter()
+        conn = None
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            with self._create_lock:
+                if self._created < self.max_readers:
+                    self._created += 1
+                    create = True
+                else:
+                    create = False
+            if create:
+                try:
+                    conn = self._connect(read_only=True)
+                except Exception:
+                    with self._create_lock:
+                        self._created -= 1
+                    raise
+            else:
+                # Pool is full, wait for someone to hand a connection back
+                conn = self._idle.get()
+        self._record(self._reader_waits, started)
+
+        try:
+            yield conn
+        finally:
+            # Never leave a read transaction open, it would pin an old WAL snapshot
+            if conn.in_transaction:
+                conn.rollback()
+            self._idle.put(conn)
+
+    @contextmanager
+    def writer(self):
+        started = time.perf_counter()
+        with self._writer_lock:
+            self._record(self._writer_waits, started)
+            if self._writer is None:
+                self._writer = self._connect()
+            conn = self._writer
+            try:
+                yield conn
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+
+    def stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            return {
+                "path": self.path,
+                "readers_open": self._created,
+                "readers_idle": self._idle.qsize(),
+                "readers_max": self.max_readers,
+                "reader": self._reader_waits.as_dict(),
+                "writer": self._writer_waits.as_dict(),
+            }
+
+    def close(self):
+        with self._writer_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+        with self._create_lock:
+            self._created = 0
+
+
+_pools: Dict[str, ConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(path: str) -> ConnectionPool:
+    """One shared pool per database file."""
+    pool = _pools.get(path)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(path)
+            if pool is None:
+                pool = ConnectionPool(path)
+                _pools[path] = pool
+                logger.info(f"Opened connection pool for {path} ({pool.max_readers} readers + 1 writer)")
+    return pool
+
+
+def close_all():
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
@@ -0,0 +1,51 @@
+# Author: Steven Lansangan
+# Thread pools for the blocking parts of a chat turn
+# Each stage gets its own bounded pool so a slow Gemini call can't eat the
+# threads that sqlite or ffmpeg need, and none of it runs on the event loop
+import os
+import asyncio
+import functools
+import contextvars
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict
+
+logger = logging.getLogger("Executors")
+
+# Worker count per stage, override with BABARU_<STAGE>_WORKERS
+DEFAULT_SIZES = {
+    "llm": 32,   # mostly waiting on the network
+    "tts": 16,
+    "mix": max(2, os.cpu_count() or 2),  # pydub/ffmpeg, CPU bound
+    "db": 8,
+}
+
+_pools: Dict[str, ThreadPoolExecutor] = {}
+
+
+def stage_size(stage: str) -> int:
+    return int(os.getenv(f"BABARU_{stage.upper()}_WORKERS", DEFAULT_SIZES.get(stage, 4)))
+
+
+def get_executor(stage: str) -> ThreadPoolExecutor:
+    pool = _pools.get(stage)
+    if pool is None:
+        size = stage_size(stage)
+        pool = ThreadPoolExecutor(max_workers=size, thread_name_prefix=f"babaru-{stage}")
+        _pools[stage] = pool
+        logger.info(f"Started '{stage}' executor with {size} workers.")
+    return pool
+
+
+async def run(stage: str, fn: Callable, *args, **kwargs) -> Any:
+    """Run a blocking call on the given stage's pool and await the result.
+    Context vars (like the request deadline) come along into the worker thread."""
+    loop = asyncio.get_running_loop()
+    ctx = contextvars.copy_context()
+    return await loop.run_in_executor(get_executor(stage), functools.partial(ctx.run, fn, *args, **kwargs))
+
+
+def shutdown(wait: bool = True):
+    for pool in _pools.values():
+        pool.shutdown(wait=wait)
+    _pools.clear()
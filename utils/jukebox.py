@@ -0,0 +1,286 @@
+# Author: Steven Lansangan
+# Song registry + fast mixing for the Jukebox
+# Songs are read once at startup and brought to the same MP3 format ElevenLabs
+# sends us (sample rate / channels / bitrate). Then a sung reply is just
+# intro frames + song frames + outro frames glued together, no decoding.
+# If a clip ever comes back in another format we fall back to pydub/ffmpeg.
+import io
+import os
+import re
+import mmap
+import hashlib
+import tempfile
+import threading
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger("Jukebox")
+
+SONGS_DIR = os.getenv("BABARU_SONGS_DIR", "assets/songs")
+# Normalized copies live here so restarts (and other workers) don't redo the ffmpeg pass
+NORMALIZED_DIR = os.getenv("BABARU_JUKEBOX_CACHE_DIR", os.path.join(".tts_cache", "songs"))
+# ElevenLabs MP3 is mono
+CHANNELS = int(os.getenv("BABARU_JUKEBOX_CHANNELS", "1"))
+
+# --- MP3 frame parsing ---
+# Only MPEG Layer III, which is what ElevenLabs and basically every .mp3 uses
+_BITRATES = {
+    3: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),  # MPEG-1
+    2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),      # MPEG-2
+}
+_BITRATES[0] = _BITRATES[2]                                                 # MPEG-2.5
+_SAMPLE_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+
+# (mpeg version, sample rate, channels): frames with the same format can be concatenated
+AudioFormat = Tuple[int, int, int]
+
+
+def _frame_header(data: bytes, i: int) -> Optional[Tuple[int, AudioFormat]]:
+    """(frame length, format) if a valid Layer III frame header starts at i."""
+    if i + 4 > len(data) or data[i] != 0xFF or (data[i + 1] & 0xE0) != 0xE0:
+        return None
+    b1, b2, b3 = data[i + 1], data[i + 2], data[i + 3]
+    version = (b1 >> 3) & 3
+    layer = (b1 >> 1) & 3
+    bitrate_idx = b2 >> 4
+    rate_idx = (b2 >> 2) & 3
+    if version == 1 or layer != 1 or bitrate_idx in (0, 15) or rate_idx == 3:
+        return None
+    bitrate = _BITRATES[version][bitrate_idx] * 1000
+    sample_rate = _SAMPLE_RATES[version][rate_idx]
+    padding = (b2 >> 1) & 1
+    channels = 1 if (b3 >> 6) == 3 else 2
+    length = (144 if version == 3 else 72) * bitrate // sample_rate + padding
+    return length, (version, sample_rate, channels)
+
+
+def _id3v2_size(data: bytes) -> int:
+    if len(data) < 10 or data[:3] != b"ID3":
+        return 0
+    # Syncsafe size (7 bits per byte), plus the header and the optional footer
+    size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]
+    return 10 + size + (10 if data[5] & 0x10 else 0)
+
+
+def parse_frames(data: bytes) -> Tuple[Optional[AudioFormat], List[Tuple[int, int]]]:
+    """
+    Find the audio frames in an MP3 file. Returns (format, [(start, end), ...]).
+    Tags (ID3v2/ID3v1) and the Xing/Info header frame are left out, so the
+    frames can be glued onto other frames as-is. Format is None when frames
+    don't all share one format (or there aren't any).
+    """
+    end = len(data)
+    if end >= 128 and data[end - 128:end - 125] == b"TAG":
+        end -= 128
+    i = _id3v2_size(data)
+    frames = []
+    formats = set()
+    while i + 4 <= end:
+        header = _frame_header(data, i)
+        # A real frame is followed by another one (or the end), that weeds out stray 0xFF bytes
+        if header and i + header[0] <= end and (i + header[0] == end or _frame_header(data, i + header[0]) or i + header[0] + 4 > end):
+            length, fmt = header
+            frames.append((i, i + length))
+            formats.add(fmt)
+            i += length
+        else:
+            i += 1
+
+    if frames:
+        start, stop = frames[0]
+        head = data[start:min(stop, start + 64)]
+        if b"Xing" in head or b"Info" in head or b"VBRI" in head:
+            # Encoder header frame (silent), it describes the old file so it can't go in the middle of ours
+            frames.pop(0)
+    return (formats.pop() if len(formats) == 1 else None), frames
+
+
+def audio_frames(data: bytes) -> Tuple[Optional[AudioFormat], bytes]:
+    """Format + just the frame bytes of an MP3 (b"" if nothing usable)."""
+    fmt, frames = parse_frames(data)
+    return fmt, b"".join(data[s:e] for s, e in frames)
+
+
+def join_clips(clips: List[bytes]) -> Optional[bytes]:
+    """Glue MP3 clips into one stream, frames only. None if they don't all share one format."""
+    formats = set()
+    joined = []
+    for clip in clips:
+        fmt, frames = audio_frames(clip)
+        if not fmt:
+            return None
+        formats.add(fmt)
+        joined.append(frames)
+    if len(formats) != 1:
+        return None
+    return b"".join(joined)
+
+
+def parse_output_format(output_format: str) -> Tuple[int, int]:
+    """"mp3_44100_128" -> (44100, 128)"""
+    m = re.fullmatch(r"mp3_(\d+)_(\d+)", output_format)
+    if not m:
+        raise ValueError(f"Unsupported output format for the jukebox: {output_format}")
+    return int(m.group(1)), int(m.group(2))
+
+
+# --- Registry ---
+class Song:
+    def __init__(self, name: str, path: str, audio: bytes, fmt: Optional[AudioFormat], frames: int):
+        self.name = name
+        self.path = path
+        # Frames only (no tags), ready to concatenate
+        # Usually a memoryview over the shared .frames mapping, any bytes-like works
+        self.audio = audio
+        self.format = fmt
+        self.frames = frames
+
+    @property
+    def duration_s(self) -> float:
+        if not self.format:
+            return 0.0
+        version, sample_rate, _ = self.format
+        return self.frames * (1152 if version == 3 else 576) / sample_rate
+
+
+def song_key(name: str) -> str:
+    # The name comes from the LLM, so only allow plain file names
+    return re.sub(r"[^a-z0-9_-]", "", name.lower())
+
+
+class SongRegistry:
+    """Every song in SONGS_DIR, loaded once and normalized to the TTS format."""
+
+    def __init__(self, output_format: str, songs_dir: str = SONGS_DIR, channels: int = CHANNELS,
+                 normalized_dir: str = NORMALIZED_DIR):
+        self.songs_dir = songs_dir
+        self.sample_rate, self.bitrate = parse_output_format(output_format)
+        self.channels = channels
+        self.normalized_dir = normalized_dir
+        self._songs: Dict[str, Song] = {}
+        self._loaded = False
+        self._lock = threading.Lock()
+        self.spliced = 0
+        self.transcoded = 0
+
+    @property
+    def target_format(self) -> AudioFormat:
+        version = 3 if self.sample_rate in _SAMPLE_RATES[3] else 2 if self.sample_rate in _SAMPLE_RATES[2] else 0
+        return version, self.sample_rate, self.channels
+
+    def load(self) -> int:
+        """(Re)load every song. Returns how many are available."""
+        songs = {}
+        if os.path.isdir(self.songs_dir):
+            for file_name in sorted(os.listdir(self.songs_dir)):
+                name, ext = os.path.splitext(file_name)
+                key = song_key(name)
+                if ext.lower() != ".mp3" or not key:
+                    continue
+                try:
+                    songs[key] = self._load_song(key, os.path.join(self.songs_dir, file_name))
+                except Exception as e:
+                    logger.error(f"Couldn't load song {file_name}: {e}")
+        with self._lock:
+            self._songs = songs
+            self._loaded = True
+        logger.info(f"Jukebox: {len(songs)} songs loaded ({', '.join(songs) or 'none'})")
+        return len(songs)
+
+    def _cache_path(self, digest: str, ext: str) -> str:
+        # Keyed by the source bytes + target format, so an edited song gets redone
+        return os.path.join(self.normalized_dir, f"{digest}-{self.sample_rate}-{self.channels}-{self.bitrate}{ext}")
+
+    def _load_song(self, name: str, path: str) -> Song:
+        with open(path, "rb") as f:
+            raw = f.read()
+        digest = hashlib.sha256(raw).hexdigest()[:16]
+        frames_path = self._cache_path(digest, ".frames")
+        if not os.path.exists(frames_path):
+            fmt, frames = parse_frames(raw)
+            if fmt != self.target_format:
+                raw = self._normalized(path, raw, digest)
+                fmt, frames = parse_frames(raw)
+            audio = b"".join(raw[s:e] for s, e in frames)
+            if not self._keep(frames_path, audio):
+                return Song(name, path, audio, fmt, len(frames))
+        return self._mapped(name, path, frames_path)
+
+    def _mapped(self, name: str, path: str, frames_path: str) -> Song:
+        # Just the spliceable frames, memory-mapped read-only: every worker process
+        # on the box shares the same page cache copy instead of holding its own
+        with open(frames_path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return Song(name, path, b"", None, 0)
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        fmt, frames = parse_frames(mapped)
+        return Song(name, path, memoryview(mapped), fmt, len(frames))
+
+    def _keep(self, target: str, data: bytes) -> bool:
+        # Atomic, so another worker loading at the same time never maps half a file
+        try:
+            os.makedirs(self.normalized_dir, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.normalized_dir, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, target)
+            return True
+        except OSError as e:
+            logger.warning(f"Couldn't write {target}: {e}")
+            return False
+
+    def _normalized(self, path: str, raw: bytes, digest: str) -> bytes:
+        # Re-encode once to the TTS format
+        cached = self._cache_path(digest, ".mp3")
+        if os.path.exists(cached):
+            with open(cached, "rb") as f:
+                return f.read()
+
+        logger.info(f"Normalizing {path} to {self.sample_rate}Hz/{self.channels}ch/{self.bitrate}k...")
+        # pydub only gets imported if a song actually needs converting
+        from pydub import AudioSegment
+        song = AudioSegment.from_file(io.BytesIO(raw)).set_frame_rate(self.sample_rate).set_channels(self.channels)
+        buffer = io.BytesIO()
+        # No Xing header, it would end up in the middle of the mixed file
+        song.export(buffer, format="mp3", bitrate=f"{self.bitrate}k", parameters=["-write_xing", "0"])
+        out = buffer.getvalue()
+        self._keep(cached, out)
+        return out
+
+    def _ensure_loaded(self):
+        # Startup normally does this, but the CLI/Streamlit never run startup
+        if not self._loaded:
+            self.load()
+
+    def get(self, name: str) -> Optional[Song]:
+        self._ensure_loaded()
+        return self._songs.get(song_key(name))
+
+    def names(self) -> List[str]:
+        self._ensure_loaded()
+        return sorted(self._songs)
+
+    def splice(self, intro_bytes: Optional[bytes], song: Song, outro_bytes: Optional[bytes]) -> Optional[bytes]:
+        """Intro + song + outro by concatenating frames. None if any part doesn't match the song's format."""
+        if not song.format:
+            return None
+        clips = []
+        for clip in (intro_bytes, outro_bytes):
+            if not clip:
+                clips.append(b"")
+                continue
+            fmt, frames = audio_frames(clip)
+            if fmt != song.format:
+                return None
+            clips.append(frames)
+        with self._lock:
+            self.spliced += 1
+        return clips[0] + song.audio + clips[1]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "songs": {name: round(song.duration_s, 1) for name, song in self._songs.items()},
+            "target_format": self.target_format,
+            "spliced": self.spliced,
+            "transcoded": self.transcoded,
+        }
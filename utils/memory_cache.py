@@ -0,0 +1,148 @@
+# Author: Steven Lansangan
+# In-process LRU cache of user memory snapshots
+# Users usually send a few messages in a row, so we keep their memory around
+# instead of hitting SQLite on every turn. Writes update the cached copy too.
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional
+
+
+class MemoryCache:
+    """
+    Size- and TTL-bounded LRU keyed by user_id.
+
+    Loads go through begin_load()/put() so a snapshot read from the db can't
+    overwrite a newer write that landed while the read was running.
+    Writes go through begin_write()/end_write() around their transaction: while
+    one is open the user's entry isn't served and no load gets cached, so nobody
+    sees the cache lag behind (or run ahead of) what's committed.
+    """
+
+    def __init__(self, max_entries: int = 10000, ttl: float = 300.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        # user_id -> number of db loads currently running for that user
+        self._loading: Dict[str, int] = {}
+        # users written to while a load was running, those loads must not be cached
+        self._dirty = set()
+        # user_id -> number of write transactions currently open for that user
+        self._writing: Dict[str, int] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def get(self, user_id: str) -> Optional[Dict[str, Any]]:
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or user_id in self._writing:
+                self.misses += 1
+                return None
+            memory, loaded_at = entry
+            if time.monotonic() - loaded_at > self.ttl:
+                del self._entries[user_id]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return memory
+
+    def begin_load(self, user_id: str):
+        """Call before reading a user from the db, then hand the result to put()."""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._loading[user_id] = self._loading.get(user_id, 0) + 1
+
+    def put(self, user_id: str, memory: Dict[str, Any], loaded: bool = True):
+        """Store a snapshot. With loaded=True this closes a begin_load()."""
+        if not self.enabled:
+            return
+        with self._lock:
+            if loaded:
+                stale = user_id in self._dirty or user_id in self._writing
+                remaining = self._loading.get(user_id, 1) - 1
+                if remaining <= 0:
+                    self._loading.pop(user_id, None)
+                    self._dirty.discard(user_id)
+                else:
+                    self._loading[user_id] = remaining
+                if stale:
+                    return
+            if not memory:
+                return
+            self._entries[user_id] = (memory, time.monotonic())
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def begin_write(self, user_id: str):
+        """Call before a write transaction for this user starts, then end_write() once it's over."""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._writing[user_id] = self._writing.get(user_id, 0) + 1
+            if user_id in self._loading:
+                self._dirty.add(user_id)
+
+    def end_write(self, user_id: str, fn: Optional[Callable[[Dict[str, Any]], Dict[str, Any]]] = None):
+        """The write is over: with fn (it committed) the cached snapshot becomes fn(old),
+        without (rolled back, or unknown) the entry is dropped."""
+        if not self.enabled:
+            return
+        with self._lock:
+            remaining = self._writing.get(user_id, 1) - 1
+            if remaining <= 0:
+                self._writing.pop(user_id, None)
+            else:
+                self._writing[user_id] = remaining
+            # Loads that overlapped the write may have read either side of the commit
+            if user_id in self._loading:
+                self._dirty.add(user_id)
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return
+            if fn is None:
+                del self._entries[user_id]
+                return
+            memory, loaded_at = entry
+            try:
+                self._entries[user_id] = (fn(memory), loaded_at)
+            except Exception:
+                # Rather drop it than serve something half-updated
+                del self._entries[user_id]
+
+    def invalidate(self, user_id: str = None):
+        with self._lock:
+            if user_id is None:
+                self._entries.clear()
+                self._dirty.update(self._loading)
+            else:
+                self._entries.pop(user_id, None)
+                if user_id in self._loading:
+                    self._dirty.add(user_id)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_s": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
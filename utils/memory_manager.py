@@ -1,240 +1,1047 @@
 # Author: Steven Lansangan
 # Project: Cloud for Babaru
 # This handles all the database stuff so Babaru remembers you
+import os
+import zlib
 import sqlite3
 import json
+import time
 import logging
+from contextlib import contextmanager
 from datetime import datetime
-from typing import Dict, List, Any, Optional
+from typing import Callable, Dict, Iterable, List, Any, Optional, Tuple
+
+from utils import db_pool
+from utils.memory_cache import MemoryCache
 
 DB_PATH = "babaru.db"
 
-# basic logging setup
-logging.basicConfig(level=logging.INFO)
+# How many recent messages get_user_memory hands back under 'conversations'
+# The full log stays in the messages table, this is just the working window
+HISTORY_WINDOW = 50
+
+# SQLite caps bound parameters per statement, so batch operations go in chunks
+_BATCH_CHUNK = 500
+
 logger = logging.getLogger("MemoryManager")
 
-def get_db_connection():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+# --- Sharding ---
+# With BABARU_DB_SHARDS > 1 users are hash-partitioned across that many SQLite files,
+# each with its own pool and writer. Callers never see this, every helper routes by user_id.
+SHARD_COUNT = int(os.getenv("BABARU_DB_SHARDS", "1"))
+
+def shard_index(user_id: str, count: Optional[int] = None) -> int:
+    count = count or SHARD_COUNT
+    # crc32 is stable across processes and Python versions, unlike hash()
+    return zlib.crc32(user_id.encode("utf-8")) % count if count > 1 else 0
+
+def shard_path(index: int, count: Optional[int] = None) -> str:
+    """File for one shard. The shard count is part of the name so a rebalance never overwrites live files."""
+    count = count or SHARD_COUNT
+    if count == 1:
+        return DB_PATH
+    root, ext = os.path.splitext(DB_PATH)
+    return f"{root}.shard{index}of{count}{ext or '.db'}"
+
+def get_pool(user_id: Optional[str] = None) -> db_pool.ConnectionPool:
+    """Pooled connections (WAL mode, many readers + one writer) for the shard that owns user_id."""
+    if SHARD_COUNT == 1:
+        return db_pool.get_pool(DB_PATH)
+    if user_id is None:
+        raise ValueError("user_id is required to pick a shard")
+    return db_pool.get_pool(shard_path(shard_index(user_id)))
+
+def shard_pool(index: int, count: Optional[int] = None) -> db_pool.ConnectionPool:
+    return db_pool.get_pool(shard_path(index, count))
+
+def all_pools(count: Optional[int] = None) -> List[db_pool.ConnectionPool]:
+    count = count or SHARD_COUNT
+    return [shard_pool(i, count) for i in range(count)]
+
+def group_by_shard(user_ids: Iterable[str]) -> Dict[int, List[str]]:
+    groups: Dict[int, List[str]] = {}
+    for user_id in user_ids:
+        groups.setdefault(shard_index(user_id), []).append(user_id)
+    return groups
+
+def pool_stats() -> List[Dict[str, Any]]:
+    """Connection pool usage per shard, including how long callers waited for a connection."""
+    return [pool.stats() for pool in all_pools()]
+
+# Recently used memory snapshots, kept in sync by every write below
+memory_cache = MemoryCache(
+    max_entries=int(os.getenv("BABARU_MEMORY_CACHE_SIZE", "10000")),
+    ttl=float(os.getenv("BABARU_MEMORY_CACHE_TTL", "300")),
+)
 
 def init_db():
-    conn = get_db_connection()
-    c = conn.cursor()
+    for pool in all_pools():
+        init_schema(pool)
+    logger.info("Database initialized successfully.")
+
+def init_schema(pool: db_pool.ConnectionPool):
+    with pool.writer() as conn:
+        c = conn.cursor()
     
-    # User Identity Table
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS use_identity (
-            user_id TEXT PRIMARY KEY,
-            name TEXT,
-            timezone TEXT
-        )
-    ''')
+        # User Identity Table
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS use_identity (
+                user_id TEXT PRIMARY KEY,
+                name TEXT,
+                timezone TEXT
+            )
+        ''')
     
-    # Progression Table
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS progression (
-            user_id TEXT PRIMARY KEY,
-            rank TEXT DEFAULT 'Newcomer',
-            points INTEGER DEFAULT 0,
-            streak_days INTEGER DEFAULT 0,
-            FOREIGN KEY (user_id) REFERENCES use_identity(user_id)
-        )
-    ''')
-
-    # Missions Table (JSON columns)
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS missions (
-            user_id TEXT PRIMARY KEY,
-            active TEXT DEFAULT '[]',
-            completed TEXT DEFAULT '[]',
-            failed TEXT DEFAULT '[]',
-            FOREIGN KEY (user_id) REFERENCES use_identity(user_id)
-        )
-    ''')
-
-    # Conversations Table (Rolling window)
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS conversations (
-            user_id TEXT PRIMARY KEY,
-            history TEXT DEFAULT '[]',
-            last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES use_identity(user_id)
-        )
-    ''')
-
-    # Core Profile Table
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS core_profile (
-            user_id TEXT PRIMARY KEY,
-            primary_goal TEXT,
-            obstacles TEXT,
-            wins TEXT,
-            communication_preferences TEXT,
-            FOREIGN KEY (user_id) REFERENCES use_identity(user_id)
-        )
-    ''')
-
-    # Relationship Table
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS relationship (
-            user_id TEXT PRIMARY KEY,
-            familiarity_level INTEGER DEFAULT 1,
-            trust_level INTEGER DEFAULT 1,
-            FOREIGN KEY (user_id) REFERENCES use_identity(user_id)
-        )
-    ''')
+        # Progression Table
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS progression (
+                user_id TEXT PRIMARY KEY,
+                rank TEXT DEFAULT 'Newcomer',
+                points INTEGER DEFAULT 0,
+                streak_days INTEGER DEFAULT 0,
+                FOREIGN KEY (user_id) REFERENCES use_identity(user_id)
+            )
+        ''')
+
+        # Missions Table (JSON columns)
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS missions (
+                user_id TEXT PRIMARY KEY,
+                active TEXT DEFAULT '[]',
+                completed TEXT DEFAULT '[]',
+                failed TEXT DEFAULT '[]',
+                FOREIGN KEY (user_id) REFERENCES use_identity(user_id)
+            )
+        ''')
+
+        # Conversations Table (last activity, history column is legacy and gets migrated into messages)
+        # timezone is a copy of use_identity.timezone, so "active users in this timezone" is one index range
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS conversations (
+                user_id TEXT PRIMARY KEY,
+                history TEXT DEFAULT '[]',
+                last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                timezone TEXT,
+                FOREIGN KEY (user_id) REFERENCES use_identity(user_id)
+            )
+        ''')
+        if "timezone" not in [row[1] for row in c.execute("PRAGMA table_info(conversations)")]:
+            c.execute("ALTER TABLE conversations ADD COLUMN timezone TEXT")
+
+        # Messages Table (append-only conversation log)
+        # One row per message so appending never touches the older history
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL,
+                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES use_identity(user_id)
+            )
+        ''')
+        c.execute("CREATE INDEX IF NOT EXISTS idx_messages_user_ts ON messages (user_id, timestamp)")
+
+        # Core Profile Table
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS core_profile (
+                user_id TEXT PRIMARY KEY,
+                primary_goal TEXT,
+                obstacles TEXT,
+                wins TEXT,
+                communication_preferences TEXT,
+                FOREIGN KEY (user_id) REFERENCES use_identity(user_id)
+            )
+        ''')
+
+        # Relationship Table
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS relationship (
+                user_id TEXT PRIMARY KEY,
+                familiarity_level INTEGER DEFAULT 1,
+                trust_level INTEGER DEFAULT 1,
+                FOREIGN KEY (user_id) REFERENCES use_identity(user_id)
+            )
+        ''')
+
+        # Conversation Summaries Table (rolling long-term memory)
+        # summarized_until is the last messages.id already folded into the summary
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS conversation_summaries (
+                user_id TEXT PRIMARY KEY,
+                summary TEXT DEFAULT '',
+                summarized_until INTEGER DEFAULT 0,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES use_identity(user_id)
+            )
+        ''')
+
+        # Post-turn jobs (durable queue, see backend/post_turn.py)
+        # A job is deleted in the same transaction that applies it, so it's applied exactly once
+        # available_at NULL means it ran out of attempts and is parked for a human to look at
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS turn_jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                attempts INTEGER DEFAULT 0,
+                available_at REAL,
+                last_error TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        c.execute("CREATE INDEX IF NOT EXISTS idx_turn_jobs_user ON turn_jobs (user_id, id)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_turn_jobs_available ON turn_jobs (available_at)")
+
+        # What the nudge scheduler (backend/nudges.py) looks users up by, so it never scans everyone
+        # last_updated + user_id: "who went quiet since the last sweep" is a range scan, in keyset order
+        c.execute("CREATE INDEX IF NOT EXISTS idx_conversations_last_updated ON conversations (last_updated, user_id)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_identity_timezone ON use_identity (timezone)")
+        # timezone + last_updated: a morning only reads the users in that timezone who were active lately
+        c.execute("CREATE INDEX IF NOT EXISTS idx_conversations_timezone ON conversations (timezone, last_updated, user_id)")
+
+        # Every timezone conversations has ever had, so the scheduler's "which timezones are there"
+        # reads a handful of rows. Kept up by triggers (create, bulk create, import, rebalance all
+        # go through them), never shrinks: a timezone nobody is in anymore just has an empty morning
+        new_table = c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'timezones'").fetchone() is None
+        c.execute("CREATE TABLE IF NOT EXISTS timezones (timezone TEXT PRIMARY KEY)")
+        c.execute('''
+            CREATE TRIGGER IF NOT EXISTS conversations_timezone_insert AFTER INSERT ON conversations
+            WHEN NEW.timezone IS NOT NULL
+            BEGIN INSERT OR IGNORE INTO timezones (timezone) VALUES (NEW.timezone); END
+        ''')
+        c.execute('''
+            CREATE TRIGGER IF NOT EXISTS conversations_timezone_update AFTER UPDATE OF timezone ON conversations
+            WHEN NEW.timezone IS NOT NULL
+            BEGIN INSERT OR IGNORE INTO timezones (timezone) VALUES (NEW.timezone); END
+        ''')
+
+        # Nudges Babaru came up with on his own, waiting for the client to pick them up
+        # response NULL = claimed, still being generated. The UNIQUE makes each nudge happen once
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS nudges (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                nudge_key TEXT NOT NULL,
+                response TEXT,
+                created_at REAL NOT NULL,
+                delivered_at REAL,
+                UNIQUE (user_id, kind, nudge_key)
+            )
+        ''')
+        c.execute("CREATE INDEX IF NOT EXISTS idx_nudges_created ON nudges (created_at)")
+
+        # Scheduler bookkeeping (sweep watermarks, last morning per timezone), so restarts pick up where they left off
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS scheduler_marks (
+                name TEXT PRIMARY KEY,
+                value TEXT
+            )
+        ''')
     
-    conn.commit()
-    conn.close()
-    logger.info("Database initialized successfully.")
+        migrate_conversation_history(conn)
+        copy_timezones(conn)
+        if new_table:
+            # Databases from before the table: one pass over the index, only the first time
+            c.execute("INSERT OR IGNORE INTO timezones (timezone) SELECT DISTINCT timezone FROM conversations WHERE timezone IS NOT NULL")
+
+def migrate_conversation_history(conn: sqlite3.Connection):
+    """Move old JSON blobs from conversations.history into the messages table.
+    Runs inside the caller's write transaction. Safe to run on every startup,
+    rows that were already moved are left as '[]'."""
+    rows = conn.execute(
+        "SELECT user_id, history, last_updated FROM conversations WHERE history IS NOT NULL AND history != '[]'"
+    ).fetchall()
+    if not rows:
+        return
+
+    moved = 0
+    for row in rows:
+        try:
+            history = json.loads(row['history'])
+        except (TypeError, ValueError):
+            logger.error(f"Skipping unreadable history for {row['user_id']}")
+            continue
+
+        # Old blobs have no per-message time, so everything gets the last_updated stamp
+        # The autoincrement id keeps the original order
+        ts = row['last_updated'] or datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+        conn.executemany(
+            "INSERT INTO messages (user_id, role, content, timestamp) VALUES (?, ?, ?, ?)",
+            [(row['user_id'], m.get('role', 'user'), m.get('content', ''), ts) for m in history],
+        )
+        conn.execute("UPDATE conversations SET history = '[]' WHERE user_id = ?", (row['user_id'],))
+        moved += len(history)
+
+    logger.info(f"Migrated {moved} messages from {len(rows)} conversation blobs.")
+
+def copy_timezones(conn: sqlite3.Connection, user_ids: Optional[List[str]] = None):
+    """Copy use_identity.timezone onto conversations (users without one count as UTC).
+    Without user_ids it fills in every row that doesn't have one yet."""
+    copy = """UPDATE conversations SET timezone = COALESCE(
+                  (SELECT i.timezone FROM use_identity i WHERE i.user_id = conversations.user_id), 'UTC')"""
+    if user_ids is None:
+        conn.execute(copy + " WHERE timezone IS NULL")
+    else:
+        conn.executemany(copy + " WHERE user_id = ?", [(user_id,) for user_id in user_ids])
 
 # --- Helper Functions ---
 
 def create_user(user_id: str, name: str, timezone: str = "UTC"):
     """Initialize a new user with default values across all tables."""
-    conn = get_db_connection()
     try:
-        c = conn.cursor()
-        
-        # Check if user exists
-        c.execute("SELECT user_id FROM use_identity WHERE user_id = ?", (user_id,))
-        if c.fetchone():
-            logger.info(f"User {user_id} already exists.")
-            return
-
-        c.execute("INSERT INTO use_identity (user_id, name, timezone) VALUES (?, ?, ?)", (user_id, name, timezone))
-        c.execute("INSERT INTO progression (user_id) VALUES (?)", (user_id,))
-        c.execute("INSERT INTO missions (user_id) VALUES (?)", (user_id,))
-        c.execute("INSERT INTO conversations (user_id) VALUES (?)", (user_id,))
-        c.execute("INSERT INTO core_profile (user_id) VALUES (?)", (user_id,))
-        c.execute("INSERT INTO relationship (user_id) VALUES (?)", (user_id,))
-        
-        conn.commit()
+        with get_pool(user_id).writer() as conn:
+            c = conn.cursor()
+
+            # Check if user exists
+            c.execute("SELECT user_id FROM use_identity WHERE user_id = ?", (user_id,))
+            if c.fetchone():
+                logger.info(f"User {user_id} already exists.")
+                return
+
+            c.execute("INSERT INTO use_identity (user_id, name, timezone) VALUES (?, ?, ?)", (user_id, name, timezone))
+            c.execute("INSERT INTO progression (user_id) VALUES (?)", (user_id,))
+            c.execute("INSERT INTO missions (user_id) VALUES (?)", (user_id,))
+            c.execute("INSERT INTO conversations (user_id, timezone) VALUES (?, ?)", (user_id, timezone or "UTC"))
+            c.execute("INSERT INTO core_profile (user_id) VALUES (?)", (user_id,))
+            c.execute("INSERT INTO relationship (user_id) VALUES (?)", (user_id,))
+
+        memory_cache.put(user_id, new_user_memory(user_id, name, timezone), loaded=False)
         logger.info(f"User {user_id} created.")
     except Exception as e:
         logger.error(f"Error creating user: {e}")
-    finally:
-        conn.close()
+
+def create_users(users: Iterable[Dict[str, str]], chunk_size: int = _BATCH_CHUNK) -> int:
+    """
+    Bulk version of create_user for onboarding a whole cohort.
+    Takes dicts with user_id, name and optional timezone. Users that already exist are skipped.
+    Each chunk is one transaction with one executemany per table. Returns how many were created.
+    """
+    created = 0
+    chunk = []
+
+    def flush(rows):
+        added = 0
+        by_shard: Dict[int, list] = {}
+        for row in rows:
+            by_shard.setdefault(shard_index(row[0]), []).append(row)
+        for shard, shard_rows in by_shard.items():
+            ids = [(r[0],) for r in shard_rows]
+            with shard_pool(shard).writer() as conn:
+                cur = conn.executemany("INSERT OR IGNORE INTO use_identity (user_id, name, timezone) VALUES (?, ?, ?)", shard_rows)
+                added += cur.rowcount
+                for table in ("progression", "missions", "core_profile", "relationship"):
+                    conn.executemany(f"INSERT OR IGNORE INTO {table} (user_id) VALUES (?)", ids)
+                conn.executemany("INSERT OR IGNORE INTO conversations (user_id, timezone) VALUES (?, ?)",
+                                 [(r[0], r[2]) for r in shard_rows])
+        return added
+
+    for user in users:
+        chunk.append((user['user_id'], user.get('name', 'Traveler'), user.get('timezone') or 'UTC'))
+        if len(chunk) >= chunk_size:
+            created += flush(chunk)
+            chunk = []
+    if chunk:
+        created += flush(chunk)
+
+    logger.info(f"Bulk created {created} users.")
+    return created
+
+# Plain columns for each memory section, in the dict shape prompt_builder expects
+_MEMORY_SECTIONS = {
+    'identity': ('i', ['user_id', 'name', 'timezone']),
+    'progression': ('p', ['user_id', 'rank', 'points', 'streak_days']),
+    'profile': ('cp', ['user_id', 'primary_goal', 'obstacles', 'wins', 'communication_preferences']),
+    'relationship': ('r', ['user_id', 'familiarity_level', 'trust_level']),
+}
+
+def _build_snapshot_sql() -> str:
+    cols = []
+    for section, (alias, fields) in _MEMORY_SECTIONS.items():
+        cols += [f"{alias}.{f} AS {section}__{f}" for f in fields]
+    # Missions stay as raw JSON text, the history window is packed into one JSON array
+    # so the whole memory comes back as a single row per user
+    cols += [
+        "m.user_id AS missions__user_id",
+        "m.active AS missions__active",
+        "m.completed AS missions__completed",
+        "m.failed AS missions__failed",
+        """(SELECT json_group_array(json_object('role', role, 'content', content)) FROM (
+                SELECT role, content FROM messages WHERE user_id = i.user_id
+                ORDER BY timestamp DESC, id DESC LIMIT ?
+            )) AS history_json""",
+        # How many of them the rolling summary doesn't cover yet (only counted as far as the window goes)
+        """(SELECT COUNT(*) FROM (
+                SELECT 1 FROM messages WHERE user_id = i.user_id AND id > COALESCE(cs.summarized_until, 0) LIMIT ?
+            )) AS unsummarized""",
+        "cs.summary AS summary",
+    ]
+    return (
+        "SELECT " + ",\n".join(cols) + """
+        FROM use_identity i
+        LEFT JOIN progression p ON p.user_id = i.user_id
+        LEFT JOIN missions m ON m.user_id = i.user_id
+        LEFT JOIN core_profile cp ON cp.user_id = i.user_id
+        LEFT JOIN relationship r ON r.user_id = i.user_id
+        LEFT JOIN conversation_summaries cs ON cs.user_id = i.user_id
+        """
+    )
+
+_SNAPSHOT_SQL = _build_snapshot_sql()
+
+class MemorySnapshot(dict):
+    """
+    A user memory dict that decodes its JSON sections the first time they are read.
+    Behaves like the plain dict get_user_memory always returned.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._pending = {}
+
+    def _defer(self, key, loader):
+        self._pending[key] = loader
+
+    def _resolve(self, key):
+        loader = self._pending.pop(key, None)
+        if loader is not None:
+            dict.__setitem__(self, key, loader())
+
+    def _resolve_all(self):
+        for key in list(self._pending):
+            self._resolve(key)
+
+    def __missing__(self, key):
+        if key in self._pending:
+            self._resolve(key)
+            return dict.__getitem__(self, key)
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        self._resolve(key)
+        return dict.get(self, key, default)
+
+    def __contains__(self, key):
+        return key in self._pending or dict.__contains__(self, key)
+
+    def __setitem__(self, key, value):
+        self._pending.pop(key, None)
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        self._resolve(key)
+        dict.__delitem__(self, key)
+
+    def pop(self, key, *default):
+        self._resolve(key)
+        return dict.pop(self, key, *default)
+
+    def setdefault(self, key, default=None):
+        self._resolve(key)
+        return dict.setdefault(self, key, default)
+
+    # Anything that walks the whole dict (json.dumps, dict(), st.json) decodes everything first
+    def __iter__(self):
+        self._resolve_all()
+        return dict.__iter__(self)
+
+    def __len__(self):
+        return dict.__len__(self) + len(self._pending)
+
+    def keys(self):
+        self._resolve_all()
+        return dict.keys(self)
+
+    def items(self):
+        self._resolve_all()
+        return dict.items(self)
+
+    def values(self):
+        self._resolve_all()
+        return dict.values(self)
+
+    def copy(self):
+        self._resolve_all()
+        return dict(dict.items(self))
+
+    def __eq__(self, other):
+        self._resolve_all()
+        return dict.__eq__(self, other)
+
+    __hash__ = None
+
+    def __repr__(self):
+        self._resolve_all()
+        return dict.__repr__(self)
+
+    def with_section(self, key, value) -> "MemorySnapshot":
+        """Copy with one section swapped out. Sections that weren't read yet stay undecoded."""
+        copy = MemorySnapshot(dict.items(self))
+        copy._pending = dict(self._pending)
+        copy[key] = value
+        return copy
+
+def _snapshot_from_row(row: sqlite3.Row) -> MemorySnapshot:
+    memory = MemorySnapshot()
+    for section, (_, fields) in _MEMORY_SECTIONS.items():
+        # LEFT JOIN gives NULL user_id when the row is missing, keep {} like before
+        if row[f"{section}__user_id"] is None:
+            memory[section] = {}
+        else:
+            memory[section] = {f: row[f"{section}__{f}"] for f in fields}
+
+    if row['missions__user_id'] is not None:
+        raw = (row['missions__active'], row['missions__completed'], row['missions__failed'])
+        memory._defer('missions', lambda: {
+            'active': json.loads(raw[0]),
+            'completed': json.loads(raw[1]),
+            'failed': json.loads(raw[2]),
+        })
+
+    # Newest first comes out of the index, flip it back to oldest first
+    history_json = row['history_json'] or '[]'
+    memory._defer('conversations', lambda: json.loads(history_json)[::-1])
+    memory['summary'] = row['summary'] or ''
+    memory['unsummarized'] = row['unsummarized']
+    return memory
 
 def get_user_memory(user_id: str) -> Dict[str, Any]:
-    """Retrieve the full user memory state."""
-    conn = get_db_connection()
+    """Retrieve the full user memory state in one query. JSON fields are decoded lazily.
+    Served from memory_cache when the user was seen recently."""
+    cached = memory_cache.get(user_id)
+    if cached is not None:
+        return cached
+
+    memory_cache.begin_load(user_id)
     memory = {}
     try:
-        c = conn.cursor()
-        
-        # Identity
-        identity = c.execute("SELECT * FROM use_identity WHERE user_id = ?", (user_id,)).fetchone()
-        if not identity:
-            return {}
-        memory['identity'] = dict(identity)
-        
-        # Progression
-        progression = c.execute("SELECT * FROM progression WHERE user_id = ?", (user_id,)).fetchone()
-        memory['progression'] = dict(progression) if progression else {}
-        
-        # Missions
-        missions = c.execute("SELECT * FROM missions WHERE user_id = ?", (user_id,)).fetchone()
-        if missions:
-            memory['missions'] = {
-                'active': json.loads(missions['active']),
-                'completed': json.loads(missions['completed']),
-                'failed': json.loads(missions['failed'])
-            }
-        
-        # Conversations
-        conversations = c.execute("SELECT * FROM conversations WHERE user_id = ?", (user_id,)).fetchone()
-        memory['conversations'] = json.loads(conversations['history']) if conversations else []
-        
-        # Profile
-        profile = c.execute("SELECT * FROM core_profile WHERE user_id = ?", (user_id,)).fetchone()
-        memory['profile'] = dict(profile) if profile else {}
-        
-        # Relationship
-        relationship = c.execute("SELECT * FROM relationship WHERE user_id = ?", (user_id,)).fetchone()
-        memory['relationship'] = dict(relationship) if relationship else {}
-        
+        with get_pool(user_id).reader() as conn:
+            row = conn.execute(_SNAPSHOT_SQL + " WHERE i.user_id = ?", (HISTORY_WINDOW, HISTORY_WINDOW, user_id)).fetchone()
+        memory = _snapshot_from_row(row) if row else {}
     except Exception as e:
         logger.error(f"Error fetching memory: {e}")
     finally:
-        conn.close()
-    
+        memory_cache.put(user_id, memory)
     return memory
 
-def update_progression(user_id: str, updates: Dict[str, Any]):
-    """Update progression fields (rank, points, streak)."""
-    conn = get_db_connection()
+def get_user_memories(user_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+    """Batch version of get_user_memory for fan-out jobs. Unknown users are left out."""
+    memories = {}
+    missing = []
+    for user_id in dict.fromkeys(user_ids):
+        cached = memory_cache.get(user_id)
+        if cached is not None:
+            memories[user_id] = cached
+        else:
+            missing.append(user_id)
+    if not missing:
+        return memories
+
+    for user_id in missing:
+        memory_cache.begin_load(user_id)
+    loaded = {}
     try:
-        updates_sql = ", ".join([f"{k} = ?" for k in updates.keys()])
-        values = list(updates.values()) + [user_id]
-        conn.execute(f"UPDATE progression SET {updates_sql} WHERE user_id = ?", values)
-        conn.commit()
+        for shard, shard_ids in group_by_shard(missing).items():
+            with shard_pool(shard).reader() as conn:
+                for i in range(0, len(shard_ids), _BATCH_CHUNK):
+                    chunk = shard_ids[i:i + _BATCH_CHUNK]
+                    placeholders = ", ".join("?" * len(chunk))
+                    rows = conn.execute(
+                        _SNAPSHOT_SQL + f" WHERE i.user_id IN ({placeholders})",
+                        [HISTORY_WINDOW, HISTORY_WINDOW] + chunk,
+                    ).fetchall()
+                    for row in rows:
+                        loaded[row['identity__user_id']] = _snapshot_from_row(row)
+    except Exception as e:
+        logger.error(f"Error fetching memories: {e}")
     finally:
-        conn.close()
+        for user_id in missing:
+            memory_cache.put(user_id, loaded.get(user_id, {}))
+    memories.update(loaded)
+    return memories
 
-def update_missions(user_id: str, active: Optional[List] = None, completed: Optional[List] = None, failed: Optional[List] = None):
-    """Update mission lists."""
-    conn = get_db_connection()
+def new_user_memory(user_id: str, name: str, timezone: str = "UTC") -> Dict[str, Any]:
+    """The memory a freshly created user has, without reading it back from the db."""
+    return MemorySnapshot({
+        'identity': {'user_id': user_id, 'name': name, 'timezone': timezone},
+        'progression': {'user_id': user_id, 'rank': 'Newcomer', 'points': 0, 'streak_days': 0},
+        'missions': {'active': [], 'completed': [], 'failed': []},
+        'conversations': [],
+        'profile': {'user_id': user_id, 'primary_goal': None, 'obstacles': None, 'wins': None, 'communication_preferences': None},
+        'relationship': {'user_id': user_id, 'familiarity_level': 1, 'trust_level': 1},
+        'summary': '',
+        'unsummarized': 0,
+    })
+
+# Each write has an _apply_* version that runs on a connection we already hold,
+# so several of them can share one transaction
+
+@contextmanager
+def _write_through(user_id: str, cached: Optional[Callable[[Dict[str, Any]], Dict[str, Any]]]):
+    """Writer transaction for one user. The cached snapshot is held back while it's open
+    and becomes cached(old) once it commits (dropped if it doesn't, or cached is None)."""
+    memory_cache.begin_write(user_id)
+    committed = False
     try:
-        data = {}
-        if active is not None: data['active'] = json.dumps(active)
-        if completed is not None: data['completed'] = json.dumps(completed)
-        if failed is not None: data['failed'] = json.dumps(failed)
-        
-        if data:
-            updates_sql = ", ".join([f"{k} = ?" for k in data.keys()])
-            values = list(data.values()) + [user_id]
-            conn.execute(f"UPDATE missions SET {updates_sql} WHERE user_id = ?", values)
-            conn.commit()
+        with get_pool(user_id).writer() as conn:
+            yield conn
+        committed = True
     finally:
-        conn.close()
+        memory_cache.end_write(user_id, cached if committed else None)
+
+def _apply_progression(conn: sqlite3.Connection, user_id: str, updates: Dict[str, Any]):
+    if not updates:
+        return
+    updates_sql = ", ".join([f"{k} = ?" for k in updates.keys()])
+    values = list(updates.values()) + [user_id]
+    conn.execute(f"UPDATE progression SET {updates_sql} WHERE user_id = ?", values)
+
+def update_progression(user_id: str, updates: Dict[str, Any]):
+    """Update progression fields (rank, points, streak)."""
+    with _write_through(user_id, lambda mem: mem.with_section('progression', {**mem.get('progression', {}), **updates})) as conn:
+        _apply_progression(conn, user_id, updates)
+
+def _apply_missions(conn: sqlite3.Connection, user_id: str, data: Dict[str, List]):
+    if not data:
+        return
+    updates_sql = ", ".join([f"{k} = ?" for k in data.keys()])
+    values = [json.dumps(v) for v in data.values()] + [user_id]
+    conn.execute(f"UPDATE missions SET {updates_sql} WHERE user_id = ?", values)
+
+def update_missions(user_id: str, active: Optional[List] = None, completed: Optional[List] = None, failed: Optional[List] = None):
+    """Update mission lists."""
+    data = {}
+    if active is not None: data['active'] = active
+    if completed is not None: data['completed'] = completed
+    if failed is not None: data['failed'] = failed
+
+    if not data:
+        return
+    with _write_through(user_id, lambda mem: mem.with_section('missions', {**mem.get('missions', {}), **data})) as conn:
+        _apply_missions(conn, user_id, data)
+
+def _fetch_recent_messages(c, user_id: str, limit: int) -> List[Dict[str, str]]:
+    # Walks the (user_id, timestamp) index backwards so this only touches `limit` rows
+    rows = c.execute(
+        "SELECT role, content FROM messages WHERE user_id = ? ORDER BY timestamp DESC, id DESC LIMIT ?",
+        (user_id, limit),
+    ).fetchall()
+    return [{"role": r['role'], "content": r['content']} for r in reversed(rows)]
+
+def get_recent_messages(user_id: str, limit: int = HISTORY_WINDOW) -> List[Dict[str, str]]:
+    """Return the last `limit` messages for a user, oldest first."""
+    with get_pool(user_id).reader() as conn:
+        return _fetch_recent_messages(conn, user_id, limit)
+
+def sql_timestamp(epoch: float) -> str:
+    """An epoch in sqlite's CURRENT_TIMESTAMP format (UTC), so it sorts and compares with the stored ones."""
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(epoch))
+
+def _apply_messages(conn: sqlite3.Connection, user_id: str, messages: List[Dict[str, str]], at: Optional[float] = None):
+    # `at` is when the messages were actually said (a queued turn can be applied much later), default now
+    if not messages:
+        return
+    stamp = sql_timestamp(at if at is not None else time.time())
+    conn.executemany(
+        "INSERT INTO messages (user_id, role, content, timestamp) VALUES (?, ?, ?, ?)",
+        [(user_id, m['role'], m['content'], stamp) for m in messages],
+    )
+    conn.execute("UPDATE conversations SET last_updated = ? WHERE user_id = ?", (stamp, user_id))
 
 def update_conversation_history(user_id: str, message: Dict[str, str]):
-    """Append a message to the conversation history (rolling window logic can be added here)."""
-    conn = get_db_connection()
-    try:
-        c = conn.cursor()
-        current = c.execute("SELECT history FROM conversations WHERE user_id = ?", (user_id,)).fetchone()
-        history = json.loads(current['history']) if current else []
-        
-        history.append(message)
-        # Keep last 30 days or N messages - for now just simple trim if too long? 
-        # Requirement says "Rolling window of the last 30 days". 
-        # For simplicity, let's keep last 50 messages for now or just append. 
-        # The prompt builder will likely filter.
-        
-        conn.execute("UPDATE conversations SET history = ?, last_updated = CURRENT_TIMESTAMP WHERE user_id = ?", (json.dumps(history), user_id))
-        conn.commit()
-    finally:
-        conn.close()
+    """Append a message to the conversation log. Cost doesn't grow with history size."""
+    entry = {"role": message['role'], "content": message['content']}
+    with _write_through(user_id, lambda mem: mem.with_section(
+        'conversations', (mem.get('conversations', []) + [entry])[-HISTORY_WINDOW:]
+    ).with_section('unsummarized', min(mem.get('unsummarized', 0) + 1, HISTORY_WINDOW))) as conn:
+        _apply_messages(conn, user_id, [message])
+
+def _apply_profile(conn: sqlite3.Connection, user_id: str, updates: Dict[str, Any]):
+    if not updates:
+        return
+    updates_sql = ", ".join([f"{k} = ?" for k in updates.keys()])
+    values = list(updates.values()) + [user_id]
+    conn.execute(f"UPDATE core_profile SET {updates_sql} WHERE user_id = ?", values)
 
 def update_profile(user_id: str, updates: Dict[str, Any]):
     """Update core profile fields."""
-    conn = get_db_connection()
-    try:
-        updates_sql = ", ".join([f"{k} = ?" for k in updates.keys()])
-        values = list(updates.values()) + [user_id]
-        conn.execute(f"UPDATE core_profile SET {updates_sql} WHERE user_id = ?", values)
-        conn.commit()
-    finally:
-        conn.close()
+    with _write_through(user_id, lambda mem: mem.with_section('profile', {**mem.get('profile', {}), **updates})) as conn:
+        _apply_profile(conn, user_id, updates)
+
+def _apply_relationship(conn: sqlite3.Connection, user_id: str, familiarity_delta: int, trust_delta: int):
+    if not familiarity_delta and not trust_delta:
+        return
+    # Clamp to 0..10 in SQL so we don't need a read first
+    conn.execute(
+        """UPDATE relationship
+           SET familiarity_level = MAX(0, MIN(10, familiarity_level + ?)),
+               trust_level = MAX(0, MIN(10, trust_level + ?))
+           WHERE user_id = ?""",
+        (familiarity_delta, trust_delta, user_id),
+    )
 
 def update_relationship(user_id: str, familiarity_delta: int = 0, trust_delta: int = 0):
     """Update relationship stats."""
-    conn = get_db_connection()
+    with _write_through(user_id, lambda mem: mem.with_section('relationship', _bump_relationship(
+        mem.get('relationship', {}), familiarity_delta, trust_delta
+    ))) as conn:
+        _apply_relationship(conn, user_id, familiarity_delta, trust_delta)
+
+def _bump_relationship(rel: Dict[str, Any], familiarity_delta: int, trust_delta: int) -> Dict[str, Any]:
+    # Same clamping as the SQL in _apply_relationship
+    if not rel:
+        return rel
+    return {
+        **rel,
+        'familiarity_level': max(0, min(10, rel['familiarity_level'] + familiarity_delta)),
+        'trust_level': max(0, min(10, rel['trust_level'] + trust_delta)),
+    }
+
+# --- Conversation Summaries ---
+
+def get_summary_state(user_id: str) -> Dict[str, Any]:
+    """Current rolling summary and the last message id it covers."""
+    with get_pool(user_id).reader() as conn:
+        row = conn.execute(
+            "SELECT summary, summarized_until FROM conversation_summaries WHERE user_id = ?", (user_id,)
+        ).fetchone()
+    if not row:
+        return {'summary': '', 'summarized_until': 0}
+    return {'summary': row['summary'] or '', 'summarized_until': row['summarized_until'] or 0}
+
+def get_unsummarized_messages(user_id: str, after_id: int, keep_recent: int, limit: int) -> List[Dict[str, Any]]:
+    """
+    Messages newer than `after_id` that are old enough to summarize, oldest first.
+    The newest `keep_recent` are left out since they still go to the model word for word.
+    Returns at most `limit` messages.
+    """
+    with get_pool(user_id).reader() as conn:
+        rows = conn.execute(
+            "SELECT id, role, content FROM messages WHERE user_id = ? AND id > ? ORDER BY timestamp, id LIMIT ?",
+            (user_id, after_id, limit + keep_recent),
+        ).fetchall()
+        if len(rows) == limit + keep_recent:
+            # There may be more after this page, so the newest keep_recent rows aren't in it
+            newest = conn.execute(
+                "SELECT id FROM messages WHERE user_id = ? ORDER BY timestamp DESC, id DESC LIMIT ?",
+                (user_id, keep_recent),
+            ).fetchall()
+            recent_ids = {r['id'] for r in newest}
+            rows = [r for r in rows if r['id'] not in recent_ids]
+        else:
+            rows = rows[:max(0, len(rows) - keep_recent)]
+    return [{"id": r['id'], "role": r['role'], "content": r['content']} for r in rows[:limit]]
+
+def save_summary(user_id: str, summary: str, summarized_until: int):
+    """Store the new rolling summary (never moves backwards)."""
+    # Rare enough to just drop the cached copy, the next load recounts what's left unsummarized
+    with _write_through(user_id, None) as conn:
+        conn.execute(
+            """INSERT INTO conversation_summaries (user_id, summary, summarized_until, updated_at)
+               VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+               ON CONFLICT(user_id) DO UPDATE SET
+                   summary = excluded.summary,
+                   summarized_until = excluded.summarized_until,
+                   updated_at = CURRENT_TIMESTAMP
+               WHERE excluded.summarized_until > conversation_summaries.summarized_until""",
+            (user_id, summary, summarized_until),
+        )
+
+# --- Post-turn Job Queue ---
+# Storage side only, what a job actually does lives in backend/post_turn.py
+
+def enqueue_turn_job(user_id: str, payload: Dict[str, Any]) -> int:
+    """Durably queue a job for this user. Returns its id."""
+    with get_pool(user_id).writer() as conn:
+        cur = conn.execute(
+            "INSERT INTO turn_jobs (user_id, payload, available_at) VALUES (?, ?, ?)",
+            (user_id, json.dumps(payload), time.time()),
+        )
+        return cur.lastrowid
+
+def _job_from_row(row: sqlite3.Row) -> Dict[str, Any]:
+    return {
+        "id": row['id'],
+        "user_id": row['user_id'],
+        "payload": json.loads(row['payload']),
+        "attempts": row['attempts'],
+    }
+
+def due_turn_jobs(shard: int, limit: int = 100) -> List[Dict[str, Any]]:
+    """Unapplied jobs, in order, of every user on this shard whose oldest job is ready to run.
+    A user whose oldest job is waiting out a retry is left out entirely (history and streaks need order)."""
+    with shard_pool(shard).reader() as conn:
+        rows = conn.execute(
+            """SELECT id, user_id, payload, attempts FROM turn_jobs
+               WHERE available_at IS NOT NULL AND user_id IN (
+                   SELECT user_id FROM turn_jobs j
+                   WHERE available_at <= ?
+                     AND id = (SELECT MIN(id) FROM turn_jobs WHERE user_id = j.user_id AND available_at IS NOT NULL))
+               ORDER BY id LIMIT ?""",
+            (time.time(), limit),
+        ).fetchall()
+    return [_job_from_row(r) for r in rows]
+
+def user_turn_jobs(user_id: str) -> List[Dict[str, Any]]:
+    """This user's unapplied jobs in order (backoff ignored, parked ones left out)."""
+    with get_pool(user_id).reader() as conn:
+        rows = conn.execute(
+            "SELECT id, user_id, payload, attempts FROM turn_jobs WHERE user_id = ? AND available_at IS NOT NULL ORDER BY id",
+            (user_id,),
+        ).fetchall()
+    return [_job_from_row(r) for r in rows]
+
+def users_with_turn_jobs(user_ids: List[str]) -> List[str]:
+    """Which of these users have unapplied (non-parked) jobs, one query per shard chunk."""
+    found = []
+    for shard, shard_ids in group_by_shard(dict.fromkeys(user_ids)).items():
+        with shard_pool(shard).reader() as conn:
+            for i in range(0, len(shard_ids), _BATCH_CHUNK):
+                chunk = shard_ids[i:i + _BATCH_CHUNK]
+                placeholders = ", ".join("?" * len(chunk))
+                rows = conn.execute(
+                    f"SELECT DISTINCT user_id FROM turn_jobs WHERE user_id IN ({placeholders}) AND available_at IS NOT NULL",
+                    chunk,
+                ).fetchall()
+                found.extend(r['user_id'] for r in rows)
+    return found
+
+def complete_turn_jobs(shard: int, jobs: List[Dict[str, Any]],
+                       apply_fn: Callable[[sqlite3.Connection, Dict[str, Any]], Any]) -> List[Tuple[Dict[str, Any], bool, Any]]:
+    """
+    Apply jobs and delete them, all in one transaction (one fsync for the whole batch).
+    A job only counts if this call deleted it, so it's applied exactly once even with several workers.
+    Each job gets its own savepoint, so a failing one is rolled back alone and the rest still commit.
+    Returns (job, applied, result) per job, result is the exception for failed ones.
+    A user's jobs after a failed one are skipped (applied False, result None) to keep their order.
+    apply_fn returns the effects it wrote with apply_turn (None if it wrote nothing), the cache
+    gets them when the transaction commits, before anyone can load the user again.
+    """
+    outcomes = []
+    failed_users = set()
+    cached: Dict[str, List[Callable[[Dict[str, Any]], Dict[str, Any]]]] = {}
+    users = {job['user_id'] for job in jobs}
+    for user_id in users:
+        memory_cache.begin_write(user_id)
+    committed = False
     try:
-        c = conn.cursor()
-        current = c.execute("SELECT familiarity_level, trust_level FROM relationship WHERE user_id = ?", (user_id,)).fetchone()
-        if current:
-            new_fam = max(0, min(10, current['familiarity_level'] + familiarity_delta))
-            new_trust = max(0, min(10, current['trust_level'] + trust_delta))
-            c.execute("UPDATE relationship SET familiarity_level = ?, trust_level = ? WHERE user_id = ?", (new_fam, new_trust, user_id))
-            conn.commit()
+        with shard_pool(shard).writer() as conn:
+            for job in jobs:
+                if job['user_id'] in failed_users:
+                    outcomes.append((job, False, None))
+                    continue
+                conn.execute("SAVEPOINT turn_job")
+                try:
+                    if conn.execute("DELETE FROM turn_jobs WHERE id = ?", (job['id'],)).rowcount == 0:
+                        outcomes.append((job, False, None))
+                    else:
+                        result = apply_fn(conn, job)
+                        outcomes.append((job, True, result))
+                        if result is not None:
+                            cached.setdefault(job['user_id'], []).append(_cached_turn(result))
+                    conn.execute("RELEASE turn_job")
+                except Exception as e:
+                    conn.execute("ROLLBACK TO turn_job")
+                    conn.execute("RELEASE turn_job")
+                    failed_users.add(job['user_id'])
+                    outcomes.append((job, False, e))
+        committed = True
     finally:
-        conn.close()
+        for user_id in users:
+            memory_cache.end_write(user_id, _chained(cached.get(user_id, [])) if committed else None)
+    return outcomes
+
+def _chained(fns: List[Callable[[Dict[str, Any]], Dict[str, Any]]]) -> Callable[[Dict[str, Any]], Dict[str, Any]]:
+    def apply(mem):
+        for fn in fns:
+            mem = fn(mem)
+        return mem
+    return apply
+
+def read_turn_state(conn: sqlite3.Connection, user_id: str) -> Optional[Dict[str, Any]]:
+    """What post-turn rules need to know, read inside the job's transaction."""
+    row = conn.execute(
+        """SELECT i.timezone, p.points, p.streak_days, c.last_updated, m.active, m.completed
+           FROM use_identity i
+           LEFT JOIN progression p ON p.user_id = i.user_id
+           LEFT JOIN conversations c ON c.user_id = i.user_id
+           LEFT JOIN missions m ON m.user_id = i.user_id
+           WHERE i.user_id = ?""",
+        (user_id,),
+    ).fetchone()
+    if row is None:
+        return None
+    return {
+        "timezone": row['timezone'] or "UTC",
+        "points": row['points'] or 0,
+        "streak_days": row['streak_days'] or 0,
+        "last_active": row['last_updated'],
+        "active": json.loads(row['active'] or '[]'),
+        "completed": json.loads(row['completed'] or '[]'),
+    }
+
+def apply_turn(conn: sqlite3.Connection, user_id: str, effects: Dict[str, Any], turn_at: Optional[float] = None):
+    """Write one turn's effects (messages, progression, missions, relationship) in the caller's transaction.
+    Activity is stamped with turn_at (when the user spoke), not when the job got applied, the streak counts days from it."""
+    _apply_messages(conn, user_id, effects.get('messages', []), turn_at)
+    _apply_progression(conn, user_id, effects.get('progression', {}))
+    _apply_missions(conn, user_id, effects.get('missions', {}))
+    _apply_relationship(conn, user_id, *effects.get('relationship', (0, 0)))
+
+def _cached_turn(effects: Dict[str, Any]) -> Callable[[Dict[str, Any]], Dict[str, Any]]:
+    """apply_turn's effects as a change to a cached snapshot."""
+    entries = [{"role": m['role'], "content": m['content']} for m in effects.get('messages', [])]
+    progression = effects.get('progression', {})
+    missions = effects.get('missions', {})
+    familiarity_delta, trust_delta = effects.get('relationship', (0, 0))
+    return lambda mem: (mem
+        .with_section('conversations', (mem.get('conversations', []) + entries)[-HISTORY_WINDOW:])
+        .with_section('unsummarized', min(mem.get('unsummarized', 0) + len(entries), HISTORY_WINDOW))
+        .with_section('progression', {**mem.get('progression', {}), **progression})
+        .with_section('missions', {**mem.get('missions', {}), **missions})
+        .with_section('relationship', _bump_relationship(mem.get('relationship', {}), familiarity_delta, trust_delta)))
+
+def fail_turn_job(job: Dict[str, Any], error: str, retry_in: Optional[float]):
+    """Record a failed attempt. retry_in=None parks the job for good."""
+    with get_pool(job['user_id']).writer() as conn:
+        conn.execute(
+            "UPDATE turn_jobs SET attempts = attempts + 1, last_error = ?, available_at = ? WHERE id = ?",
+            (error[:1000], time.time() + retry_in if retry_in is not None else None, job['id']),
+        )
+
+def turn_job_stats() -> Dict[str, Any]:
+    pending = parked = 0
+    oldest = None
+    for pool in all_pools():
+        with pool.reader() as conn:
+            row = conn.execute(
+                "SELECT COUNT(available_at), COUNT(*) - COUNT(available_at), MIN(available_at) FROM turn_jobs"
+            ).fetchone()
+        pending += row[0]
+        parked += row[1]
+        if row[2] is not None:
+            oldest = row[2] if oldest is None else min(oldest, row[2])
+    return {
+        "pending": pending,
+        "parked": parked,
+        "oldest_due_s": round(time.time() - oldest, 2) if oldest is not None else None,
+    }
+
+# --- Nudges ---
+# Storage side only, the scheduling lives in backend/nudges.py
+
+def timezones(shard: int) -> List[str]:
+    """Every timezone users on this shard have had (the small timezones table, not a scan of the users)."""
+    with shard_pool(shard).reader() as conn:
+        rows = conn.execute("SELECT timezone FROM timezones").fetchall()
+    return [r[0] for r in rows]
+
+def users_in_timezone(shard: int, timezone: str, active_since: str) -> List[str]:
+    """Users in this timezone who said anything since `active_since` (UTC, sqlite timestamp format)."""
+    # One range on idx_conversations_timezone, users in the zone who went quiet long ago are never read
+    with shard_pool(shard).reader() as conn:
+        rows = conn.execute(
+            "SELECT user_id FROM conversations WHERE timezone = ? AND last_updated >= ?",
+            (timezone, active_since),
+        ).fetchall()
+    return [r['user_id'] for r in rows]
+
+def went_silent(shard: int, after: Tuple[str, str], until: str, limit: int) -> List[Tuple[str, str]]:
+    """
+    (user_id, last_updated) of users whose last activity is past `after` (a (last_updated, user_id)
+    keyset position) and at most `until`, oldest first. Those are the ones that crossed the silence
+    line since the previous sweep, so the cost is the number of them, not the number of users.
+    """
+    with shard_pool(shard).reader() as conn:
+        rows = conn.execute(
+            """SELECT user_id, last_updated FROM conversations
+               WHERE (last_updated, user_id) > (?, ?) AND last_updated <= ?
+               ORDER BY last_updated, user_id LIMIT ?""",
+            (after[0], after[1], until, limit),
+        ).fetchall()
+    return [(r['user_id'], r['last_updated']) for r in rows]
+
+def get_mark(name: str) -> Optional[str]:
+    # Scheduler state lives on shard 0, there's one scheduler for all shards
+    with shard_pool(0).reader() as conn:
+        row = conn.execute("SELECT value FROM scheduler_marks WHERE name = ?", (name,)).fetchone()
+    return row['value'] if row else None
+
+def set_mark(name: str, value: str):
+    with shard_pool(0).writer() as conn:
+        conn.execute(
+            "INSERT INTO scheduler_marks (name, value) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = excluded.value",
+            (name, value),
+        )
+
+def claim_nudges(kind: str, targets: List[Tuple[str, str]]) -> Dict[str, int]:
+    """
+    Claim (user_id, nudge_key) pairs for generating. Returns user_id -> nudge id for the ones
+    nobody claimed before (a pair already in the table, from another worker or a previous run, is skipped).
+    """
+    claimed = {}
+    keys = dict(targets)
+    now = time.time()
+    for shard, user_ids in group_by_shard(keys).items():
+        with shard_pool(shard).writer() as conn:
+            for user_id in user_ids:
+                cur = conn.execute(
+                    "INSERT OR IGNORE INTO nudges (user_id, kind, nudge_key, created_at) VALUES (?, ?, ?, ?)",
+                    (user_id, kind, keys[user_id], now),
+                )
+                if cur.rowcount:
+                    claimed[user_id] = cur.lastrowid
+    return claimed
+
+def finish_nudge(user_id: str, nudge_id: int, response: Optional[str]):
+    """Store the generated nudge, or with response None give the claim back."""
+    with get_pool(user_id).writer() as conn:
+        if response is None:
+            conn.execute("DELETE FROM nudges WHERE id = ? AND response IS NULL", (nudge_id,))
+        else:
+            conn.execute("UPDATE nudges SET response = ?, created_at = ? WHERE id = ?", (response, time.time(), nudge_id))
+
+def take_nudges(user_id: str, since: float, peek: bool = False) -> List[Dict[str, Any]]:
+    """Ready nudges this user hasn't picked up yet (created after `since`), oldest first. Marks them delivered unless peek."""
+    with get_pool(user_id).writer() as conn:
+        rows = conn.execute(
+            """SELECT id, kind, response, created_at FROM nudges
+               WHERE user_id = ? AND response IS NOT NULL AND delivered_at IS NULL AND created_at >= ?
+               ORDER BY id""",
+            (user_id, since),
+        ).fetchall()
+        if rows and not peek:
+            conn.executemany("UPDATE nudges SET delivered_at = ? WHERE id = ?", [(time.time(), r['id']) for r in rows])
+    return [{"id": r['id'], "kind": r['kind'], "response": r['response'], "created_at": r['created_at']} for r in rows]
+
+def prune_nudges(before: float) -> int:
+    """Forget nudges (picked up or not) created before `before`. Their UNIQUE keys are long past by then."""
+    removed = 0
+    for pool in all_pools():
+        with pool.writer() as conn:
+            removed += conn.execute("DELETE FROM nudges WHERE created_at < ?", (before,)).rowcount
+    return removed
+
+def nudge_stats() -> Dict[str, Any]:
+    ready = delivered = generating = 0
+    for pool in all_pools():
+        with pool.reader() as conn:
+            row = conn.execute(
+                "SELECT COUNT(response) - COUNT(delivered_at), COUNT(delivered_at), COUNT(*) - COUNT(response) FROM nudges"
+            ).fetchone()
+        ready += row[0]
+        delivered += row[1]
+        generating += row[2]
+    return {"ready": ready, "delivered": delivered, "generating": generating}
+
+def cache_stats() -> Dict[str, Any]:
+    """Hit/miss/eviction counters for the user memory cache."""
+    return memory_cache.stats()
 
 if __name__ == "__main__":
+    from utils import warmup
+    warmup.configure()
     init_db()
     # Test creation
     # create_user("test_user_1", "Test Subject", "EST")
@@ -0,0 +1,488 @@
+# Author: Steven Lansangan
+# Dump and load user memory as NDJSON (one user per line)
+# Streams both ways so a multi-GB database never has to fit in RAM
+#
+#   python -m utils.memory_transfer export backup.ndjson.gz
+#   python -m utils.memory_transfer import backup.ndjson.gz --db new.db
+import sys
+import gzip
+import json
+import argparse
+import logging
+from contextlib import ExitStack, nullcontext
+from typing import IO, Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from utils import memory_manager, warmup
+
+logger = logging.getLogger("MemoryTransfer")
+
+# The single-row-per-user tables, in the order they show up on each line
+USER_TABLES = ["use_identity", "progression", "missions", "conversations", "core_profile", "relationship", "conversation_summaries"]
+
+# Tables with any number of rows per user (not counting messages), carried in id order
+# Queued/parked turns still owe the user their history, points and streak, and undelivered nudges are still owed to them
+USER_LIST_TABLES = {
+    "turn_jobs": ["payload", "attempts", "available_at", "last_error", "created_at"],
+    "nudges": ["kind", "nudge_key", "response", "created_at", "delivered_at"],
+}
+
+# Columns holding JSON text, exported as real JSON so the dump is readable
+JSON_COLUMNS = {"missions": ["active", "completed", "failed"], "conversations": ["history"], "turn_jobs": ["payload"]}
+
+# Users per read batch
+EXPORT_BATCH = 500
+# Rows (mostly messages) per import transaction, checked between users so nobody is half-imported
+IMPORT_ROWS = 20000
+# Messages per executemany while a user's log streams in
+MESSAGE_CHUNK = 1000
+# Characters read from the dump at a time
+READ_CHUNK = 1 << 16
+
+
+def _open(path: str, mode: str):
+    if path == "-":
+        # Don't let the with-block close stdout/stdin
+        return nullcontext(sys.stdout if "w" in mode else sys.stdin)
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+def _row_out(table: str, row, conn=None) -> Dict[str, Any]:
+    data = dict(row)
+    user_id = data.pop("user_id", None)
+    for col in JSON_COLUMNS.get(table, []):
+        if data.get(col) is not None:
+            data[col] = json.loads(data[col])
+    if table == "conversation_summaries" and conn is not None:
+        # Message ids change on import, so store how many messages the summary covers instead
+        until = data.pop("summarized_until", 0) or 0
+        data["summarized_messages"] = conn.execute(
+            "SELECT COUNT(*) FROM messages WHERE user_id = ? AND id <= ?", (user_id, until)
+        ).fetchone()[0]
+    return data
+
+
+def _list_out(table: str, rows) -> List[Dict[str, Any]]:
+    return [{k: v for k, v in _row_out(table, row).items() if k in USER_LIST_TABLES[table]} for row in rows]
+
+
+def _write_user(out: IO[str], conn, user_id: str, rows: Dict[str, Any]):
+    # Written piece by piece so a user with 50k messages is never one big string
+    out.write('{"user_id": ' + json.dumps(user_id))
+    for table in USER_TABLES:
+        row = rows.get(table)
+        out.write(f', "{table}": ' + json.dumps(_row_out(table, row, conn) if row is not None else None))
+    for table in USER_LIST_TABLES:
+        out.write(f', "{table}": ' + json.dumps(_list_out(table, rows.get(table, []))))
+    out.write(', "messages": [')
+    first = True
+    for msg in iter_messages(conn, user_id):
+        out.write(("" if first else ", ") + json.dumps(msg))
+        first = False
+    out.write("]}\n")
+
+
+def iter_user_rows(conn) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """Walk every user in one shard with keyset pagination, yielding (user_id, {table: row})."""
+    last_id = ""
+    while True:
+        ids = [r["user_id"] for r in conn.execute(
+            "SELECT user_id FROM use_identity WHERE user_id > ? ORDER BY user_id LIMIT ?", (last_id, EXPORT_BATCH)
+        )]
+        if not ids:
+            return
+        last_id = ids[-1]
+
+        placeholders = ", ".join("?" * len(ids))
+        rows: Dict[str, Dict[str, Any]] = {user_id: {} for user_id in ids}
+        for table in USER_TABLES:
+            for row in conn.execute(f"SELECT * FROM {table} WHERE user_id IN ({placeholders})", ids):
+                rows[row["user_id"]][table] = row
+        for table in USER_LIST_TABLES:
+            for row in conn.execute(f"SELECT * FROM {table} WHERE user_id IN ({placeholders}) ORDER BY id", ids):
+                rows[row["user_id"]].setdefault(table, []).append(row)
+
+        for user_id in ids:
+            yield user_id, rows[user_id]
+
+
+def iter_messages(conn, user_id: str) -> Iterator[Dict[str, Any]]:
+    for msg in conn.execute(
+        "SELECT role, content, timestamp FROM messages WHERE user_id = ? ORDER BY timestamp, id", (user_id,)
+    ):
+        yield {"role": msg["role"], "content": msg["content"], "timestamp": msg["timestamp"]}
+
+
+def user_header(conn, user_id: str, rows: Dict[str, Any]) -> Dict[str, Any]:
+    """One user as the dict an NDJSON line decodes to, minus the messages (stream those with iter_messages)."""
+    record = {"user_id": user_id}
+    for table in USER_TABLES:
+        row = rows.get(table)
+        record[table] = _row_out(table, row, conn) if row is not None else None
+    for table in USER_LIST_TABLES:
+        record[table] = _list_out(table, rows.get(table, []))
+    return record
+
+
+def read_marks(pool) -> Dict[str, str]:
+    """The nudge scheduler's progress (scheduler_marks, kept on shard 0)."""
+    with pool.reader() as conn:
+        return {r["name"]: r["value"] for r in conn.execute("SELECT name, value FROM scheduler_marks")}
+
+
+def write_marks(pool, marks: Dict[str, str], shard_count: int):
+    """
+    Store scheduler marks for a layout with shard_count shards. The silent-sweep watermarks are
+    per shard, and users end up on other shards when the count changes, so every new shard starts
+    from the oldest old watermark: a few users get looked at again (their nudges travel with them,
+    so nobody is nudged twice) and nobody who went quiet is skipped.
+    """
+    marks = dict(marks)
+    silent = [marks.pop(name) for name in list(marks) if name.startswith("silent:")]
+    if silent:
+        oldest = min(silent, key=lambda mark: tuple(mark.split("|", 1)))
+        marks.update({f"silent:{shard}": oldest for shard in range(shard_count)})
+    with pool.writer() as conn:
+        conn.executemany(
+            "INSERT INTO scheduler_marks (name, value) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = excluded.value",
+            marks.items(),
+        )
+
+
+def export_ndjson(out: IO[str], pools: Optional[List] = None) -> int:
+    """Write every user (from every shard) as one JSON line. Returns the number of users written.
+    The nudge scheduler's marks, if there are any, go first on a line of their own."""
+    pools = pools or memory_manager.all_pools()
+    marks = read_marks(pools[0])
+    if marks:
+        out.write(json.dumps({"scheduler_marks": marks}) + "\n")
+    written = 0
+    for pool in pools:
+        with pool.reader() as conn:
+            # One read transaction per shard, so each shard is a consistent snapshot
+            conn.execute("BEGIN")
+            for user_id, rows in iter_user_rows(conn):
+                _write_user(out, conn, user_id, rows)
+                written += 1
+                if written % EXPORT_BATCH == 0:
+                    logger.info(f"Exported {written} users...")
+    return written
+
+
+def _row_in(table: str, data: Dict[str, Any]) -> Dict[str, Any]:
+    data = dict(data)
+    for col in JSON_COLUMNS.get(table, []):
+        if col in data and not isinstance(data[col], str):
+            data[col] = json.dumps(data[col])
+    return data
+
+
+def _table_columns(conn) -> Dict[str, set]:
+    return {table: {r["name"] for r in conn.execute(f"PRAGMA table_info({table})")}
+            for table in USER_TABLES + list(USER_LIST_TABLES)}
+
+
+def _import_user(conn, columns: Dict[str, set], user: Dict[str, Any], messages: Iterable[Dict[str, Any]]) -> int:
+    """Replace one user's rows, messages go in MESSAGE_CHUNK at a time as they're read. Returns rows written."""
+    user_id = user["user_id"]
+    written = 0
+    for table in USER_TABLES:
+        data = user.get(table)
+        if data is None:
+            continue
+        # Only columns this schema knows about, the dump could come from a newer version
+        data = {k: v for k, v in _row_in(table, data).items() if k in columns[table] and k != "user_id"}
+        cols = ["user_id"] + list(data.keys())
+        conn.execute(
+            f"INSERT OR REPLACE INTO {table} ({', '.join(cols)}) VALUES ({', '.join('?' * len(cols))})",
+            [user_id] + list(data.values()),
+        )
+        written += 1
+    for table, list_columns in USER_LIST_TABLES.items():
+        items = user.get(table)
+        if items is None:
+            # Dump from before this table existed, leave what's here alone
+            continue
+        conn.execute(f"DELETE FROM {table} WHERE user_id = ?", (user_id,))
+        for item in items:
+            data = {k: v for k, v in _row_in(table, item).items() if k in list_columns and k in columns[table]}
+            cols = ["user_id"] + list(data.keys())
+            conn.execute(
+                f"INSERT INTO {table} ({', '.join(cols)}) VALUES ({', '.join('?' * len(cols))})",
+                [user_id] + list(data.values()),
+            )
+            written += 1
+    # The dump is the source of truth for this user's log
+    conn.execute("DELETE FROM messages WHERE user_id = ?", (user_id,))
+    chunk = []
+    for m in messages:
+        chunk.append((user_id, m["role"], m["content"], m.get("timestamp")))
+        if len(chunk) >= MESSAGE_CHUNK:
+            written += _insert_messages(conn, chunk)
+            chunk = []
+    written += _insert_messages(conn, chunk)
+    _remap_summary(conn, user_id, user.get("conversation_summaries"))
+    return written
+
+
+def _insert_messages(conn, rows: List[Tuple]) -> int:
+    conn.executemany(
+        "INSERT INTO messages (user_id, role, content, timestamp) VALUES (?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP))", rows
+    )
+    return len(rows)
+
+
+class _Batch:
+    def __init__(self, pool):
+        self.stack = ExitStack()
+        self.conn = self.stack.enter_context(pool.writer())
+        self.columns = _table_columns(self.conn)
+        self.user_ids: List[str] = []
+        self.rows = 0
+
+
+class ShardWriter:
+    """
+    Streams users into the shards, one open write transaction per target shard, committed
+    once it holds IMPORT_ROWS rows. Without explicit pools each user goes to its own shard
+    in memory_manager's layout. Use it as a context manager: an error rolls back what isn't committed yet.
+    """
+
+    def __init__(self, pools: Optional[List] = None):
+        self.pools = pools
+        self._batches: Dict[int, _Batch] = {}
+        self.users = 0
+
+    def _pool(self, shard: int):
+        return self.pools[shard] if self.pools else memory_manager.shard_pool(shard)
+
+    def add(self, user: Dict[str, Any], messages: Iterable[Dict[str, Any]] = ()):
+        """Write one user (the header fields of an NDJSON line) and their messages."""
+        user_id = user["user_id"]
+        shard = memory_manager.shard_index(user_id, len(self.pools) if self.pools else None)
+        batch = self._batches.get(shard)
+        if batch is None:
+            batch = self._batches[shard] = _Batch(self._pool(shard))
+        if user_id not in batch.user_ids:
+            memory_manager.memory_cache.begin_write(user_id)
+            batch.user_ids.append(user_id)
+        batch.rows += _import_user(batch.conn, batch.columns, user, messages)
+        self.users += 1
+        if batch.rows >= IMPORT_ROWS:
+            self._close(shard)
+
+    def _close(self, shard: int, error: Optional[BaseException] = None):
+        batch = self._batches.pop(shard)
+        try:
+            if error is None:
+                # Dumps from before conversations had it (or a changed identity) get it from use_identity
+                memory_manager.copy_timezones(batch.conn, batch.user_ids)
+                batch.stack.close()
+            else:
+                batch.stack.__exit__(type(error), error, error.__traceback__)
+        finally:
+            for user_id in batch.user_ids:
+                # Cached copies of these users are from before the import
+                memory_manager.memory_cache.end_write(user_id)
+
+    def flush(self):
+        """Commit every open transaction."""
+        for shard in list(self._batches):
+            self._close(shard)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc is None:
+            self.flush()
+            return
+        for shard in list(self._batches):
+            try:
+                self._close(shard, exc)
+            except Exception:
+                pass
+
+def _remap_summary(conn, user_id: str, summary: Optional[Dict[str, Any]]):
+    # Point summarized_until at the freshly inserted id of the last covered message
+    if not summary:
+        return
+    covered = summary.get("summarized_messages", 0) or 0
+    row = conn.execute(
+        "SELECT id FROM messages WHERE user_id = ? ORDER BY timestamp, id LIMIT 1 OFFSET ?", (user_id, covered - 1)
+    ).fetchone() if covered > 0 else None
+    conn.execute(
+        "UPDATE conversation_summaries SET summarized_until = ? WHERE user_id = ?", (row["id"] if row else 0, user_id)
+    )
+
+
+class _Reader:
+    """Chunked reads from a text stream, so a line never has to be held whole."""
+
+    def __init__(self, src: IO[str]):
+        self.src = src
+        self.buf = ""
+        self.pos = 0
+        self.line_no = 0
+
+    def fill(self) -> bool:
+        chunk = self.src.read(READ_CHUNK)
+        if not chunk:
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self) -> str:
+        """Next character that isn't a space on this line ("" at the end of the input)."""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in " \t\r":
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                return ""
+
+    def error(self, what: str) -> ValueError:
+        return ValueError(f"Bad NDJSON on line {self.line_no}: {what}")
+
+
+# Where the messages start on a line we exported, they always come last.
+# Can't show up inside a string (its quote would be escaped), only as a key
+_MESSAGES_KEY = ', "messages": ['
+
+
+def _head(reader: _Reader) -> Optional[Tuple[Dict[str, Any], bool]]:
+    """The next line up to its messages: (fields, messages follow). None at the end of the input."""
+    scanned = 0
+    while True:
+        newline = reader.buf.find("\n", reader.pos)
+        key = reader.buf.find(_MESSAGES_KEY, reader.pos + scanned)
+        while key != -1 and (newline == -1 or key < newline):
+            try:
+                head = json.loads(reader.buf[reader.pos:key] + "}")
+            except ValueError:
+                # A nested "messages", keep looking
+                key = reader.buf.find(_MESSAGES_KEY, key + 1)
+                continue
+            reader.pos = key + len(_MESSAGES_KEY)
+            reader.line_no += 1
+            return head, True
+        if newline != -1:
+            line = reader.buf[reader.pos:newline].strip()
+            reader.pos = newline + 1
+            reader.line_no += 1
+            scanned = 0
+            if not line:
+                continue
+            try:
+                return json.loads(line), False
+            except ValueError as e:
+                raise reader.error(str(e))
+        scanned = max(len(reader.buf) - reader.pos - len(_MESSAGES_KEY), 0)
+        if not reader.fill():
+            line = reader.buf[reader.pos:].strip()
+            reader.pos = len(reader.buf)
+            if not line:
+                return None
+            reader.line_no += 1
+            try:
+                return json.loads(line), False
+            except ValueError as e:
+                raise reader.error(str(e))
+
+
+def _stream_messages(reader: _Reader) -> Iterator[Dict[str, Any]]:
+    """Decode a line's messages one at a time, then step past the end of the line."""
+    decoder = json.JSONDecoder()
+    expect_comma = False
+    while True:
+        ch = reader.peek()
+        if ch == "]":
+            reader.pos += 1
+            break
+        if expect_comma:
+            if ch != ",":
+                raise reader.error("expected , between messages")
+            reader.pos += 1
+            expect_comma = False
+            continue
+        try:
+            msg, end = decoder.raw_decode(reader.buf, reader.pos)
+        except ValueError as e:
+            # Most likely cut off at the end of the buffer
+            if ch in ("", "\n") or not reader.fill():
+                raise reader.error(f"messages cut short ({e})")
+            continue
+        reader.pos = end
+        expect_comma = True
+        yield msg
+    if reader.peek() != "}":
+        raise reader.error("expected } after the messages")
+    reader.pos += 1
+    ch = reader.peek()
+    if ch not in ("", "\n"):
+        raise reader.error("extra data after the user")
+    reader.pos += 1
+
+
+def read_users(src: IO[str]) -> Iterator[Tuple[Dict[str, Any], Iterator[Dict[str, Any]]]]:
+    """
+    Yield (line without messages, its messages) per NDJSON line. The messages of lines we
+    exported are decoded as they're iterated, finish with them before asking for the next line.
+    """
+    reader = _Reader(src)
+    while True:
+        head = _head(reader)
+        if head is None:
+            return
+        record, streamed = head
+        if not streamed:
+            yield record, iter(record.pop("messages", None) or [])
+            continue
+        messages = _stream_messages(reader)
+        yield record, messages
+        # Whatever the caller didn't read still has to be stepped over
+        for _ in messages:
+            pass
+
+
+def import_ndjson(src: IO[str]) -> int:
+    """Load users from NDJSON, replacing any existing rows for them. Returns the number imported."""
+    with ShardWriter() as writer:
+        for user, messages in read_users(src):
+            if "user_id" not in user and "scheduler_marks" in user:
+                write_marks(memory_manager.shard_pool(0), user["scheduler_marks"], memory_manager.SHARD_COUNT)
+                continue
+            writer.add(user, messages)
+            if writer.users % EXPORT_BATCH == 0:
+                logger.info(f"Imported {writer.users} users...")
+    return writer.users
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export/import Babaru user memory as NDJSON")
+    parser.add_argument("action", choices=["export", "import"])
+    parser.add_argument("path", help="NDJSON file (.gz is compressed, - for stdout/stdin)")
+    parser.add_argument("--db", default=memory_manager.DB_PATH, help="SQLite database file (base name when sharded)")
+    parser.add_argument("--shards", type=int, default=memory_manager.SHARD_COUNT, help="Number of shard files")
+    args = parser.parse_args(argv)
+
+    warmup.configure()
+    memory_manager.DB_PATH = args.db
+    memory_manager.SHARD_COUNT = args.shards
+    memory_manager.init_db()
+
+    if args.action == "export":
+        with _open(args.path, "w") as out:
+            count = export_ndjson(out)
+        logger.info(f"Export done: {count} users -> {args.path}")
+    else:
+        with _open(args.path, "r") as src:
+            count = import_ndjson(src)
+        logger.info(f"Import done: {count} users <- {args.path}")
+
+
+if __name__ == "__main__":
+    main()
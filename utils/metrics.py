@@ -0,0 +1,254 @@
+# Author: Steven Lansangan
+# Where did the time go? Per-stage timings for every request
+# Code wraps each stage in `with metrics.stage("gemini"):` and we get:
+# - a Prometheus histogram per stage (GET /metrics, text format)
+# - counters for upstream errors and fallbacks ("Jukebox crashed" and friends)
+# - the request's own timings in a Server-Timing header, so DevTools shows them too
+# Hand-rolled instead of prometheus_client, it's a few dicts and a lock,
+# cheap enough (a couple of microseconds per stage) to leave on in production.
+import math
+import time
+import bisect
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+# Seconds. Covers sqlite reads (sub-ms) up to a slow Gemini reply
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_lock = threading.Lock()
+_metrics: Dict[str, "_Metric"] = {}
+# Callables returning stats dicts, turned into gauges at scrape time
+_collectors: List[Tuple[str, str, Callable[[], Dict[str, Any]]]] = []
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Tuple[str, ...], values: Tuple[Any, ...], extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels: Dict[str, Any]) -> Tuple:
+        return tuple(labels.get(n, "") for n in self.labelnames)
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"] + self._samples()
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Iterable[str] = ()):
+        super().__init__(name, help, labelnames)
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def _samples(self) -> List[str]:
+        with _lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_labels(self.labelnames, k)} {_number(v)}" for k, v in items]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Iterable[str] = (), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [count per bucket (+Inf last), sum]
+        self._series: Dict[Tuple, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with _lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][i] += 1
+            series[1] += value
+
+    def count(self, **labels) -> int:
+        series = self._series.get(self._key(labels))
+        return sum(series[0]) if series else 0
+
+    def _samples(self) -> List[str]:
+        with _lock:
+            items = sorted((k, list(v[0]), v[1]) for k, v in self._series.items())
+        lines = []
+        for key, counts, total in items:
+            running = 0
+            for bound, n in zip(self.buckets + (math.inf,), counts):
+                running += n
+                le = 'le="' + _number(bound) + '"'
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, le)} {running}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {running}")
+        return lines
+
+
+def _register(cls, name: str, *args, **kwargs):
+    with _lock:
+        metric = _metrics.get(name)
+        if metric is None:
+            metric = _metrics[name] = cls(name, *args, **kwargs)
+    return metric
+
+
+def counter(name: str, help: str, labelnames: Iterable[str] = ()) -> Counter:
+    return _register(Counter, name, help, labelnames)
+
+
+def histogram(name: str, help: str, labelnames: Iterable[str] = (), buckets=DEFAULT_BUCKETS) -> Histogram:
+    return _register(Histogram, name, help, labelnames, buckets=buckets)
+
+
+def register_stats(prefix: str, fn: Callable[[], Dict[str, Any]], label: Optional[str] = None):
+    """
+    Export an existing stats() as gauges on every scrape (nothing is recorded in between).
+    Flat dicts become prefix_<key>; with `label`, fn returns {name: {key: value}} and
+    each name becomes that label. Non-numeric values are skipped.
+    """
+    _collectors.append((prefix, label, fn))
+
+
+def _collect(prefix: str, label: Optional[str], fn) -> List[str]:
+    try:
+        stats = fn() or {}
+    except Exception:
+        return []
+    rows: Dict[str, List[str]] = {}
+    groups = stats.items() if label else [(None, stats)]
+    for group, values in groups:
+        if not isinstance(values, dict):
+            continue
+        for key, value in values.items():
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            name = f"{prefix}_{key}"
+            labels = f'{{{label}="{_escape(group)}"}}' if label else ""
+            rows.setdefault(name, []).append(f"{name}{labels} {_number(value)}")
+    lines = []
+    for name, samples in rows.items():
+        lines += [f"# TYPE {name} gauge"] + samples
+    return lines
+
+
+def render() -> str:
+    """Everything, in the Prometheus text exposition format."""
+    with _lock:
+        metrics = list(_metrics.values())
+    lines = []
+    for metric in metrics:
+        lines += metric.render()
+    for prefix, label, fn in list(_collectors):
+        lines += _collect(prefix, label, fn)
+    return "\n".join(lines) + "\n"
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+# --- The built-in ones ---
+STAGE_SECONDS = histogram("babaru_stage_seconds", "Time spent in each stage of a request", ["stage"])
+REQUEST_SECONDS = histogram("babaru_request_seconds", "Whole HTTP request, until the response starts", ["method", "route", "status"])
+UPSTREAM_SECONDS = histogram("babaru_upstream_call_seconds", "One attempt at an upstream call (retries count separately)", ["upstream", "outcome"])
+UPSTREAM_ERRORS = counter("babaru_upstream_errors_total", "Failed upstream attempts, by status code or error type", ["upstream", "error"])
+FALLBACKS = counter("babaru_fallbacks_total", "Times we fell back to something worse (no song, voice broke, full prompt...)", ["kind"])
+
+
+def fallback(kind: str):
+    FALLBACKS.inc(kind=kind)
+
+
+# --- Per-request timings ---
+# A Timings object per HTTP request, shared with the executor threads (executors.run copies the context)
+_timings: contextvars.ContextVar = contextvars.ContextVar("babaru_timings", default=None)
+
+
+class Timings:
+    def __init__(self):
+        self.started = time.perf_counter()
+        # stage -> [total seconds, times]; stages that run in parallel (TTS per sentence) add up
+        self.stages: Dict[str, list] = {}
+        self._lock = threading.Lock()
+
+    def add(self, stage: str, seconds: float):
+        with self._lock:
+            entry = self.stages.get(stage)
+            if entry is None:
+                self.stages[stage] = [seconds, 1]
+            else:
+                entry[0] += seconds
+                entry[1] += 1
+
+    def header(self) -> str:
+        """Server-Timing value, e.g. `memory;dur=1.2, gemini;dur=812.4, tts;dur=950.1;desc="x3", total;dur=1790.0`"""
+        with self._lock:
+            stages = list(self.stages.items())
+        parts = []
+        for stage, (seconds, times) in stages:
+            part = f"{stage};dur={seconds * 1000:.1f}"
+            if times > 1:
+                part += f';desc="x{times}"'
+            parts.append(part)
+        parts.append(f"total;dur={(time.perf_counter() - self.started) * 1000:.1f}")
+        return ", ".join(parts)
+
+
+@contextmanager
+def request_timings():
+    """Collect stage timings for everything under this block (one HTTP request)."""
+    timings = Timings()
+    token = _timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _timings.reset(token)
+
+
+def record(stage: str, seconds: float):
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    timings = _timings.get()
+    if timings is not None:
+        timings.add(stage, seconds)
+
+
+@contextmanager
+def stage(name: str):
+    """Time a block as one stage (works around awaits too)."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - started)
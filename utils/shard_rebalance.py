@@ -0,0 +1,87 @@
+# Author: Steven Lansangan
+# Offline tool for changing the number of SQLite shards
+# Stop the API first, run this, then restart with BABARU_DB_SHARDS set to the new count
+#
+#   python -m utils.shard_rebalance --from 1 --to 4
+#
+# Shard files have the count in their name (babaru.shard2of4.db), so the old
+# layout is never touched and stays around as a rollback until you delete it.
+import argparse
+import logging
+
+from utils import memory_manager, memory_transfer, warmup
+
+logger = logging.getLogger("ShardRebalance")
+
+
+def _count_rows(pools, table: str) -> int:
+    total = 0
+    for pool in pools:
+        with pool.reader() as conn:
+            total += conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+    return total
+
+
+def _count_users(pools) -> int:
+    return _count_rows(pools, "use_identity")
+
+
+def rebalance(old_count: int, new_count: int, force: bool = False) -> int:
+    """Copy every user from the old shard layout into the new one. Returns users moved."""
+    if old_count == new_count:
+        raise ValueError("Old and new shard counts are the same, nothing to do.")
+
+    sources = memory_manager.all_pools(old_count)
+    targets = memory_manager.all_pools(new_count)
+    for pool in targets:
+        memory_manager.init_schema(pool)
+
+    if not force and _count_users(targets) > 0:
+        raise RuntimeError("Target shards already contain users. Delete them or pass --force to merge into them.")
+
+    # Messages go straight from the source cursor into the target, a chunk at a time
+    with memory_transfer.ShardWriter(targets) as writer:
+        for pool in sources:
+            logger.info(f"Reading {pool.path}...")
+            with pool.reader() as conn:
+                conn.execute("BEGIN")
+                for user_id, rows in memory_transfer.iter_user_rows(conn):
+                    writer.add(memory_transfer.user_header(conn, user_id, rows), memory_transfer.iter_messages(conn, user_id))
+                    if writer.users % memory_transfer.EXPORT_BATCH == 0:
+                        logger.info(f"Moved {writer.users} users...")
+    moved = writer.users
+
+    # Nudge scheduler progress (shard 0 only), re-keyed for the new shard count
+    memory_transfer.write_marks(targets[0], memory_transfer.read_marks(sources[0]), new_count)
+
+    expected = _count_users(sources)
+    actual = _count_users(targets)
+    if actual < expected:
+        raise RuntimeError(f"Rebalance incomplete: {expected} users in the old layout, {actual} in the new one.")
+    expected_jobs = _count_rows(sources, "turn_jobs")
+    actual_jobs = _count_rows(targets, "turn_jobs")
+    if actual_jobs < expected_jobs:
+        raise RuntimeError(f"Rebalance incomplete: {expected_jobs} queued turns in the old layout, {actual_jobs} in the new one.")
+
+    for pool in targets:
+        with pool.reader() as conn:
+            logger.info(f"{pool.path}: {conn.execute('SELECT COUNT(*) FROM use_identity').fetchone()[0]} users")
+    return moved
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Re-shard the Babaru SQLite storage (server must be stopped)")
+    parser.add_argument("--from", dest="old", type=int, default=memory_manager.SHARD_COUNT, help="Current shard count")
+    parser.add_argument("--to", dest="new", type=int, required=True, help="New shard count")
+    parser.add_argument("--db", default=memory_manager.DB_PATH, help="Base database file name")
+    parser.add_argument("--force", action="store_true", help="Allow writing into non-empty target shards")
+    args = parser.parse_args(argv)
+
+    warmup.configure()
+    memory_manager.DB_PATH = args.db
+    moved = rebalance(args.old, args.new, force=args.force)
+    logger.info(f"Done: {moved} users moved. Restart the API with BABARU_DB_SHARDS={args.new}.")
+
+
+if __name__ == "__main__":
+    main()
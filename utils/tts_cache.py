@@ -0,0 +1,353 @@
+# Author: Steven Lansangan
+# Content-addressed cache for ElevenLabs audio
+# Babaru says the same lines a lot ("I'm 8 inches tall and I'm still right."),
+# so rendered audio is kept by a hash of exactly what was sent to ElevenLabs:
+# a small in-memory tier for the hottest clips, and a bigger disk tier that
+# survives restarts. Both are LRU with a byte budget.
+# The disk budget is for the directory, not the process: workers sharing it
+# (serve.py) rescan it under a file lock every so often and evict together.
+#
+#   python -m utils.tts_cache prewarm tts_prewarm.txt
+#   python -m utils.tts_cache stats
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import tempfile
+import threading
+import logging
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:
+    # No flock (Windows): each process only evicts against what it knows about
+    fcntl = None
+
+logger = logging.getLogger("TTSCache")
+
+TTS_CACHE_DIR = os.getenv("BABARU_TTS_CACHE_DIR", ".tts_cache")
+TTS_CACHE_DISK_MB = int(os.getenv("BABARU_TTS_CACHE_DISK_MB", "512"))
+TTS_CACHE_MEMORY_MB = int(os.getenv("BABARU_TTS_CACHE_MEMORY_MB", "32"))
+
+# Bump if the way audio is produced changes without the key inputs changing
+KEY_VERSION = "1"
+
+# Rescan the directory after writing this share of the disk budget, so several workers
+# overshoot it by at most workers x budget / RESCAN_FRACTION before someone evicts
+RESCAN_FRACTION = 32
+
+
+def cache_key(text: str, voice_id: str, model_id: str, output_format: str) -> str:
+    """Hash of everything that decides what the audio sounds like."""
+    raw = json.dumps([KEY_VERSION, text, voice_id, model_id, output_format], ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class TTSCache:
+    """
+    Two-tier LRU of audio bytes keyed by cache_key().
+    Disk files are written to a temp file and renamed into place, so a crash
+    (or another worker reading at the same time) never sees half a clip.
+    """
+
+    def __init__(self, directory: str = TTS_CACHE_DIR, disk_bytes: int = TTS_CACHE_DISK_MB * 1024 * 1024,
+                 memory_bytes: int = TTS_CACHE_MEMORY_MB * 1024 * 1024):
+        self.directory = directory
+        self.disk_bytes = disk_bytes
+        self.memory_bytes = memory_bytes
+        self._memory: "OrderedDict[str, bytes]" = OrderedDict()
+        self._memory_size = 0
+        # key -> size on disk, oldest first
+        self._disk: "OrderedDict[str, int]" = OrderedDict()
+        self._disk_size = 0
+        self._scanned = False
+        # Bytes we wrote since the last look at the whole directory
+        self._written = 0
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+        self.errors = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.disk_bytes > 0 or self.memory_bytes > 0
+
+    def _path(self, key: str) -> str:
+        # Two-level fan-out so no directory ends up with 100k files in it
+        return os.path.join(self.directory, key[:2], f"{key}.audio")
+
+    def _walk(self, clean: bool = False) -> List[Tuple[float, str, int]]:
+        # (mtime, key, size) of every clip on disk, oldest first (we touch files on every hit)
+        found = []
+        if os.path.isdir(self.directory):
+            for root, _, files in os.walk(self.directory):
+                for name in files:
+                    path = os.path.join(root, name)
+                    if clean and name.endswith(".tmp"):
+                        # Leftover from a crash mid-write
+                        _remove(path)
+                        continue
+                    if not name.endswith(".audio"):
+                        continue
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    found.append((st.st_mtime, name[:-len(".audio")], st.st_size))
+        return sorted(found)
+
+    def _scan(self):
+        # Rebuild the disk index once, LRU order comes from mtime
+        if self._scanned or self.disk_bytes <= 0:
+            return
+        self._scanned = True
+        for _, key, size in self._walk(clean=True):
+            self._disk[key] = size
+            self._disk_size += size
+        self._evict_disk()
+        logger.info(f"TTS cache: {len(self._disk)} clips ({self._disk_size // 1024} KB) on disk in {self.directory}")
+
+    @contextmanager
+    def _directory_lock(self):
+        if fcntl is None:
+            yield
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, ".lock"), "a") as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            yield
+
+    def share_budget(self) -> int:
+        """
+        Evict against everything in the directory, not just what this process wrote or read.
+        Runs under a file lock so workers sharing the directory don't evict on top of each other.
+        Returns how many clips went.
+        """
+        if self.disk_bytes <= 0:
+            return 0
+        with self._directory_lock():
+            found = self._walk()
+            total = sum(size for _, _, size in found)
+            evicted = 0
+            for _, key, size in found:
+                if total <= self.disk_bytes:
+                    break
+                _remove(self._path(key))
+                total -= size
+                evicted += 1
+        with self._lock:
+            self._disk = OrderedDict((key, size) for _, key, size in found[evicted:])
+            self._disk_size = total
+            self._scanned = True
+            self._written = 0
+            self.evictions += evicted
+        return evicted
+
+    def peek(self, key: str) -> Optional[bytes]:
+        """Memory tier only, never touches the disk (safe on the event loop)."""
+        if self.memory_bytes <= 0:
+            return None
+        with self._lock:
+            audio = self._memory.get(key)
+            if audio is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+            return audio
+
+    def contains(self, key: str) -> bool:
+        """Whether the clip is cached in either tier (doesn't count as a lookup)."""
+        with self._lock:
+            if key in self._memory:
+                return True
+            self._scan()
+            return key in self._disk
+
+    def get(self, key: str) -> Optional[bytes]:
+        audio = self.peek(key)
+        if audio is not None:
+            return audio
+        if self.disk_bytes <= 0:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self._scan()
+            known = key in self._disk
+        # Not in our index can still be on disk, another worker sharing the directory may have written it
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                audio = f.read()
+            os.utime(path)
+        except OSError:
+            # Never cached, or evicted under us, either way it's a miss
+            audio = None
+
+        with self._lock:
+            if audio is None:
+                self.misses += 1
+                if known:
+                    self._drop_disk(key)
+                return None
+            self.disk_hits += 1
+            if key not in self._disk:
+                self._disk[key] = len(audio)
+                self._disk_size += len(audio)
+            self._disk.move_to_end(key)
+            self._remember(key, audio)
+        return audio
+
+    def put(self, key: str, audio: bytes):
+        if not audio or not self.enabled:
+            return
+        with self._lock:
+            self._remember(key, audio)
+            if self.disk_bytes <= 0 or len(audio) > self.disk_bytes:
+                return
+            self._scan()
+            if key in self._disk:
+                return
+
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(audio)
+                os.replace(tmp, path)
+            except BaseException:
+                _remove(tmp)
+                raise
+        except OSError as e:
+            with self._lock:
+                self.errors += 1
+            logger.warning(f"Couldn't write TTS cache entry {key[:12]}: {e}")
+            return
+
+        with self._lock:
+            if key not in self._disk:
+                self._disk[key] = len(audio)
+                self._disk_size += len(audio)
+            self.writes += 1
+            self._written += len(audio)
+            self._evict_disk()
+            # Other workers have been writing too, time to look at the whole directory
+            rescan = self._written >= max(self.disk_bytes // RESCAN_FRACTION, 1)
+        if rescan:
+            try:
+                self.share_budget()
+            except OSError as e:
+                logger.warning(f"Couldn't rescan the TTS cache directory: {e}")
+
+    def _remember(self, key: str, audio: bytes):
+        # Caller holds the lock
+        if self.memory_bytes <= 0 or len(audio) > self.memory_bytes:
+            return
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memory_size -= len(old)
+        self._memory[key] = audio
+        self._memory_size += len(audio)
+        while self._memory_size > self.memory_bytes:
+            _, dropped = self._memory.popitem(last=False)
+            self._memory_size -= len(dropped)
+
+    def _drop_disk(self, key: str):
+        # Caller holds the lock
+        size = self._disk.pop(key, None)
+        if size is not None:
+            self._disk_size -= size
+
+    def _evict_disk(self):
+        # Caller holds the lock
+        while self._disk_size > self.disk_bytes and self._disk:
+            key, size = self._disk.popitem(last=False)
+            self._disk_size -= size
+            _remove(self._path(key))
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._scan()
+            for key in list(self._disk):
+                _remove(self._path(key))
+            self._disk.clear()
+            self._disk_size = 0
+            self._memory.clear()
+            self._memory_size = 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            self._scan()
+            hits = self.memory_hits + self.disk_hits
+            lookups = hits + self.misses
+            return {
+                "directory": self.directory,
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_size,
+                "memory_budget": self.memory_bytes,
+                "disk_entries": len(self._disk),
+                "disk_bytes": self._disk_size,
+                "disk_budget": self.disk_bytes,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+                "writes": self.writes,
+                "evictions": self.evictions,
+                "errors": self.errors,
+            }
+
+
+def _remove(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def read_phrases(path: str) -> Iterable[str]:
+    """One phrase per line, blank lines and # comments skipped."""
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                yield line
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Manage the ElevenLabs audio cache")
+    sub = parser.add_subparsers(dest="command", required=True)
+    warm = sub.add_parser("prewarm", help="Render a list of phrases so they're cached")
+    warm.add_argument("path", help="Text file, one phrase per line")
+    warm.add_argument("--voice", default=None, help="Voice id (defaults to ELEVENLABS_VOICE_ID)")
+    sub.add_parser("stats", help="Show what's in the disk cache")
+    sub.add_parser("clear", help="Delete every cached clip")
+    args = parser.parse_args(argv)
+
+    # Imported here, only prewarm needs the ElevenLabs side
+    from utils import voice_manager, warmup
+    warmup.configure()
+
+    if args.command == "prewarm":
+        t0 = time.perf_counter()
+        result = voice_manager.prewarm(read_phrases(args.path), voice_id=args.voice)
+        print(f"{result} in {time.perf_counter() - t0:.1f}s", file=sys.stderr)
+    elif args.command == "stats":
+        print(json.dumps(voice_manager.audio_cache.stats(), indent=2))
+    elif args.command == "clear":
+        voice_manager.audio_cache.clear()
+
+
+if __name__ == "__main__":
+    main()
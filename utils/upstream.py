@@ -0,0 +1,529 @@
+# Author: Steven Lansangan
+# One place for how we call Gemini and ElevenLabs
+# Every upstream call goes through an Upstream, which gives it:
+# - an adaptive concurrency limit (AIMD: grows while calls are healthy, shrinks on 429/5xx/timeouts)
+# - the request's deadline (set once per HTTP request, every call below it respects it)
+# - jittered exponential retries, only for errors that are worth retrying
+# - optional hedging: if a call is slower than the recent p95, fire a second one, first wins
+# - a circuit breaker, so a dead upstream fails fast instead of piling up requests
+import os
+import time
+import random
+import asyncio
+import threading
+import logging
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Optional
+
+from utils import metrics
+
+logger = logging.getLogger("Upstream")
+
+# Absolute time.monotonic() by which the current request has to be done (None = no deadline)
+_deadline: contextvars.ContextVar = contextvars.ContextVar("babaru_deadline", default=None)
+
+# Status codes that mean "try again later" (and, except 500, "you're sending too much")
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+OVERLOAD_STATUS = {429, 503}
+
+
+class UpstreamUnavailable(Exception):
+    """We didn't (or couldn't) get an answer, as opposed to the upstream rejecting the request."""
+
+
+class CircuitOpen(UpstreamUnavailable):
+    pass
+
+
+class DeadlineExceeded(UpstreamUnavailable):
+    pass
+
+
+# --- Deadlines ---
+@contextmanager
+def deadline(seconds: Optional[float]):
+    """Everything inside has at most `seconds` (never extends an outer deadline)."""
+    if seconds is None:
+        yield
+        return
+    new = time.monotonic() + seconds
+    current = _deadline.get()
+    token = _deadline.set(new if current is None else min(current, new))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining() -> Optional[float]:
+    """Seconds left on the current deadline (None if there isn't one)."""
+    current = _deadline.get()
+    return None if current is None else current - time.monotonic()
+
+
+# --- Error classification ---
+def status_of(error: BaseException) -> Optional[int]:
+    # google-genai errors have .code, elevenlabs/httpx ones .status_code (or .response.status_code)
+    for attr in ("code", "status_code"):
+        value = getattr(error, attr, None)
+        if isinstance(value, int):
+            return value
+    response = getattr(error, "response", None)
+    value = getattr(response, "status_code", None)
+    return value if isinstance(value, int) else None
+
+
+def is_retryable(error: BaseException) -> bool:
+    if isinstance(error, UpstreamUnavailable):
+        return False
+    if isinstance(error, (asyncio.TimeoutError, TimeoutError, ConnectionError)):
+        return True
+    status = status_of(error)
+    if status is not None:
+        return status in RETRYABLE_STATUS
+    # Transport errors from httpx/aiohttp don't share a base class we can import here
+    name = type(error).__name__
+    return "Timeout" in name or "Connect" in name or name in ("RemoteProtocolError", "ReadError")
+
+
+def is_overload(error: BaseException) -> bool:
+    return isinstance(error, (asyncio.TimeoutError, TimeoutError)) or status_of(error) in OVERLOAD_STATUS
+
+
+# --- Adaptive concurrency limit ---
+class AdaptiveLimit:
+    """
+    AIMD concurrency limit shared by threads and event loops.
+    Each success adds 1/limit (about +1 per round of calls), each overload
+    multiplies by BACKOFF. Waiters are served in order.
+    """
+
+    BACKOFF = 0.7
+
+    def __init__(self, initial: int, min_limit: int = 1, max_limit: int = 64):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = float(max(min_limit, min(initial, max_limit)))
+        self.in_flight = 0
+        self._lock = threading.Lock()
+        # threading.Event for blocking callers, (loop, future) for async ones
+        self._waiters: deque = deque()
+
+    def _has_room(self) -> bool:
+        return self.in_flight < int(self.limit)
+
+    def try_acquire(self) -> bool:
+        with self._lock:
+            if self._has_room() and not self._waiters:
+                self.in_flight += 1
+                return True
+            return False
+
+    def acquire(self, timeout: Optional[float]) -> bool:
+        with self._lock:
+            if self._has_room() and not self._waiters:
+                self.in_flight += 1
+                return True
+            event = threading.Event()
+            self._waiters.append(event)
+        if event.wait(timeout):
+            return True
+        with self._lock:
+            if event.is_set():
+                # Got the slot right as we gave up
+                return True
+            self._waiters.remove(event)
+            return False
+
+    async def acquire_async(self, timeout: Optional[float]) -> bool:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._has_room() and not self._waiters:
+                self.in_flight += 1
+                return True
+            future = loop.create_future()
+            self._waiters.append((loop, future))
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout)
+            return True
+        except asyncio.TimeoutError:
+            # Could have been granted right as we gave up
+            return self._abandon(loop, future)
+        except asyncio.CancelledError:
+            if self._abandon(loop, future):
+                self.release()
+            raise
+
+    def _abandon(self, loop, future) -> bool:
+        """Stop waiting for a slot. True if it was granted anyway."""
+        with self._lock:
+            if future.done() and not future.cancelled():
+                return True
+            # If the grant is already on its way, _grant() sees the cancel and hands the slot back
+            future.cancel()
+            try:
+                self._waiters.remove((loop, future))
+            except ValueError:
+                pass
+            return False
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+            self._wake()
+
+    def _wake(self):
+        # Caller holds the lock, hand freed slots straight to waiters
+        while self._waiters and self._has_room():
+            waiter = self._waiters.popleft()
+            self.in_flight += 1
+            if isinstance(waiter, threading.Event):
+                waiter.set()
+            else:
+                loop, future = waiter
+                loop.call_soon_threadsafe(_grant, future, self)
+
+    def on_success(self):
+        with self._lock:
+            self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+            self._wake()
+
+    def on_overload(self):
+        with self._lock:
+            self.limit = max(self.min_limit, self.limit * self.BACKOFF)
+
+
+def _grant(future: asyncio.Future, limit: AdaptiveLimit):
+    # Runs on the waiter's loop; if it gave up in the meantime, give the slot back
+    if future.done():
+        limit.release()
+    else:
+        future.set_result(True)
+
+
+# --- Circuit breaker ---
+class CircuitBreaker:
+    """closed -> (N failures in a row) -> open -> (cooldown) -> half_open -> one probe decides."""
+
+    def __init__(self, threshold: int = 5, cooldown: float = 30.0):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trips = 0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.cooldown:
+                self.state = "half_open"
+                self._probing = False
+            if self.state == "half_open" and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.state = "closed"
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.threshold:
+                if self.state != "open":
+                    self.trips += 1
+                    logger.warning(f"Circuit opened after {self.failures} failures, failing fast for {self.cooldown}s.")
+                self.state = "open"
+                self.opened_at = time.monotonic()
+                self._probing = False
+
+    def release_probe(self):
+        # The probe ended without telling us anything (e.g. a 400), let another one through
+        with self._lock:
+            self._probing = False
+
+
+# --- Upstream ---
+class Upstream:
+    def __init__(self, name: str, timeout: float = 60.0, max_attempts: int = 3, hedge: bool = False,
+                 initial_limit: int = 8, max_limit: int = 64, breaker_threshold: int = 5,
+                 breaker_cooldown: float = 30.0, backoff_base: float = 0.25, backoff_cap: float = 4.0):
+        self.name = name
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.hedge = hedge
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.limit = AdaptiveLimit(initial_limit, max_limit=max_limit)
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_cooldown)
+        # Successful call latencies, for the hedging threshold
+        self._latencies: deque = deque(maxlen=200)
+        self.calls = 0
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.failures = 0
+        self.rejected = 0
+
+    # Hedging only kicks in once we know what "normal" looks like
+    HEDGE_MIN_SAMPLES = 20
+
+    def p95(self) -> Optional[float]:
+        if len(self._latencies) < self.HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self._latencies)
+        return ordered[int(len(ordered) * 0.95) - 1]
+
+    def _budget(self) -> Optional[float]:
+        # Time this attempt may take: the per-call timeout, cut short by the request deadline
+        left = remaining()
+        if left is not None and left <= 0:
+            raise DeadlineExceeded(f"{self.name}: request deadline passed")
+        return self.timeout if left is None else min(self.timeout, left)
+
+    def _backoff(self, attempt: int) -> Optional[float]:
+        # Full jitter; None means the deadline doesn't leave room for another try
+        delay = random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+        left = remaining()
+        if left is not None and delay >= left:
+            return None
+        return delay
+
+    def _check_breaker(self):
+        if not self.breaker.allow():
+            self.rejected += 1
+            metrics.UPSTREAM_ERRORS.inc(upstream=self.name, error="circuit_open")
+            raise CircuitOpen(f"{self.name} is failing, not calling it for a bit")
+
+    def _record(self, error: Optional[BaseException], started: float, sample: bool = True):
+        # sample=False: don't count it towards the hedging p95 (a whole stream isn't a call latency)
+        latency = time.monotonic() - started
+        if error is None:
+            metrics.UPSTREAM_SECONDS.observe(latency, upstream=self.name, outcome="ok")
+        else:
+            kind = str(status_of(error) or ("timeout" if isinstance(error, asyncio.TimeoutError) else type(error).__name__))
+            metrics.UPSTREAM_SECONDS.observe(latency, upstream=self.name, outcome="error")
+            metrics.UPSTREAM_ERRORS.inc(upstream=self.name, error=kind)
+        if error is None:
+            if sample:
+                self._latencies.append(latency)
+            self.limit.on_success()
+            self.breaker.record_success()
+            return
+        if is_overload(error):
+            self.limit.on_overload()
+        if is_retryable(error):
+            self.breaker.record_failure()
+        else:
+            # The upstream answered (e.g. a 400), that's not an outage
+            self.breaker.release_probe()
+
+    # --- async ---
+    async def call_async(self, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """Await fn() (a fresh coroutine per attempt) with limits, retries, hedging and the breaker."""
+        self.calls += 1
+        attempt = 0
+        while True:
+            try:
+                return await self._attempt_async(fn)
+            except Exception as e:
+                attempt += 1
+                delay = self._backoff(attempt) if attempt < self.max_attempts and is_retryable(e) else None
+                if delay is None:
+                    self.failures += 1
+                    raise
+                self.retries += 1
+                logger.warning(f"{self.name} call failed ({type(e).__name__}: {e}), retry {attempt} in {delay:.2f}s")
+                await asyncio.sleep(delay)
+
+    async def _attempt_async(self, fn):
+        self._check_breaker()
+        budget = self._budget()
+        if not await self.limit.acquire_async(budget):
+            self.breaker.release_probe()
+            raise DeadlineExceeded(f"{self.name}: no concurrency slot before the deadline")
+        # Latency is measured from here, queueing for a slot isn't the upstream being slow
+        started = time.monotonic()
+        error = None
+        try:
+            budget = self._budget()
+            threshold = self.p95() if self.hedge else None
+            if threshold is None or threshold >= budget:
+                return await asyncio.wait_for(fn(), budget)
+            return await self._hedged(fn, threshold, budget)
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self.limit.release()
+            if not isinstance(error, asyncio.CancelledError):
+                self._record(error, started)
+
+    async def _hedged(self, fn, threshold: float, budget: float):
+        primary = asyncio.ensure_future(fn())
+        tasks = [primary]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=threshold)
+            if not done and self.limit.try_acquire():
+                # Slow one, race a second copy (only if there's room, hedging must not cause overload)
+                self.hedges += 1
+                backup = asyncio.ensure_future(fn())
+                backup.add_done_callback(lambda _: self.limit.release())
+                tasks.append(backup)
+            deadline_at = time.monotonic() + budget - threshold
+            while True:
+                left = deadline_at - time.monotonic()
+                done, pending = await asyncio.wait(tasks, timeout=max(left, 0), return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    raise asyncio.TimeoutError()
+                for task in done:
+                    if task.exception() is None:
+                        if task is not primary:
+                            self.hedge_wins += 1
+                        return task.result()
+                tasks = list(pending)
+                if not tasks:
+                    # Both failed, report the primary's error
+                    raise primary.exception()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def stream_async(self, fn: Callable[[], Awaitable[AsyncIterator[Any]]]) -> AsyncIterator[Any]:
+        """
+        Open a stream with fn() (a fresh one per attempt) and yield what it yields.
+        The concurrency slot is held until the stream is done, not just while it opens.
+        Retried like call_async until the first item is out, after that a failure is final.
+        Never hedged, and its time doesn't count towards the hedging p95.
+        """
+        self.calls += 1
+        attempt = 0
+        while True:
+            self._check_breaker()
+            budget = self._budget()
+            if not await self.limit.acquire_async(budget):
+                self.breaker.release_probe()
+                raise DeadlineExceeded(f"{self.name}: no concurrency slot before the deadline")
+            started = time.monotonic()
+            error = None
+            finished = yielded = False
+            try:
+                stream = await asyncio.wait_for(fn(), self._budget())
+                async for item in stream:
+                    yielded = True
+                    yield item
+                finished = True
+            except Exception as e:
+                error = e
+            finally:
+                self.limit.release()
+                # Cancelled, or the caller stopped reading: says nothing about the upstream
+                if finished or error is not None:
+                    self._record(error, started, sample=False)
+            if error is None:
+                return
+            attempt += 1
+            delay = self._backoff(attempt) if not yielded and attempt < self.max_attempts and is_retryable(error) else None
+            if delay is None:
+                self.failures += 1
+                raise error
+            self.retries += 1
+            logger.warning(f"{self.name} stream failed ({type(error).__name__}: {error}), retry {attempt} in {delay:.2f}s")
+            await asyncio.sleep(delay)
+
+    # --- blocking ---
+    def call(self, fn: Callable[[float], Any]) -> Any:
+        """Blocking version for threads (CLI, Streamlit, background jobs). No hedging.
+        A thread can't be interrupted from outside, so fn(timeout) gets the seconds this attempt
+        has (per-call timeout, cut short by the deadline) and hands them to the SDK as its request timeout."""
+        self.calls += 1
+        attempt = 0
+        while True:
+            try:
+                return self._attempt(fn)
+            except Exception as e:
+                attempt += 1
+                delay = self._backoff(attempt) if attempt < self.max_attempts and is_retryable(e) else None
+                if delay is None:
+                    self.failures += 1
+                    raise
+                self.retries += 1
+                logger.warning(f"{self.name} call failed ({type(e).__name__}: {e}), retry {attempt} in {delay:.2f}s")
+                time.sleep(delay)
+
+    def _attempt(self, fn):
+        self._check_breaker()
+        budget = self._budget()
+        if not self.limit.acquire(budget):
+            self.breaker.release_probe()
+            raise DeadlineExceeded(f"{self.name}: no concurrency slot before the deadline")
+        # Latency is measured from here, queueing for a slot isn't the upstream being slow
+        started = time.monotonic()
+        error = None
+        try:
+            return fn(self._budget())
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self.limit.release()
+            self._record(error, started)
+
+    def stats(self) -> Dict[str, Any]:
+        p95 = self.p95()
+        return {
+            "limit": round(self.limit.limit, 2),
+            "in_flight": self.limit.in_flight,
+            "waiting": len(self.limit._waiters),
+            "breaker": self.breaker.state,
+            "breaker_trips": self.breaker.trips,
+            "p95_ms": round(p95 * 1000, 1) if p95 is not None else None,
+            "calls": self.calls,
+            "retries": self.retries,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "failures": self.failures,
+            "rejected": self.rejected,
+        }
+
+
+# --- Registry ---
+# Per-upstream defaults, each overridable with BABARU_<NAME>_TIMEOUT / _LIMIT / _HEDGE
+DEFAULTS = {
+    "gemini": {"timeout": 60.0, "max_limit": 64, "hedge": False},
+    "elevenlabs": {"timeout": 30.0, "max_limit": 32, "hedge": False},
+}
+
+_upstreams: Dict[str, Upstream] = {}
+_registry_lock = threading.Lock()
+
+
+def get(name: str) -> Upstream:
+    upstream = _upstreams.get(name)
+    if upstream is None:
+        with _registry_lock:
+            upstream = _upstreams.get(name)
+            if upstream is None:
+                conf = DEFAULTS.get(name, {})
+                prefix = f"BABARU_{name.upper()}_"
+                upstream = Upstream(
+                    name,
+                    timeout=float(os.getenv(prefix + "TIMEOUT", conf.get("timeout", 60.0))),
+                    max_limit=int(os.getenv(prefix + "LIMIT", conf.get("max_limit", 64))),
+                    hedge=os.getenv(prefix + "HEDGE", "1" if conf.get("hedge") else "0") == "1",
+                )
+                _upstreams[name] = upstream
+    return upstream
+
+
+def stats() -> Dict[str, Dict[str, Any]]:
+    return {name: upstream.stats() for name, upstream in _upstreams.items()}
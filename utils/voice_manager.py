@@ -1,74 +1,356 @@
 # Author: Steven Lansangan
 # Manages Text-to-Speech using ElevenLabs
 import os
+import math
+import inspect
 import logging
-from elevenlabs import ElevenLabs
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+from utils import executors, upstream, metrics, warmup
+from utils.tts_cache import TTSCache, cache_key
+from utils.jukebox import SongRegistry
+
 logger = logging.getLogger("VoiceManager")
 
-# Get the key
-key = os.getenv("ELEVENLABS_API_KEY")
+def _build_clients():
+    # The SDK is only imported here (first use or startup warm-up), it's slow to import
+    from elevenlabs import ElevenLabs, AsyncElevenLabs
+
+    # Get the key
+    key = os.getenv("ELEVENLABS_API_KEY")
+
+    if key:
+        print(" hl Voice System: Online and ready.")
+    else:
+        # Print a loud warning so I see it in the logs
+        print("!!! WARNING: ElevenLabs API Key is MISSING !!!")
+        print("Please add ELEVENLABS_API_KEY to your environment variables.")
 
-if key:
-    print(" hl Voice System: Online and ready.")
-else:
-    # Print a loud warning so I see it in the logs
-    print("!!! WARNING: ElevenLabs API Key is MISSING !!!")
-    print("Please add ELEVENLABS_API_KEY to your environment variables.")
+    # ELEVENLABS_BASE_URL points it somewhere else, e.g. the fakes in benchmarks/fake_services.py
+    base_url = os.getenv("ELEVENLABS_BASE_URL")
+
+    try:
+        # Async one is for the API server, so TTS calls don't block the event loop
+        return ElevenLabs(api_key=key, base_url=base_url), AsyncElevenLabs(api_key=key, base_url=base_url)
+    except Exception as e:
+        print(f"Voice client crashed: {e}")
+        return None, None
 
-try:
-    client = ElevenLabs(api_key=key)
-except Exception as e:
-    print(f"Voice client crashed: {e}")
-    client = None
+# (client, async_client), built on first use
+clients = warmup.lazy("elevenlabs", _build_clients, stage="tts")
+
+MODEL_ID = "eleven_monolingual_v1"
+# Spelled out (it's the SDK default) because it's part of the audio cache key
+OUTPUT_FORMAT = "mp3_44100_128"
+
+# Rendered clips by hash of (text, voice, model, format), memory + disk
+audio_cache = TTSCache()
+
+# Limits, retries, deadline and circuit breaker for every ElevenLabs call
+elevenlabs = upstream.get("elevenlabs")
+
+# Songs for [PLAY_SONG: x], loaded once (api startup) in the same MP3 format as the TTS clips
+jukebox = SongRegistry(OUTPUT_FORMAT)
+songs = warmup.lazy("jukebox", jukebox.load, stage="mix")
 
 import re
 
+def _prepare_text(text: str, voice_id: str = None):
+    # User should provide a specific voice ID in .env, or we fallback
+    target_voice = voice_id or os.getenv("ELEVENLABS_VOICE_ID") or "21m00Tcm4TlvDq8ikWAM"
+
+    if not target_voice:
+        logger.error("No Voice ID provided (arg or env).")
+        return None, None
+
+    # Just in case the prompt fails, we strip asterisks here too
+    clean_text = re.sub(r'\*.*?\*', '', text)
+    # Collapse the gaps actions leave behind, so the same words always hit the same cache entry
+    clean_text = " ".join(clean_text.split())
+    return clean_text, target_voice
+
 def generate_voice(text: str, voice_id: str = None) -> bytes:
     """
     Converts text to speech and returns raw audio bytes (mp3).
     """
 
+    clean_text, target_voice = _prepare_text(text, voice_id)
+    if not clean_text:
+        return None
+
+    key = cache_key(clean_text, target_voice, MODEL_ID, OUTPUT_FORMAT)
+    cached = audio_cache.get(key)
+    if cached:
+        return cached
+
+    client, _ = clients.get()
     if not client:
         logger.error("ElevenLabs client not initialized.")
         return None
 
-    # User should provide a specific voice ID in .env, or we fallback
-    target_voice = voice_id or os.getenv("ELEVENLABS_VOICE_ID") or "21m00Tcm4TlvDq8ikWAM"
-    
-    if not target_voice:
-        logger.error("No Voice ID provided (arg or env).")
+    logger.info(f"Generating voice for cleaned text: {clean_text[:50]}...")
+    try:
+        # Generate audio generator
+        # Using text_to_speech.convert for v1+ SDK compatibility
+        # Convert generator to full bytes (inside the call, so a dropped stream gets retried too)
+        with metrics.stage("tts"):
+            audio_bytes = elevenlabs.call(lambda timeout: b"".join(client.text_to_speech.convert(
+                text=clean_text,
+                voice_id=target_voice,
+                model_id=MODEL_ID,
+                output_format=OUTPUT_FORMAT,
+                # Whole seconds only, rounded up so a short budget doesn't become 0 (no timeout)
+                request_options={"timeout_in_seconds": math.ceil(timeout)}
+            )))
+        audio_cache.put(key, audio_bytes)
+        return audio_bytes
+        
+    except Exception as e:
+        logger.error(f"Voice generation failed: {e}")
+        metrics.fallback("voice_failed")
         return None
 
-    # Just in case the prompt fails, we strip asterisks here too
-    clean_text = re.sub(r'\*.*?\*', '', text).strip()
-    
-    logger.info(f"Generating voice for cleaned text: {clean_text[:50]}...")
-    
+async def generate_voice_async(text: str, voice_id: str = None) -> bytes:
+    """
+    Async version of generate_voice for the API server.
+    """
+
+    clean_text, target_voice = _prepare_text(text, voice_id)
     if not clean_text:
         return None
 
-    try:
-        # Generate audio generator
-        # Using text_to_speech.convert for v1+ SDK compatibility
-        audio_generator = client.text_to_speech.convert(
+    key = cache_key(clean_text, target_voice, MODEL_ID, OUTPUT_FORMAT)
+    # Memory tier is free, only go to the disk tier (off the event loop) if that misses
+    with metrics.stage("tts_cache"):
+        cached = audio_cache.peek(key) or await executors.run("tts", audio_cache.get, key)
+    if cached:
+        return cached
+
+    _, async_client = await clients.get_async()
+    if not async_client:
+        logger.error("ElevenLabs client not initialized.")
+        return None
+
+    logger.info(f"Generating voice for cleaned text: {clean_text[:50]}...")
+    async def fetch():
+        stream = async_client.text_to_speech.convert(
             text=clean_text,
             voice_id=target_voice,
-            model_id="eleven_monolingual_v1"
+            model_id=MODEL_ID,
+            output_format=OUTPUT_FORMAT
         )
-        
-        # Convert generator to full bytes
-        audio_bytes = b"".join(audio_generator)
+        # Depending on the SDK version convert is a coroutine or hands back the iterator directly
+        if inspect.isawaitable(stream):
+            stream = await stream
+
+        chunks = []
+        async for chunk in stream:
+            chunks.append(chunk)
+        return b"".join(chunks)
+
+    try:
+        with metrics.stage("tts"):
+            audio_bytes = await elevenlabs.call_async(fetch)
+        await executors.run("tts", audio_cache.put, key, audio_bytes)
         return audio_bytes
-        
+
     except Exception as e:
         logger.error(f"Voice generation failed: {e}")
+        metrics.fallback("voice_failed")
         return None
 
+# --- Sentence Pipelining ---
+# Instead of waiting for the whole reply and synthesizing it in one go, we cut it
+# into sentences and synthesize a few at a time, handing back audio in order as
+# soon as each piece is ready. Works on a finished reply or on a live LLM stream.
+import asyncio
+from typing import AsyncIterable, Dict, Iterable, List, Optional, Tuple, Union
+
+# How many sentences are being synthesized at the same time
+TTS_PARALLELISM = int(os.getenv("BABARU_TTS_PARALLELISM", "3"))
+
+SONG_TAG = re.compile(r"\[PLAY_SONG:\s*(.*?)\]")
+# End of sentence: punctuation, optional closing quotes/brackets, then whitespace
+SENTENCE_END = re.compile(r"[.!?\u2026]+[\"'\u201d\u2019)\]]*\s+")
+ACTION = re.compile(r"\*.*?\*", re.DOTALL)
+
+# (kind, value): ("speech", "Some sentence.") or ("song", "anthem")
+Segment = Tuple[str, str]
+
+class SentenceChunker:
+    """
+    Turns reply text (whole, or delta by delta) into ordered speech/song segments.
+    - [PLAY_SONG: x] tags become their own "song" segment and are never spoken
+    - *actions* are stripped, and we never cut a sentence inside one
+    - very short sentences get merged with the next one (fewer tiny TTS calls)
+    """
+
+    def __init__(self, min_chars: int = 25):
+        self.min_chars = min_chars
+        self._buf = ""
+        # How much of _buf has already been turned into segments
+        self._consumed = 0
+        # Short sentences waiting to be merged with the next one
+        self._speech = ""
+
+    def feed(self, delta: str) -> List[Segment]:
+        self._buf += delta
+        return self._drain(final=False)
+
+    def flush(self) -> List[Segment]:
+        return self._drain(final=True)
+
+    def _drain(self, final: bool) -> List[Segment]:
+        out: List[Segment] = []
+        while True:
+            tag = SONG_TAG.search(self._buf)
+            if tag:
+                # Songs split the reply, everything before the tag has to go out first
+                out += self._sentences(self._buf[:tag.start()])
+                out += self._emit(self._buf[:tag.start()][self._consumed:], force=True)
+                out.append(("song", tag.group(1).strip().lower()))
+                self._buf = self._buf[tag.end():]
+                self._consumed = 0
+                continue
+
+            if final:
+                out += self._sentences(self._buf)
+                out += self._emit(self._buf[self._consumed:], force=True)
+                self._buf = ""
+                self._consumed = 0
+                return out
+
+            # Don't touch a tag that's still arriving ("[PLAY_SO...")
+            safe = self._buf
+            open_idx = safe.rfind("[")
+            if open_idx != -1 and "]" not in safe[open_idx:]:
+                safe = safe[:open_idx]
+            out += self._sentences(safe)
+            # Keep only what hasn't been emitted yet
+            self._buf = self._buf[self._consumed:]
+            self._consumed = 0
+            return out
+
+    def _sentences(self, text: str) -> List[Segment]:
+        # Emit every complete sentence in text past what we already consumed
+        out: List[Segment] = []
+        for m in SENTENCE_END.finditer(text, self._consumed):
+            # An odd number of asterisks means we're inside an *action*
+            if text.count("*", 0, m.end()) % 2 == 0:
+                out += self._emit(text[self._consumed:m.end()], force=False)
+                self._consumed = m.end()
+        return out
+
+    def _emit(self, text: str, force: bool) -> List[Segment]:
+        self._speech += ACTION.sub("", text)
+        if not self._speech.strip():
+            self._speech = ""
+            return []
+        if not force and len(self._speech.strip()) < self.min_chars:
+            return []
+        speech = " ".join(self._speech.split())
+        self._speech = ""
+        return [("speech", speech)]
+
+def split_segments(text: str) -> List[Segment]:
+    """Segments for a complete reply."""
+    chunker = SentenceChunker()
+    return chunker.feed(text) + chunker.flush()
+
+def load_song_bytes(name: str) -> Optional[bytes]:
+    # Already in the TTS clips' format, so it can go out between them as-is
+    songs.get()
+    song = jukebox.get(name)
+    if not song:
+        logger.warning(f"Song not found: {name}")
+        return None
+    return song.audio
+
+async def _aiter(segments: Union[Iterable[Segment], AsyncIterable[Segment]]):
+    if hasattr(segments, "__aiter__"):
+        async for seg in segments:
+            yield seg
+    else:
+        for seg in segments:
+            yield seg
+
+async def synthesize_segments(segments, voice_id: str = None, concurrency: int = TTS_PARALLELISM):
+    """
+    Synthesize segments with at most `concurrency` TTS calls in flight.
+    Yields (kind, value, audio_bytes) in the original order, each one as soon as
+    it and everything before it is ready. `segments` can be a live async stream.
+    """
+    sem = asyncio.Semaphore(concurrency)
+    ready: asyncio.Queue = asyncio.Queue()
+
+    async def render(kind: str, value: str) -> Optional[bytes]:
+        if kind == "song":
+            return await executors.run("tts", load_song_bytes, value)
+        async with sem:
+            return await generate_voice_async(value, voice_id)
+
+    async def produce():
+        try:
+            async for kind, value in _aiter(segments):
+                ready.put_nowait((kind, value, asyncio.ensure_future(render(kind, value))))
+        finally:
+            ready.put_nowait(None)
+
+    producer = asyncio.ensure_future(produce())
+    try:
+        while True:
+            item = await ready.get()
+            if item is None:
+                break
+            kind, value, task = item
+            yield kind, value, await task
+        # Surface errors from the segment source
+        await producer
+    finally:
+        producer.cancel()
+        while not ready.empty():
+            item = ready.get_nowait()
+            if item is not None:
+                item[2].cancel()
+
+async def generate_voice_pipelined(text: str, voice_id: str = None) -> Optional[bytes]:
+    """Like generate_voice_async, but sentences are synthesized in parallel and spliced frame by frame."""
+    parts = []
+    async for _, _, audio in synthesize_segments(split_segments(text), voice_id):
+        if audio:
+            parts.append(audio)
+    if len(parts) <= 1:
+        return parts[0] if parts else None
+    # Each clip has its own ID3 tag and Xing header, those can't end up in the middle of the stream
+    joined = jukebox.join_clips(parts)
+    if joined is None:
+        logger.warning("TTS clips don't share one MP3 format, sending them back to back.")
+        return b"".join(parts)
+    return joined
+
+# --- Cache Pre-warming ---
+def prewarm(phrases: Iterable[str], voice_id: str = None) -> Dict[str, int]:
+    """
+    Render phrases into the audio cache so they cost nothing the next time.
+    Each phrase is cached whole (what /v1/speak sends) and cut into sentences
+    (what the pipelined chat audio sends).
+    """
+    counts = {"cached": 0, "rendered": 0, "failed": 0}
+    for phrase in phrases:
+        texts = [phrase] + [value for kind, value in split_segments(phrase) if kind == "speech" and value != phrase]
+        for text in texts:
+            clean_text, target_voice = _prepare_text(text, voice_id)
+            if not clean_text:
+                continue
+            if audio_cache.contains(cache_key(clean_text, target_voice, MODEL_ID, OUTPUT_FORMAT)):
+                counts["cached"] += 1
+            elif generate_voice(text, voice_id):
+                counts["rendered"] += 1
+            else:
+                counts["failed"] += 1
+    logger.info(f"TTS prewarm: {counts}")
+    return counts
+
 # --- Audio Mixing (The Jukebox) ---
-from pydub import AudioSegment
 import io
 
 def mix_audio_sandwich(intro_bytes: bytes, song_path: str, outro_bytes: bytes) -> bytes:
@@ -76,6 +358,8 @@ def mix_audio_sandwich(intro_bytes: bytes, song_path: str, outro_bytes: bytes) -
     Combines: Intro (TTS) + Song (File) + Outro (TTS) -> One MP3
     """
     try:
+        # Only now, pydub is a slow import and most replies never get here
+        from pydub import AudioSegment
         combined = AudioSegment.empty()
         
         # 1. Add Intro
@@ -101,3 +385,22 @@ def mix_audio_sandwich(intro_bytes: bytes, song_path: str, outro_bytes: bytes) -
     except Exception as e:
         logger.error(f"Mixing failed: {e}")
         return None
+
+def mix_song(intro_bytes: bytes, song_name: str, outro_bytes: bytes) -> Optional[bytes]:
+    """
+    Intro (TTS) + Song + Outro (TTS), the fast way when we can.
+    Clips in the song's format are glued frame by frame (no decoding),
+    anything else goes through the ffmpeg sandwich above.
+    """
+    songs.get()
+    song = jukebox.get(song_name)
+    if not song:
+        return None
+    with metrics.stage("mix"):
+        spliced = jukebox.splice(intro_bytes, song, outro_bytes)
+        if spliced:
+            return spliced
+        logger.warning(f"TTS format doesn't match {song.name} {song.format}, mixing with ffmpeg.")
+        jukebox.transcoded += 1
+        metrics.fallback("ffmpeg_mix")
+        return mix_audio_sandwich(intro_bytes, song.path, outro_bytes)
@@ -0,0 +1,118 @@
+# Author: Steven Lansangan
+# Heavy stuff (SDK clients, songs, the prompt cache) built on first use, not on import
+# Importing google-genai / elevenlabs / pydub and building their clients used to
+# happen the moment api.py was imported, so a cold replica sat there for seconds
+# before it could even bind its port. Now each of those is a Lazy: built the
+# first time someone needs it, or warmed in the background right after startup,
+# and /ready reports which ones are done.
+import time
+import asyncio
+import logging
+import threading
+from typing import Any, Callable, Dict, Iterable, Optional
+
+from utils import executors
+
+logger = logging.getLogger("Warmup")
+
+_configured = False
+
+
+def configure():
+    """.env and logging, for entry points (api.py, app.py, CLIs) to call before anything else.
+    Library modules never do this on import anymore."""
+    global _configured
+    if _configured:
+        return
+    _configured = True
+    logging.basicConfig(level=logging.INFO)
+    try:
+        from dotenv import load_dotenv
+        load_dotenv()
+    except ImportError:
+        logger.warning("python-dotenv not installed, .env not loaded.")
+
+
+class Lazy:
+    """Builds a value on first get() (once, thread-safe) and remembers how it went.
+    A failed build isn't cached, the next get() tries again."""
+
+    def __init__(self, name: str, factory: Callable[[], Any], stage: str = "db"):
+        self.name = name
+        self.factory = factory
+        # Executor stage get_async() builds on, so the event loop never does the heavy lifting
+        self.stage = stage
+        self.value = None
+        self.ready = False
+        self.error: Optional[str] = None
+        self.seconds: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def get(self) -> Any:
+        if self.ready:
+            return self.value
+        with self._lock:
+            if not self.ready:
+                started = time.perf_counter()
+                try:
+                    self.value = self.factory()
+                except Exception as e:
+                    self.error = f"{type(e).__name__}: {e}"
+                    raise
+                self.seconds = time.perf_counter() - started
+                self.error = None
+                self.ready = True
+                logger.info(f"{self.name} ready in {self.seconds * 1000:.0f}ms")
+        return self.value
+
+    async def get_async(self) -> Any:
+        if self.ready:
+            return self.value
+        return await executors.run(self.stage, self.get)
+
+    def state(self) -> Dict[str, Any]:
+        return {
+            "ready": self.ready,
+            "ms": round(self.seconds * 1000, 1) if self.seconds is not None else None,
+            "error": self.error,
+        }
+
+
+_registry: Dict[str, Lazy] = {}
+
+
+def lazy(name: str, factory: Callable[[], Any], stage: str = "db") -> Lazy:
+    """Register a Lazy under a name, so warm() and /ready know about it."""
+    item = _registry[name] = Lazy(name, factory, stage)
+    return item
+
+
+def get(name: str) -> Any:
+    return _registry[name].get()
+
+
+def warm(names: Optional[Iterable[str]] = None) -> Dict[str, Dict[str, Any]]:
+    """Build everything (or just `names`) now, one at a time. Failures are logged, not raised."""
+    for name in list(names or _registry):
+        try:
+            _registry[name].get()
+        except Exception as e:
+            logger.error(f"Warming {name} failed: {e}")
+    return states()
+
+
+async def warm_async(names: Optional[Iterable[str]] = None):
+    """Same, each on its own stage's executor, all at the same time."""
+    items = [_registry[name] for name in (names or list(_registry))]
+    results = await asyncio.gather(*(item.get_async() for item in items), return_exceptions=True)
+    for item, result in zip(items, results):
+        if isinstance(result, Exception):
+            logger.error(f"Warming {item.name} failed: {result}")
+
+
+def states() -> Dict[str, Dict[str, Any]]:
+    return {name: item.state() for name, item in _registry.items()}
+
+
+def all_ready(names: Optional[Iterable[str]] = None) -> bool:
+    return all(_registry[name].ready for name in (names or _registry))